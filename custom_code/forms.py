@@ -1,5 +1,6 @@
 from django import forms
-from .models import TidesTarget, TidesClass, TidesClassSubClass
+from tidestom.tides_utils.taxonomy import get_taxonomy
+from .models import TidesTarget, TidesClassSubClass
 
 class TidesTargetForm(forms.ModelForm):
     class Meta:
@@ -8,26 +9,19 @@ class TidesTargetForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Sub-classes of the selected class, from the in-memory taxonomy; the queryset stays lazy, so building the
+        # form runs no query, and the page fills the options from the taxonomy endpoint
         self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.none()
 
         if 'tidesclass' in self.data:
-            try:
-                main_class_name = self.data.get('tidesclass')
-                print(f"Trying to get TidesClass with name: {main_class_name}")
-                main_class = TidesClass.objects.get(name=main_class_name)
-                self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(main_class=main_class)
-            except (ValueError, TypeError, TidesClass.DoesNotExist):
-                print(f"TidesClass with name {main_class_name} does not exist.")
-                pass  # invalid input from the client; ignore and fallback to empty queryset
+            main_class_name = self.data.get('tidesclass')
         elif self.instance.pk:
-            try:
-                main_class_name = self.instance.tidesclass
-                print(f"Trying to get TidesClass with name: {main_class_name}")
-                main_class = TidesClass.objects.get(name=main_class_name)
-                self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(main_class=main_class)
-            except TidesClass.DoesNotExist:
-                print(f"TidesClass with name {main_class_name} does not exist.")
-                pass  # handle the case where the main class does not exist
+            main_class_name = self.instance.tidesclass
+        else:
+            return
+        subclass_ids = [subclass_id for subclass_id, _ in get_taxonomy().subclasses_of(main_class_name)]
+        if subclass_ids:
+            self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(id__in=subclass_ids)
     
     def clean(self):
         cleaned_data = super().clean()
@@ -0,0 +1,75 @@
+"""
+Target matching for TidesTarget, installed through ``MATCH_MANAGERS`` in settings. TOM imports this module while it
+defines ``BaseTarget``, so it must not import ``custom_code.models``.
+"""
+from math import radians
+from django.conf import settings
+from django.db.models import Exists, ExpressionWrapper, FloatField, OuterRef, Q, Value
+from django.db.models.functions import ACos, Cos, Least, Lower, Pi, Radians, Replace, Sin
+from tom_targets.base_models import TargetMatchManager
+from tidestom.tides_utils.sky_index import cone_cell_ranges
+
+# Characters removed by TargetMatchManager.simplify_name
+SIMPLIFIED_CHARACTERS = (' ', '-', '_', '(', ')')
+
+
+def simplified(expression):
+    '''Database version of ``TargetMatchManager.simplify_name``.'''
+    expression = Lower(expression)
+    for character in SIMPLIFIED_CHARACTERS:
+        expression = Replace(expression, Value(character), Value(''))
+    return expression
+
+
+class TidesTargetMatchManager(TargetMatchManager):
+    """
+    Matches a target by name or alias, as TOM does, and by position: anything within ``TARGET_MATCH_RADIUS``
+    arcseconds is the same object, whatever the alert stream called it. Both lookups run in the database on indexed
+    columns, so they cost the same with a thousand targets or millions.
+    """
+
+    def match_target(self, target, *args, **kwargs):
+        queryset = self.match_name(target.name)
+        radius = getattr(settings, 'TARGET_MATCH_RADIUS', None)
+        if not radius or target.ra is None or target.dec is None:
+            return queryset
+        return self.get_queryset().filter(
+            Q(pk__in=queryset.values('pk')) |
+            Q(pk__in=self.match_cone_search(target.ra, target.dec, radius).values('pk')))
+
+    def match_cone_search(self, ra, dec, radius):
+        '''
+        TOM's cone search, with the candidates taken from the sky cells that cover the cone instead of a box on
+        ra/dec, which cannot use an index on both columns and misses targets across ra = 0. The queryset keeps TOM's
+        ``separation`` annotation, in degrees, computed for the candidates only.
+
+        :param radius: The radius in arcseconds
+        '''
+        if ra is None or dec is None or radius is None or not -90 <= dec <= 90:
+            return self.get_queryset().none()
+        ra %= 360
+        radius /= 3600
+        cells = Q()
+        for first, last in cone_cell_ranges(ra, dec, radius):
+            cells |= Q(sky_cell__range=(first, last))
+        separation = ExpressionWrapper(
+            ACos(
+                Least(
+                    (Sin(radians(dec)) * Sin(Radians('dec'))) +
+                    (Cos(radians(dec)) * Cos(Radians('dec')) * Cos(radians(ra) - Radians('ra'))), 1.0
+                )
+            ) * 180 / Pi(), FloatField()
+        )
+        return self.get_queryset().filter(cells).annotate(separation=separation).filter(separation__lte=radius)
+
+    def match_fuzzy_name(self, name):
+        '''
+        Same matches as TOM's ``match_fuzzy_name``, which simplifies the names of every target in Python; here the
+        comparison is a single query.
+        '''
+        from tom_targets.models import TargetName  # imports BaseTarget, see the module docstring
+        simple_name = self.simplify_name(name)
+        aliases = TargetName.objects.annotate(simple_name=simplified('name')).filter(
+            target=OuterRef('pk'), simple_name=simple_name)
+        return self.get_queryset().annotate(simple_name=simplified('name')).filter(
+            Q(simple_name=simple_name) | Exists(aliases))
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0007_humantidesclasssubmission"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpectrumFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=1024, unique=True)),
+                ("size", models.BigIntegerField()),
+                ("mtime", models.FloatField()),
+                ("sha256", models.CharField(db_index=True, max_length=64)),
+                ("first_seen", models.DateTimeField(auto_now_add=True)),
+                ("last_seen", models.DateTimeField(auto_now=True)),
+                (
+                    "data_product",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="spectrum_files",
+                        to="tom_dataproducts.dataproduct",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0009_ingestioncheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpectrumData",
+            fields=[
+                (
+                    "reduced_datum",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="spectrum_data",
+                        serialize=False,
+                        to="tom_dataproducts.reduceddatum",
+                    ),
+                ),
+                ("wavelength", models.BinaryField()),
+                ("flux", models.BinaryField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_code", "0010_spectrumdata"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpectrumThumbnail",
+            fields=[
+                (
+                    "target",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="spectrum_thumbnail",
+                        serialize=False,
+                        to="custom_code.tidestarget",
+                    ),
+                ),
+                ("version", models.CharField(max_length=16)),
+                ("rendered", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:47
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.db.models.deletion
+
+
+def summarise_targets(apps, schema_editor):
+    TidesTarget = apps.get_model('custom_code', 'TidesTarget')
+    TargetSummary = apps.get_model('custom_code', 'TargetSummary')
+    HumanTidesClassSubmission = apps.get_model('custom_code', 'HumanTidesClassSubmission')
+    ReducedDatum = apps.get_model('tom_dataproducts', 'ReducedDatum')
+    spectra = {
+        row['target_id']: row for row in
+        ReducedDatum.objects.filter(data_type='spectroscopy').values('target_id')
+        .annotate(n_spectra=Count('id'), latest_spectrum=Max('timestamp'))
+    }
+    submissions = dict(HumanTidesClassSubmission.objects.values('target_id').annotate(n=Count('id'))
+                       .values_list('target_id', 'n'))
+    summaries = []
+    for target in TidesTarget.objects.values(
+            'pk', 'name', 'created', 'auto_tidesclass', 'auto_tidesclass_subclass__sub_class', 'auto_tidesclass_prob',
+            'spectrum_thumbnail__version', 'human_tidesclass').iterator():
+        target_spectra = spectra.get(target['pk'], {})
+        summaries.append(TargetSummary(
+            target_id=target['pk'],
+            name=target['name'],
+            created=target['created'],
+            n_spectra=target_spectra.get('n_spectra', 0),
+            latest_spectrum=target_spectra.get('latest_spectrum'),
+            thumbnail_version=target['spectrum_thumbnail__version'] or '',
+            auto_tidesclass=target['auto_tidesclass'],
+            auto_tidesclass_subclass=target['auto_tidesclass_subclass__sub_class'],
+            auto_tidesclass_prob=target['auto_tidesclass_prob'],
+            human_tidesclass=target['human_tidesclass'],
+            n_human_submissions=submissions.get(target['pk'], 0),
+        ))
+    TargetSummary.objects.bulk_create(summaries, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0011_spectrumthumbnail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TargetSummary",
+            fields=[
+                (
+                    "target",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="custom_code.tidestarget",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("created", models.DateTimeField()),
+                ("n_spectra", models.IntegerField(default=0)),
+                ("latest_spectrum", models.DateTimeField(blank=True, null=True)),
+                (
+                    "thumbnail_version",
+                    models.CharField(blank=True, default="", max_length=16),
+                ),
+                (
+                    "auto_tidesclass",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                (
+                    "auto_tidesclass_subclass",
+                    models.CharField(blank=True, max_length=100, null=True),
+                ),
+                ("auto_tidesclass_prob", models.FloatField(blank=True, null=True)),
+                (
+                    "human_tidesclass",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                ("n_human_submissions", models.IntegerField(default=0)),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["-created", "-target"], name="targetsummary_created"
+                    ),
+                    models.Index(
+                        condition=models.Q(("latest_spectrum__isnull", False)),
+                        fields=["-created", "-target"],
+                        name="targetsummary_with_spectra",
+                    ),
+                ],
+            },
+        ),
+        migrations.RunPython(summarise_targets, migrations.RunPython.noop),
+    ]
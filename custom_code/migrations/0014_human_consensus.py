@@ -0,0 +1,119 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+def _majority(votes):
+    # votes maps a choice to (count, id of its first submission); ties go to the choice submitted first
+    return min(votes, key=lambda choice: (-votes[choice][0], votes[choice][1])) if votes else None
+
+
+def _vote(votes, key, choice, submission_id):
+    # Submissions are counted in id order, so the first id seen for a choice is its first submission
+    n, first = votes.setdefault(key, {}).get(choice, (0, submission_id))
+    votes[key][choice] = (n + 1, first)
+
+
+def compute_human_consensus(apps, schema_editor):
+    # A frozen copy of the consensus rules as of this migration, so later changes to the live code cannot alter it
+    TidesTarget = apps.get_model('custom_code', 'TidesTarget')
+    TargetSummary = apps.get_model('custom_code', 'TargetSummary')
+    HumanTidesClassSubmission = apps.get_model('custom_code', 'HumanTidesClassSubmission')
+    class_votes, subclass_votes, other_votes = {}, {}, {}
+    for submission_id, target_id, tidesclass, other, subclass_id in HumanTidesClassSubmission.objects.order_by(
+            'id').values_list('id', 'target_id', 'tidesclass', 'tidesclass_other', 'tidesclass_subclass_id'):
+        _vote(class_votes, target_id, tidesclass, submission_id)
+        if subclass_id:
+            _vote(subclass_votes, (target_id, tidesclass), subclass_id, submission_id)
+        if other:
+            _vote(other_votes, (target_id, tidesclass), other, submission_id)
+
+    targets, summaries = [], []
+    for target_id, votes in class_votes.items():
+        majority = _majority(votes)
+        total = sum(n for n, _ in votes.values())
+        targets.append(TidesTarget(
+            pk=target_id,
+            human_tidesclass=majority,
+            human_tidesclass_other=_majority(other_votes.get((target_id, majority), {})),
+            human_tidesclass_subclass_id=_majority(subclass_votes.get((target_id, majority), {})),
+            human_tidesclass_votes={choice: n for choice, (n, _) in votes.items()},
+            human_tidesclass_count=total,
+            human_tidesclass_agreement=votes[majority][0] / total,
+        ))
+        summaries.append(TargetSummary(target_id=target_id, human_tidesclass=majority, n_human_submissions=total))
+    TidesTarget.objects.bulk_update(targets, ['human_tidesclass', 'human_tidesclass_other',
+                                              'human_tidesclass_subclass', 'human_tidesclass_votes',
+                                              'human_tidesclass_count', 'human_tidesclass_agreement'],
+                                    batch_size=2000)
+    TargetSummary.objects.bulk_update(summaries, ['human_tidesclass', 'n_human_submissions'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_code", "0013_targetsummary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tidestarget",
+            name="human_tidesclass_agreement",
+            field=models.FloatField(
+                blank=True,
+                db_index=True,
+                null=True,
+                verbose_name="Human TiDES Classification Agreement",
+            ),
+        ),
+        migrations.AddField(
+            model_name="tidestarget",
+            name="human_tidesclass_count",
+            field=models.IntegerField(
+                db_index=True,
+                default=0,
+                verbose_name="Number of Human TiDES Classifications",
+            ),
+        ),
+        migrations.AddField(
+            model_name="tidestarget",
+            name="human_tidesclass_votes",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                verbose_name="Human TiDES Classification Votes",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="tidestarget",
+            name="human_tidesclass",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("SN", "SN"),
+                    ("SNI", "SNI"),
+                    ("SNIa", "SNIa"),
+                    ("SNIbc", "SNIbc"),
+                    ("SNIb", "SNIb"),
+                    ("SNIc", "SNIc"),
+                    ("SNId", "SNId"),
+                    ("SNIe", "SNIe"),
+                    ("SNII", "SNII"),
+                    ("SLSN-I", "SLSN-I"),
+                    ("SLSN-II", "SLSN-II"),
+                    ("TDE", "TDE"),
+                    ("KN", "KN"),
+                    ("AGN", "AGN"),
+                    ("LRN", "LRN"),
+                    ("CV", "CV"),
+                    ("LBV", "LBV"),
+                    ("Other", "Other"),
+                ],
+                db_index=True,
+                max_length=50,
+                null=True,
+                verbose_name="Human TiDES Classification",
+            ),
+        ),
+        migrations.RunPython(compute_human_consensus, migrations.RunPython.noop),
+    ]
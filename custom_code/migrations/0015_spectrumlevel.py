@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_code", "0014_human_consensus"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpectrumLevel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("n_bins", models.IntegerField()),
+                ("wavelength", models.BinaryField()),
+                ("flux", models.BinaryField()),
+                (
+                    "spectrum",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="levels",
+                        to="custom_code.spectrumdata",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="spectrumlevel",
+            constraint=models.UniqueConstraint(
+                fields=("spectrum", "n_bins"), name="unique_spectrum_level"
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:02
+
+from django.db import migrations, models
+
+
+def index_target_positions(apps, schema_editor):
+    from tidestom.tides_utils.sky_index import sky_cells
+    TidesTarget = apps.get_model('custom_code', 'TidesTarget')
+    positions = [(target_id, ra, dec) for target_id, ra, dec in
+                 TidesTarget.objects.filter(ra__isnull=False, dec__isnull=False, dec__gte=-90, dec__lte=90)
+                 .values_list('pk', 'ra', 'dec')]
+    if not positions:
+        return
+    target_ids, ras, decs = zip(*positions)
+    table = schema_editor.quote_name(TidesTarget._meta.db_table)
+    pk_column = schema_editor.quote_name(TidesTarget._meta.pk.column)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(f'UPDATE {table} SET sky_cell = %s WHERE {pk_column} = %s',
+                           [(int(cell), target_id) for cell, target_id in zip(sky_cells(ras, decs), target_ids)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_code", "0015_spectrumlevel"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tidestarget",
+            name="sky_cell",
+            field=models.BigIntegerField(
+                blank=True,
+                db_index=True,
+                null=True,
+                verbose_name="Sky Cell",
+            ),
+        ),
+        migrations.RunPython(index_target_positions, migrations.RunPython.noop),
+    ]
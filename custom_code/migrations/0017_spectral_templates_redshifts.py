@@ -0,0 +1,102 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0016_tidestarget_sky_cell"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpectralTemplate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=200, unique=True)),
+                (
+                    "tidesclass",
+                    models.CharField(
+                        blank=True,
+                        choices=[
+                            ("SN", "SN"),
+                            ("SNI", "SNI"),
+                            ("SNIa", "SNIa"),
+                            ("SNIbc", "SNIbc"),
+                            ("SNIb", "SNIb"),
+                            ("SNIc", "SNIc"),
+                            ("SNId", "SNId"),
+                            ("SNIe", "SNIe"),
+                            ("SNII", "SNII"),
+                            ("SLSN-I", "SLSN-I"),
+                            ("SLSN-II", "SLSN-II"),
+                            ("TDE", "TDE"),
+                            ("KN", "KN"),
+                            ("AGN", "AGN"),
+                            ("LRN", "LRN"),
+                            ("CV", "CV"),
+                            ("LBV", "LBV"),
+                            ("Other", "Other"),
+                        ],
+                        max_length=50,
+                        null=True,
+                        verbose_name="TiDES Classification",
+                    ),
+                ),
+                ("wavelength", models.BinaryField()),
+                ("flux", models.BinaryField()),
+                ("updated", models.DateTimeField(auto_now=True)),
+                (
+                    "tidesclass_subclass",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="templates",
+                        to="custom_code.tidesclasssubclass",
+                        verbose_name="TiDES Sub-classification",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RedshiftEstimate",
+            fields=[
+                (
+                    "reduced_datum",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="redshift_estimate",
+                        serialize=False,
+                        to="tom_dataproducts.reduceddatum",
+                    ),
+                ),
+                ("redshift", models.FloatField()),
+                ("redshift_err", models.FloatField()),
+                ("r_value", models.FloatField(db_index=True)),
+                ("estimated", models.DateTimeField(auto_now=True)),
+                (
+                    "template",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="redshift_estimates",
+                        to="custom_code.spectraltemplate",
+                    ),
+                ),
+            ],
+        ),
+    ]
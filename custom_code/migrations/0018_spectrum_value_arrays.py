@@ -0,0 +1,66 @@
+# Generated by Django 4.2.30 on 2026-10-19 09:12
+
+from django.db import migrations
+import numpy as np
+
+VALUE_BINS = 512
+
+
+def decimate_minmax(wavelength, flux, n_bins):
+    # Frozen copy of spectrum_store.decimate_minmax as of this migration
+    n_pixels = len(flux)
+    if n_pixels <= 2 * n_bins:
+        return wavelength, flux
+    run = -(-n_pixels // n_bins)
+    n_bins = -(-n_pixels // run)
+    finite = np.isfinite(flux)
+    low = np.full(n_bins * run, np.inf)
+    low[:n_pixels] = np.where(finite, flux, np.inf)
+    high = np.full(n_bins * run, -np.inf)
+    high[:n_pixels] = np.where(finite, flux, -np.inf)
+    offsets = np.arange(n_bins) * run
+    index = np.sort(np.stack([low.reshape(n_bins, run).argmin(axis=1) + offsets,
+                              high.reshape(n_bins, run).argmax(axis=1) + offsets], axis=1), axis=1).ravel()
+    index = index[np.r_[True, index[1:] != index[:-1]]]
+    return wavelength[index], flux[index]
+
+
+def add_value_arrays(apps, schema_editor):
+    '''Gives the binary spectra a decimated copy of their arrays in the JSON value, which TOM's own code reads.'''
+    ReducedDatum = apps.get_model('tom_dataproducts', 'ReducedDatum')
+    SpectrumData = apps.get_model('custom_code', 'SpectrumData')
+    last_id = 0
+    while True:
+        batch = list(SpectrumData.objects.filter(reduced_datum_id__gt=last_id).order_by('reduced_datum_id')
+                     .select_related('reduced_datum')[:500])
+        if not batch:
+            break
+        last_id = batch[-1].reduced_datum_id
+        datums = []
+        for spectrum_data in batch:
+            datum = spectrum_data.reduced_datum
+            wavelength, flux = decimate_minmax(np.frombuffer(spectrum_data.wavelength, dtype='<f4'),
+                                               np.frombuffer(spectrum_data.flux, dtype='<f4'), VALUE_BINS)
+            datum.value = dict(datum.value, wavelength=wavelength.tolist(), flux=flux.tolist())
+            datums.append(datum)
+        ReducedDatum.objects.bulk_update(datums, ['value'])
+
+
+def remove_value_arrays(apps, schema_editor):
+    ReducedDatum = apps.get_model('tom_dataproducts', 'ReducedDatum')
+    datums = list(ReducedDatum.objects.filter(data_type='spectroscopy', value__storage='float32'))
+    for datum in datums:
+        datum.value = {key: value for key, value in datum.value.items() if key not in ('wavelength', 'flux')}
+    ReducedDatum.objects.bulk_update(datums, ['value'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0017_spectral_templates_redshifts"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_value_arrays, remove_value_arrays),
+    ]
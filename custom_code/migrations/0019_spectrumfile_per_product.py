@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+def add_product_entries(apps, schema_editor):
+    '''
+    Multi-target L1 files were recorded with the first of their DataProducts only; the others, which point at the
+    same file, get entries of their own.
+    '''
+    SpectrumFile = apps.get_model('custom_code', 'SpectrumFile')
+    DataProduct = apps.get_model('tom_dataproducts', 'DataProduct')
+    entries = []
+    for entry in SpectrumFile.objects.filter(data_product__isnull=False).select_related('data_product'):
+        recorded = set(SpectrumFile.objects.filter(path=entry.path).values_list('data_product_id', flat=True))
+        for data_product_id in DataProduct.objects.filter(data=entry.data_product.data).exclude(
+                id__in=recorded).values_list('id', flat=True):
+            entries.append(SpectrumFile(path=entry.path, size=entry.size, mtime=entry.mtime, sha256=entry.sha256,
+                                        data_product_id=data_product_id))
+    SpectrumFile.objects.bulk_create(entries, batch_size=500)
+
+
+def remove_product_entries(apps, schema_editor):
+    SpectrumFile = apps.get_model('custom_code', 'SpectrumFile')
+    keep = SpectrumFile.objects.values('path').annotate(first_id=models.Min('id')).values_list('first_id', flat=True)
+    SpectrumFile.objects.exclude(id__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0012_alter_reduceddatum_data_product_and_more"),
+        ("custom_code", "0018_spectrum_value_arrays"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="spectrumfile",
+            name="path",
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+        migrations.AddConstraint(
+            model_name="spectrumfile",
+            constraint=models.UniqueConstraint(
+                fields=("path", "data_product"), name="unique_spectrum_file_product"
+            ),
+        ),
+        migrations.RunPython(add_product_entries, remove_product_entries),
+    ]
@@ -2,7 +2,8 @@ from django.db import models
 from tom_targets.base_models import BaseTarget
 from django.contrib.auth.models import User
 from django.utils.timezone import now
-from collections import Counter
+import numpy as np
+from tidestom.tides_utils.sky_index import sky_cell
 
 class TidesClass(models.Model):
     name = models.CharField(max_length=50)
@@ -51,23 +52,34 @@ class TidesTarget(BaseTarget):
     auto_tidesclass_subclass = models.ForeignKey(TidesClassSubClass, on_delete=models.SET_NULL, blank=True, null=True, related_name='auto_subclass', verbose_name='Auto TiDES Sub-classification')
     auto_tidesclass_prob = models.FloatField(blank=True, null=True, verbose_name='Auto TiDES Classification Probability')
 
-    human_tidesclass = models.CharField(max_length=50, choices=TIDES_CLASS_CHOICES, verbose_name='Human TiDES Classification', blank=True, null=True)
+    human_tidesclass = models.CharField(max_length=50, choices=TIDES_CLASS_CHOICES, verbose_name='Human TiDES Classification', blank=True, null=True, db_index=True)
     human_tidesclass_other = models.CharField(max_length=100, blank=True, null=True, verbose_name='Human TiDES Classification (Other)')
     human_tidesclass_subclass = models.ForeignKey(TidesClassSubClass, on_delete=models.SET_NULL, blank=True, null=True, related_name='human_subclass', verbose_name='Human TiDES Sub-classification')
+    # Consensus of the HumanTidesClassSubmissions, maintained by update_human_consensus together with the human_tidesclass fields above
+    human_tidesclass_votes = models.JSONField(default=dict, blank=True, verbose_name='Human TiDES Classification Votes')
+    human_tidesclass_count = models.IntegerField(default=0, db_index=True, verbose_name='Number of Human TiDES Classifications')
+    human_tidesclass_agreement = models.FloatField(blank=True, null=True, db_index=True, verbose_name='Human TiDES Classification Agreement')
+    # Indexed sky cell of ra/dec for positional queries (see tidestom.tides_utils.sky_index), kept up to date by save()
+    # and by bulk_upsert_targets
+    sky_cell = models.BigIntegerField(blank=True, null=True, db_index=True, verbose_name='Sky Cell')
+
+    def save(self, *args, **kwargs):
+        self.sky_cell = sky_cell(self.ra, self.dec)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('ra' in update_fields or 'dec' in update_fields):
+            kwargs['update_fields'] = {*update_fields, 'sky_cell'}
+        super().save(*args, **kwargs)
     
     def aggregate_human_tidesclass(self):
-        submissions = self.human_classifications.all()
-        if not submissions:
+        # Materialized by update_human_consensus whenever a classification is submitted
+        if not self.human_tidesclass_count:
             return None
 
-        # Aggregate the most common classification
-        tidesclass_counts = Counter(sub.tidesclass for sub in submissions)
-        most_common_class, count = tidesclass_counts.most_common(1)[0]
-
         return {
-            'most_common_class': most_common_class,
-            'count': count,
-            'total_submissions': len(submissions),
+            'most_common_class': self.human_tidesclass,
+            'count': self.human_tidesclass_votes.get(self.human_tidesclass, 0),
+            'total_submissions': self.human_tidesclass_count,
+            'agreement': self.human_tidesclass_agreement,
         }
     
     class Meta:
@@ -88,3 +100,179 @@ class HumanTidesClassSubmission(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {self.target.name} - {self.tidesclass}"
+
+class SpectrumFile(models.Model):
+    """
+    Ingestion manifest entry for a spectrum file and a DataProduct made from it. A multi-target L1 file has one
+    entry per product. The size and modification time let a re-run skip unchanged files with a single stat, and the
+    content hash catches files re-delivered under a new path.
+    """
+    path = models.CharField(max_length=1024, db_index=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    sha256 = models.CharField(max_length=64, db_index=True)
+    data_product = models.ForeignKey('tom_dataproducts.DataProduct', on_delete=models.SET_NULL, blank=True, null=True, related_name='spectrum_files')
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['path', 'data_product'], name='unique_spectrum_file_product'),
+        ]
+
+    def __str__(self):
+        return self.path
+
+class IngestionCheckpoint(models.Model):
+    """
+    Progress through a pipeline results file, updated in the same transaction as each ingested chunk so that an
+    interrupted run can be resumed from the last committed row.
+    """
+    source = models.CharField(max_length=1024, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    row_offset = models.BigIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source} @ {self.row_offset}"
+
+class SpectrumData(models.Model):
+    """
+    Binary store for the arrays of a spectroscopic ReducedDatum, as little-endian float32. The datum's JSON value
+    keeps only the units, pixel count, a digest of the arrays and a decimated copy of them for TOM, so the database
+    holds 8 bytes per pixel instead of the JSON text. See ``tidestom.tides_utils.spectrum_store``.
+    """
+    DTYPE = np.dtype('<f4')
+
+    reduced_datum = models.OneToOneField('tom_dataproducts.ReducedDatum', on_delete=models.CASCADE, primary_key=True, related_name='spectrum_data')
+    wavelength = models.BinaryField()
+    flux = models.BinaryField()
+
+    @property
+    def wavelength_array(self):
+        """Read-only view of the stored bytes, no copy is made."""
+        return np.frombuffer(self.wavelength, dtype=self.DTYPE)
+
+    @property
+    def flux_array(self):
+        """Read-only view of the stored bytes, no copy is made."""
+        return np.frombuffer(self.flux, dtype=self.DTYPE)
+
+    def __str__(self):
+        return f"Spectrum data for datum {self.reduced_datum_id}"
+
+class SpectrumLevel(models.Model):
+    """
+    One level of the level-of-detail pyramid of a ``SpectrumData``: the pixels holding the minimum and maximum flux of
+    each of ``n_bins`` equal runs of pixels, in wavelength order. Narrow lines survive the decimation, and a plot
+    ``n_bins`` pixels wide looks the same as one drawn from every pixel.
+    """
+    spectrum = models.ForeignKey(SpectrumData, on_delete=models.CASCADE, related_name='levels')
+    n_bins = models.IntegerField()
+    wavelength = models.BinaryField()
+    flux = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['spectrum', 'n_bins'], name='unique_spectrum_level'),
+        ]
+
+    @property
+    def wavelength_array(self):
+        return np.frombuffer(self.wavelength, dtype=SpectrumData.DTYPE)
+
+    @property
+    def flux_array(self):
+        return np.frombuffer(self.flux, dtype=SpectrumData.DTYPE)
+
+    def __str__(self):
+        return f"{self.n_bins}-bin level of datum {self.spectrum_id}"
+
+class SpectralTemplate(models.Model):
+    """
+    Rest-frame template spectrum of the bank that spectra are cross-correlated against to estimate their redshift.
+    Templates are loaded from files with the ``load_spectral_templates`` command and labelled with the TiDES class of
+    the object they were taken from.
+    """
+    name = models.CharField(max_length=200, unique=True)
+    tidesclass = models.CharField(max_length=50, choices=TidesTarget.TIDES_CLASS_CHOICES, blank=True, null=True, verbose_name='TiDES Classification')
+    tidesclass_subclass = models.ForeignKey(TidesClassSubClass, on_delete=models.SET_NULL, blank=True, null=True, related_name='templates', verbose_name='TiDES Sub-classification')
+    wavelength = models.BinaryField()
+    flux = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def wavelength_array(self):
+        return np.frombuffer(self.wavelength, dtype=SpectrumData.DTYPE)
+
+    @property
+    def flux_array(self):
+        return np.frombuffer(self.flux, dtype=SpectrumData.DTYPE)
+
+    def __str__(self):
+        return self.name
+
+class RedshiftEstimate(models.Model):
+    """
+    Cross-correlation redshift of a spectroscopic ReducedDatum, written by the ``estimate_redshifts`` command. The
+    Tonry & Davis r value measures how far the correlation peak stands above the noise; estimates with a low r are
+    kept but not offered as a starting point.
+    """
+    reduced_datum = models.OneToOneField('tom_dataproducts.ReducedDatum', on_delete=models.CASCADE, primary_key=True, related_name='redshift_estimate')
+    redshift = models.FloatField()
+    redshift_err = models.FloatField()
+    r_value = models.FloatField(db_index=True)
+    template = models.ForeignKey(SpectralTemplate, on_delete=models.SET_NULL, blank=True, null=True, related_name='redshift_estimates')
+    estimated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"z = {self.redshift:.4f} for datum {self.reduced_datum_id}"
+
+class SpectrumThumbnail(models.Model):
+    """
+    Current version of a target's spectrum thumbnails. The version is a hash of the rendered image and is part of the
+    thumbnail file names, so browsers can cache them forever and a re-render with new content changes the URL.
+    """
+    WIDTHS = (320, 640, 1280)
+    ASPECT = 0.75  # height / width
+
+    target = models.OneToOneField(TidesTarget, on_delete=models.CASCADE, primary_key=True, related_name='spectrum_thumbnail')
+    version = models.CharField(max_length=16)
+    rendered = models.DateTimeField()
+
+    def filename(self, width):
+        return f"spectrum_{self.target_id}_{width}.{self.version}.webp"
+
+    def __str__(self):
+        return f"Thumbnail {self.version} for target {self.target_id}"
+
+class TargetSummary(models.Model):
+    """
+    Read model for list pages: one row per target holding everything a target card shows, so a page of cards is a
+    single indexed query. Kept up to date by ingestion, thumbnail rendering and classification submissions through
+    ``tidestom.tides_utils.summaries``; rebuild it with the ``rebuild_target_summaries`` command.
+    """
+    target = models.OneToOneField(TidesTarget, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    name = models.CharField(max_length=100)
+    created = models.DateTimeField()
+    n_spectra = models.IntegerField(default=0)
+    latest_spectrum = models.DateTimeField(blank=True, null=True)
+    thumbnail_version = models.CharField(max_length=16, blank=True, default='')
+    auto_tidesclass = models.CharField(max_length=50, blank=True, null=True)
+    auto_tidesclass_subclass = models.CharField(max_length=100, blank=True, null=True)
+    auto_tidesclass_prob = models.FloatField(blank=True, null=True)
+    human_tidesclass = models.CharField(max_length=50, blank=True, null=True)
+    n_human_submissions = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created', '-target'], name='targetsummary_created'),
+            models.Index(fields=['-created', '-target'], condition=models.Q(latest_spectrum__isnull=False),
+                         name='targetsummary_with_spectra'),
+        ]
+
+    def __str__(self):
+        return f"Summary of {self.name}"
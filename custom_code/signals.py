@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from tom_targets.models import TargetExtra, TargetName
+from custom_code.models import HumanTidesClassSubmission, TidesClass, TidesClassSubClass, TidesTarget
+from tidestom.tides_utils.cache_utils import invalidate_latest_targets, invalidate_targets
+from tidestom.tides_utils.summaries import refresh_target_summaries
+from tidestom.tides_utils.taxonomy import invalidate_taxonomy
+from tidestom.tides_utils.target_utils import update_human_consensus
+
+
+@receiver(post_save, sender=DataProduct)
+def data_product_saved(sender, instance, **kwargs):
+    """A data product was added or reprocessed: the detail page of its target, and for spectra the Latest view, are out of date."""
+    invalidate_targets([instance.target_id])
+    if instance.data_product_type == 'spectroscopy':
+        invalidate_latest_targets()
+
+
+@receiver(post_delete, sender=DataProduct)
+def data_product_deleted(sender, instance, **kwargs):
+    invalidate_targets([instance.target_id])
+    if instance.data_product_type == 'spectroscopy':
+        invalidate_latest_targets()
+        refresh_target_summaries([instance.target_id])
+
+
+@receiver(post_save, sender=ReducedDatum)
+@receiver(post_delete, sender=ReducedDatum)
+def reduced_datum_changed(sender, instance, **kwargs):
+    """Photometry and spectra saved one at a time, e.g. by data services; bulk ingestion invalidates itself."""
+    invalidate_targets([instance.target_id])
+
+
+@receiver(post_save, sender=TargetName)
+@receiver(post_delete, sender=TargetName)
+@receiver(post_save, sender=TargetExtra)
+@receiver(post_delete, sender=TargetExtra)
+def target_detail_changed(sender, instance, **kwargs):
+    invalidate_targets([instance.target_id])
+
+
+@receiver(post_save, sender=TidesTarget)
+def target_saved(sender, instance, **kwargs):
+    """Targets saved one at a time; the bulk paths refresh their summaries themselves."""
+    refresh_target_summaries([instance.id])
+
+
+@receiver(post_save, sender=HumanTidesClassSubmission)
+@receiver(post_delete, sender=HumanTidesClassSubmission)
+def human_classification_changed(sender, instance, **kwargs):
+    update_human_consensus([instance.target_id])
+    refresh_target_summaries([instance.target_id])
+
+
+@receiver(post_save, sender=TidesClass)
+@receiver(post_delete, sender=TidesClass)
+@receiver(post_save, sender=TidesClassSubClass)
+@receiver(post_delete, sender=TidesClassSubClass)
+def taxonomy_changed(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_taxonomy)
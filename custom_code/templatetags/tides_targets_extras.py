@@ -1,7 +1,12 @@
 from django import template
 from django.conf import settings
+from django.urls import reverse
+from custom_code.models import SpectrumThumbnail
+from tidestom.tides_utils.summaries import visible_summaries
 register = template.Library()
 
+THUMBNAIL_SIZES = '(min-width: 992px) 25vw, (min-width: 576px) 45vw, 90vw'
+
 @register.inclusion_tag('custom_code/partials/target_data.html')
 def tides_target_data(target):
     """
@@ -9,7 +14,6 @@ def tides_target_data(target):
     """
     exclude_fields = ['name', 'tidesclass', 'tidesclass_other', 'tidesclass_subclass', 'auto_tidesclass', 'auto_tidesclass_other', 'auto_tidesclass_subclass', 'auto_tidesclass_prob', 'human_tidesclass', 'human_tidesclass_other', 'human_tidesclass_subclass']
     extras = {k['name']: target.extra_fields.get(k['name'], '') for k in settings.EXTRA_FIELDS if not k.get('hidden') and k['name'] not in exclude_fields}
-    print(target.as_dict())
     return {
         'target': target,
         'extras': extras
@@ -28,3 +32,47 @@ def aladin_finderchart(target):
 
     return {'target': target}
 
+def thumbnail_context(target_id, name, version, sizes, width):
+    if not version:
+        return {'name': name, 'thumbnail': None}
+    thumbnail = SpectrumThumbnail(target_id=target_id, version=version)
+    urls = {w: reverse('thumbnail', args=[thumbnail.filename(w)]) for w in SpectrumThumbnail.WIDTHS}
+    return {
+        'name': name,
+        'thumbnail': thumbnail,
+        'src': urls.get(width, urls[max(urls)]),
+        'srcset': ', '.join(f'{url} {w}w' for w, url in urls.items()),
+        'sizes': sizes,
+        'width': width,
+        'height': round(width * SpectrumThumbnail.ASPECT),
+    }
+
+@register.inclusion_tag('custom_code/partials/spectrum_thumbnail.html')
+def spectrum_thumbnail(target, sizes=THUMBNAIL_SIZES, width=640):
+    """
+    Displays the spectrum thumbnail of a target as a lazily loaded, responsive image. The browser picks the smallest
+    WebP from ``srcset`` that fits ``sizes``; ``width`` is the fallback ``src``. Select the ``spectrum_thumbnail``
+    relation when listing many targets.
+    """
+    try:
+        version = target.spectrum_thumbnail.version
+    except SpectrumThumbnail.DoesNotExist:
+        version = None
+    return thumbnail_context(target.id, target.name, version, sizes, width)
+
+@register.inclusion_tag('custom_code/partials/spectrum_thumbnail.html')
+def summary_thumbnail(summary, sizes=THUMBNAIL_SIZES, width=640):
+    """``spectrum_thumbnail`` for a ``TargetSummary``, without any query."""
+    return thumbnail_context(summary.target_id, summary.name, summary.thumbnail_version, sizes, width)
+
+@register.inclusion_tag('custom_code/partials/summary_classifications.html')
+def summary_classifications(summary):
+    return {'summary': summary}
+
+@register.inclusion_tag('custom_code/partials/recent_target_summaries.html', takes_context=True)
+def recent_target_summaries(context, limit=10):
+    """
+    Displays the most recently created targets the user can view, like the TOM Toolkit's ``recent_targets`` but read
+    from the ``TargetSummary`` table.
+    """
+    return {'summaries': visible_summaries(context['request'].user).order_by('-created', '-target_id')[:limit]}
@@ -1,47 +1,84 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from plotly import offline
 import plotly.graph_objs as go
-from datetime import datetime, timedelta
 from django import template
-from django.conf import settings
+from django.urls import reverse
+from django.utils.html import format_html
 
-from tom_dataproducts.models import DataProduct, ReducedDatum
-from guardian.shortcuts import get_objects_for_user
-from tom_dataproducts.processors.data_serializers import SpectrumSerializer
+from tom_dataproducts.templatetags import dataproduct_extras
 from tom_targets.models import Target
+from tom_targets.templatetags import targets_extras
 
 register = template.Library()
 
+
+@register.simple_tag
+def plotly_js():
+    """
+    Script element loading plotly.js from its own versioned URL, which browsers cache indefinitely. Put it in pages
+    with plots, before the first one, and render their figures with ``include_plotlyjs=False``.
+    """
+    return format_html('<script src="{}"></script>', reverse('plotly_js', kwargs={'version': offline.get_plotlyjs_version()}))
+
+
+_without_plotlyjs = ContextVar('without_plotlyjs', default=False)
+
+
+class _PlotlyOffline:
+    """
+    Stands in for ``plotly.offline`` in TOM's tag modules. Within ``_unbundled_plots`` figures are rendered with
+    ``include_plotlyjs=False``; everywhere else it behaves as ``plotly.offline``.
+    """
+
+    def __getattr__(self, name):
+        return getattr(offline, name)
+
+    def plot(self, *args, **kwargs):
+        if _without_plotlyjs.get():
+            kwargs['include_plotlyjs'] = False
+        return offline.plot(*args, **kwargs)
+
+
+dataproduct_extras.offline = targets_extras.offline = _PlotlyOffline()
+
+
+@contextmanager
+def _unbundled_plots():
+    token = _without_plotlyjs.set(True)
+    try:
+        yield
+    finally:
+        _without_plotlyjs.reset(token)
+
+
+@register.inclusion_tag('tom_dataproducts/partials/photometry_for_target.html', takes_context=True)
+def target_photometry(context, target, *args, **kwargs):
+    """TOM's ``photometry_for_target`` without its own copy of plotly.js: pages with it load it with ``plotly_js``."""
+    with _unbundled_plots():
+        return dataproduct_extras.photometry_for_target(context, target, *args, **kwargs)
+
+
+@register.inclusion_tag('tom_targets/partials/moon_distance.html')
+def target_moon_distance(target, *args, **kwargs):
+    """TOM's ``moon_distance`` without its own copy of plotly.js."""
+    with _unbundled_plots():
+        return targets_extras.moon_distance(target, *args, **kwargs)
+
+
 @register.inclusion_tag('myplots/target_spectroscopy.html', takes_context=True)
 def target_spectroscopy(context, target, dataproduct=None):
     """
     Renders a spectroscopic plot for a ``Target``. If a ``DataProduct`` is specified, it will only render a plot with
-    that spectrum.
+    that spectrum. The page only carries the empty figure: the epochs are listed by the ``target_spectra`` endpoint
+    and each one's arrays are fetched from it when its trace is shown, so the HTML does not grow with the epochs.
     """
-    try:
-        spectroscopy_data_type = settings.DATA_PRODUCT_TYPES['spectroscopy'][0]
-    except (AttributeError, KeyError):
-        spectroscopy_data_type = 'spectroscopy'
-    spectral_dataproducts = DataProduct.objects.filter(target=target,
-                                                       data_product_type=spectroscopy_data_type)
+    spectra_url = reverse('target_spectra', kwargs={'target_id': target.id})
     if dataproduct:
-        spectral_dataproducts = DataProduct.objects.get(data_product=dataproduct)
-
-    plot_data = []
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(data_product__in=spectral_dataproducts)
-    else:
-        datums = get_objects_for_user(context['request'].user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(data_product__in=spectral_dataproducts))
-    for datum in datums:
-        deserialized = SpectrumSerializer().deserialize(datum.value)
-        plot_data.append(go.Scatter(
-            x=deserialized.wavelength.value,
-            y=deserialized.flux.value,
-            name=datetime.strftime(datum.timestamp, '%Y%m%d-%H:%M:%s')
-        ))
+        spectra_url += f'?data_product={dataproduct.id}'
+
     # Create a figure
-    fig = go.Figure(data=plot_data)
+    fig = go.Figure()
 
     fig.update_layout(autosize=True, 
                       xaxis_title='Observed Wavelength [Å] ',
@@ -52,7 +89,8 @@ def target_spectroscopy(context, target, dataproduct=None):
 
     return {
         'target': target,
-        'plot': offline.plot(fig, output_type='div', show_link=False)
+        'spectra_url': spectra_url,
+        'plot': offline.plot(fig, output_type='div', show_link=False, include_plotlyjs=False)
     }
 
 
@@ -60,7 +98,6 @@ def target_spectroscopy(context, target, dataproduct=None):
 
 
 
-
 ###### Below is an example from the TOM Documentation
 # @register.inclusion_tag('myplots/targets_reduceddata.html')
 # def targets_reduceddata(targets=Target.objects.all()):
@@ -1,15 +1,24 @@
 import os
+import time
 import logging
+import multiprocessing
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path  # Import pathlib
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from custom_code.models import TidesTarget as Target
-from custom_code.models import TidesClassSubClass
 from tom_dataproducts.models import DataProduct
-from tidestom.tides_utils.target_utils import generate_spectrum_plot, add_spectrum_to_database
+from custom_code.models import IngestionCheckpoint
+from tidestom.tides_utils.ingestion import IngestionContext, iter_pipeline_results, ARROW_FORMATS
+from tidestom.tides_utils.target_utils import (add_spectrum_to_database, add_l1_file_to_database, prepare_spectrum,
+                                               save_prepared_spectrum, spectrum_file_stat, spectrum_file_digest)
+from tidestom.tides_utils.workers import init_ingest_worker
 
 # Configure logging
 logging.basicConfig(
@@ -25,18 +34,34 @@ class Command(BaseCommand):
         parser.add_argument('--mock', action='store_true', help='Add spectra from mock database')
         parser.add_argument('--pipeline', action='store_true', help='Add spectra from pipeline results')
         parser.add_argument('--pipeline-results', type=str, help='Path to the pipeline results file')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes used to read, plot and serialize pipeline spectra')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of pipeline results per chunk; each chunk is committed atomically')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue a pipeline results file from its last committed chunk')
+        parser.add_argument('--watch', type=str, metavar='DIR',
+                            help='Keep polling a delivery directory and ingest new spectra and pipeline results')
+        parser.add_argument('--poll-interval', type=float, default=5, help='Seconds between polls with --watch')
+        parser.add_argument('--defer-plots', action='store_true',
+                            help='Do not plot spectra while ingesting; render them afterwards with create_thumbnails')
 
     def handle(self, *args, **kwargs):
-        if kwargs['mock']:
+        self.plot = not kwargs['defer_plots']
+        if kwargs['watch']:
+            self.watch_directory(kwargs['watch'], kwargs['poll_interval'], workers=kwargs['workers'],
+                                 chunk_size=kwargs['chunk_size'])
+        elif kwargs['mock']:
             self.add_spectra_from_mock_db()
         elif kwargs['pipeline']:
             pipeline_results_path = kwargs['pipeline_results']
             if not pipeline_results_path:
                 logging.error("Pipeline results path must be provided when using --pipeline option")
                 return
-            self.add_spectra_from_pipeline(pipeline_results_path)
+            self.add_spectra_from_pipeline(pipeline_results_path, workers=kwargs['workers'],
+                                           chunk_size=kwargs['chunk_size'], resume=kwargs['resume'])
         else:
-            logging.error("Either --mock or --pipeline option must be specified")
+            logging.error("Either --mock, --pipeline or --watch option must be specified")
 
     def add_spectra_from_mock_db(self):
         test_data_dir = Path(settings.BASE_DIR) / 'data/spectra/test'
@@ -48,16 +73,14 @@ class Command(BaseCommand):
             return
         
         dbdf = pd.read_csv(target_csv_path, index_col=0)
+        context = IngestionContext()
         targets = Target.objects.all()
         for target in targets:
             spectrum_file_path = os.path.join(settings.TEST_DIR,f'sims/l1_obs_joined_{target.name}.fits')
             if os.path.exists(spectrum_file_path):
-                # Check if the spectrum already exists in the database
-                spectrum_exists = DataProduct.objects.filter(target=target, data=spectrum_file_path).exists()
-                if not spectrum_exists:
-                    generate_spectrum_plot(target, spectrum_file_path)
-                    logging.info(f'Successfully updated plots for target {target.name}')
-                    result = add_spectrum_to_database(target, spectrum_file_path)
+                # Check the ingestion manifest for the spectrum; an unchanged file costs a single stat
+                if not context.spectrum_unchanged(spectrum_file_path, *spectrum_file_stat(spectrum_file_path)):
+                    result = add_spectrum_to_database(target, spectrum_file_path, plot=self.plot)
                     if 'Error' in result:
                         logging.error(result)
                     else:
@@ -70,75 +93,261 @@ class Command(BaseCommand):
                 int_name = int(target.name)
                 if int_name in dbdf.index:
                     logging.info(f'Found target {target.name} in the mock catalogue')
-                    auto_class = dbdf.at[int_name, 'AutoClass']
-                    auto_class_subclass = dbdf.at[int_name, 'AutoClass_SubClass']
-                    auto_class_prob = dbdf.at[int_name, 'AutoClassProb']
-
-                    if auto_class:
-                        target.auto_tidesclass = auto_class
-
-                        # Retrieve the TidesClassSubClass instance using the correct field
-                        auto_class_subclass_instance = TidesClassSubClass.objects.filter(sub_class=auto_class_subclass).first()
-
-                        if auto_class_subclass_instance:
-                            target.auto_tidesclass_subclass = auto_class_subclass_instance
-                        else:
-                            logging.warning(f"Subclass '{auto_class_subclass}' not found in TidesClassSubClass for target {target.name}")
-
-                        target.auto_tidesclass_prob = auto_class_prob
-                        target.save()
-                        logging.info(f'Updated auto classification for target {target.name}')
-                    else:
-                        logging.warning(f'No auto classification found for target {target.name}')
+                    context.set_auto_classification(target.id, target.name,
+                                                    dbdf.at[int_name, 'AutoClass'],
+                                                    dbdf.at[int_name, 'AutoClass_SubClass'],
+                                                    dbdf.at[int_name, 'AutoClassProb'])
             else:
                 logging.warning(f'Spectrum file {spectrum_file_path} not found for target {target.name}')
+        context.flush()
 
-    def add_spectra_from_pipeline(self, pipeline_results_path):
-        pipeline_results = pd.read_csv(pipeline_results_path)
+    def add_spectra_from_pipeline(self, pipeline_results_path, workers=1, chunk_size=1000, resume=False):
+        """
+        Streams the pipeline results (CSV, Parquet or Arrow) in chunks. Each chunk is ingested in one transaction
+        together with its checkpoint, so ``resume`` continues after the last chunk that was committed.
+        """
+        pipeline_results_path = os.path.abspath(pipeline_results_path)
+        stat = os.stat(pipeline_results_path)
+        checkpoint, _ = IngestionCheckpoint.objects.get_or_create(
+            source=pipeline_results_path, defaults={'size': stat.st_size, 'mtime': stat.st_mtime}
+        )
+        start_row = 0
+        if resume:
+            if (checkpoint.size, checkpoint.mtime) != (stat.st_size, stat.st_mtime):
+                logging.error(f'{pipeline_results_path} has changed since its checkpoint and cannot be resumed')
+                return
+            if checkpoint.completed:
+                logging.info(f'{pipeline_results_path} has already been ingested')
+                return
+            start_row = checkpoint.row_offset
+            logging.info(f'Resuming {pipeline_results_path} from row {start_row}')
+        checkpoint.size, checkpoint.mtime = stat.st_size, stat.st_mtime
+        checkpoint.row_offset, checkpoint.completed = start_row, False
+        checkpoint.save()
 
-        for _, row in pipeline_results.iterrows():
-            obj_name = row['obj_name']
-            spectrum_file_path = row['spectrum_file']
-            auto_class = row.get('auto_class_agg')
-            auto_class_subclass = row.get('auto_class_subclass_agg')
-            auto_class_prob = row.get('auto_class_prob_agg')
+        context = IngestionContext(batch_size=chunk_size)
+        with self.worker_pool(workers) as executor:
+            for first_row, chunk in iter_pipeline_results(pipeline_results_path, chunk_size, start_row):
+                with transaction.atomic():
+                    self.ingest_pipeline_chunk(chunk, context, executor)
+                    checkpoint.row_offset = first_row + len(chunk)
+                    checkpoint.save(update_fields=['row_offset', 'updated'])
+                logging.info(f'Committed rows {first_row} to {checkpoint.row_offset} of {pipeline_results_path}')
+        checkpoint.completed = True
+        checkpoint.save(update_fields=['completed', 'updated'])
 
-            target = Target.objects.filter(name=obj_name).first()
-            if not target:
+    def ingest_pipeline_chunk(self, chunk, context, executor=None):
+        """
+        Ingests one chunk of pipeline results. Rows are resolved against the preloaded ``context``, so the lookups
+        cost a fixed number of queries per chunk however many rows it holds. Files that the ingestion manifest shows
+        are unchanged are skipped after a stat; the rest are hashed, and only new or changed content is decoded.
+        """
+        candidates = {}
+        for obj_name, spectrum_file_path, auto_class, auto_class_subclass, auto_class_prob in zip(
+                chunk['obj_name'], chunk['spectrum_file'],
+                chunk.get('auto_class_agg', [None] * len(chunk)),
+                chunk.get('auto_class_subclass_agg', [None] * len(chunk)),
+                chunk.get('auto_class_prob_agg', [None] * len(chunk))):
+            target_id = context.resolve_target(obj_name)
+            if not target_id:
                 logging.warning(f'Target {obj_name} not found in the database')
                 continue
 
-            if not spectrum_file_path or not os.path.exists(spectrum_file_path):
+            if not isinstance(spectrum_file_path, str) or not os.path.exists(spectrum_file_path):
                 logging.warning(f'Spectrum file {spectrum_file_path} not found for target {obj_name}')
                 continue
 
-            # Check if the spectrum already exists in the database
-            spectrum_exists = DataProduct.objects.filter(target=target, data=spectrum_file_path).exists()
-            if not spectrum_exists:
-                generate_spectrum_plot(target, spectrum_file_path)
-                logging.info(f'Successfully updated plots for target {target.name}')
-                result = add_spectrum_to_database(target, spectrum_file_path)
-                if 'Error' in result:
-                    logging.error(result)
-                else:
-                    logging.info(result)
+            # Check the ingestion manifest for the spectrum
+            size, mtime = spectrum_file_stat(spectrum_file_path)
+            if not context.spectrum_unchanged(spectrum_file_path, size, mtime):
+                candidates[spectrum_file_path] = (target_id, size, mtime)
             else:
-                logging.warning(f'Spectrum for target {target.name} already exists in the database')
+                logging.warning(f'Spectrum for target {obj_name} already exists in the database')
 
             # Add or update automatic classification
-            if auto_class:
-                target.auto_tidesclass = auto_class
+            context.set_auto_classification(target_id, obj_name, auto_class, auto_class_subclass, auto_class_prob)
+        context.flush()
 
-                # Retrieve the TidesClassSubClass instance using the correct field
-                auto_class_subclass_instance = TidesClassSubClass.objects.filter(sub_class=auto_class_subclass).first()
+        new_spectra = []
+        digests = {}
+        chunk_digests = set()
+        repeated = []
+        for (spectrum_file_path,), sha256 in self.run_in_pool(executor, spectrum_file_digest,
+                                                             [(path,) for path in candidates]):
+            target_id, size, mtime = candidates[spectrum_file_path]
+            if isinstance(sha256, Exception):
+                logging.error(f'Error reading spectrum file {spectrum_file_path}: {sha256}')
+                continue
+            action, data_product_ids = context.classify_spectrum(spectrum_file_path, sha256)
+            if action in ('unchanged', 'duplicate'):
+                context.record_spectrum_file(spectrum_file_path, size, mtime, sha256, data_product_ids)
+                logging.warning(f'Spectrum file {spectrum_file_path} is already in the database')
+            elif sha256 in chunk_digests:
+                repeated.append((spectrum_file_path, sha256))  # same content twice in this chunk
+            else:
+                chunk_digests.add(sha256)
+                digests[spectrum_file_path] = sha256
+                new_spectra.append((target_id, spectrum_file_path, data_product_ids))
 
-                if auto_class_subclass_instance:
-                    target.auto_tidesclass_subclass = auto_class_subclass_instance
-                else:
-                    logging.warning(f"Subclass '{auto_class_subclass}' not found in TidesClassSubClass for target {target.name}")
+        targets = Target.objects.in_bulk([target_id for target_id, _, _ in new_spectra])
+        data_products = DataProduct.objects.in_bulk([dp_id for _, _, dp_ids in new_spectra for dp_id in dp_ids])
+        # The FITS reads, plots and serialization run in the workers; this process is the only database writer
+        tasks = [(target_id, spectrum_file_path, self.plot) for target_id, spectrum_file_path, _ in new_spectra]
+        # A file that changed in place is reprocessed into the product it made for its target
+        existing = {spectrum_file_path: next((data_products[dp_id] for dp_id in dp_ids if dp_id in data_products
+                                              and data_products[dp_id].target_id == target_id), None)
+                    for target_id, spectrum_file_path, dp_ids in new_spectra}
+        for (target_id, spectrum_file_path, _), prepared in self.run_in_pool(executor, prepare_spectrum, tasks):
+            target = targets[target_id]
+            if isinstance(prepared, Exception):
+                logging.error(f'Error adding spectrum for {target.name}: {prepared}')
+                continue
+            _, size, mtime = candidates[spectrum_file_path]
+            with transaction.atomic():
+                data_product = save_prepared_spectrum(target, prepared, data_product=existing[spectrum_file_path])
+                context.record_spectrum_file(spectrum_file_path, size, mtime, digests[spectrum_file_path],
+                                             [data_product.id])
+            context.add_spectrum(data_product)
+            logging.info(f'Added spectrum for {target.name} to the database')
 
-                target.auto_tidesclass_prob = auto_class_prob
-                target.save()
-                logging.info(f'Updated auto classification for target {target.name}')
+        # Repeats point at the product made from the first file with their content, like a 'duplicate'
+        for spectrum_file_path, sha256 in repeated:
+            data_product_ids = context.products_by_digest.get(sha256)
+            if not data_product_ids:
+                logging.error(f'Spectrum file {spectrum_file_path} was not added, as its content could not be')
+                continue
+            _, size, mtime = candidates[spectrum_file_path]
+            context.record_spectrum_file(spectrum_file_path, size, mtime, sha256, data_product_ids)
+            logging.warning(f'Spectrum file {spectrum_file_path} is already in the database')
+
+    def watch_directory(self, directory, poll_interval, workers=1, chunk_size=1000):
+        """
+        Polls ``directory`` and ingests files as they are delivered. A file is picked up once its size and mtime
+        are the same in two polls in a row, so partially written files are left alone. Pipeline results files are
+        ingested first, through the resumable ``add_spectra_from_pipeline`` path; FITS files are then added in
+        batches of ``chunk_size`` with ``ingest_delivered_spectra``. A FITS file whose target is not known is
+        remembered by its size and mtime, and only tried again once the file changes.
+        """
+        logging.info(f'Watching {directory} for new spectra and pipeline results')
+        ingested = {}
+        unresolved = {}
+        last_seen = {}
+        while True:
+            ready = []
+            current = {}
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if not filename.endswith(('.fits', '.fits.gz', '.csv')) and \
+                            Path(filename).suffix.lower() not in ARROW_FORMATS:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    current[path] = (stat.st_size, stat.st_mtime)
+                    if current[path] not in (ingested.get(path), unresolved.get(path)) and \
+                            last_seen.get(path) == current[path]:
+                        ready.append(path)
+            last_seen = current
+
+            results_files = [path for path in ready if not path.endswith(('.fits', '.fits.gz'))]
+            spectrum_files = [path for path in ready if path.endswith(('.fits', '.fits.gz'))]
+            for path in results_files:
+                self.ingest_delivered_results(path, workers, chunk_size)
+                ingested[path] = current[path]
+            for start in range(0, len(spectrum_files), chunk_size):
+                batch = spectrum_files[start:start + chunk_size]
+                processed = set(self.ingest_delivered_spectra(batch, directory))
+                for path in batch:
+                    (ingested if path in processed else unresolved)[path] = current[path]
+            if ready:
+                logging.info(f'Ingested {len(results_files)} results files and {len(spectrum_files)} spectra '
+                             f'from {directory}')
+            time.sleep(poll_interval)
+
+    def ingest_delivered_results(self, pipeline_results_path, workers, chunk_size):
+        # An interrupted file is resumed; a new or rewritten one is ingested from the start
+        checkpoint = IngestionCheckpoint.objects.filter(source=os.path.abspath(pipeline_results_path)).first()
+        stat = os.stat(pipeline_results_path)
+        resume = checkpoint is not None and (checkpoint.size, checkpoint.mtime) == (stat.st_size, stat.st_mtime)
+        try:
+            self.add_spectra_from_pipeline(pipeline_results_path, workers=workers, chunk_size=chunk_size,
+                                           resume=resume)
+        except Exception as e:
+            logging.error(f'Error ingesting pipeline results {pipeline_results_path}: {e}')
+
+    def ingest_delivered_spectra(self, spectrum_files, directory):
+        """
+        ``l1_obs_joined_<name>.fits`` files hold one target each. Any other FITS file is treated as a multi-row L1
+        file, whose rows may belong to many targets, and is added with one read by ``add_l1_file_to_database``.
+        Links to the files keep their directory relative to the delivery ``directory``.
+
+        :returns: the files that were processed, which leaves out those whose target was not found
+        """
+        processed = []
+        for spectrum_file_path in spectrum_files:
+            filename = os.path.basename(spectrum_file_path)
+            if filename.startswith('l1_obs_joined_'):
+                target = self.find_target(filename[len('l1_obs_joined_'):].split('.fits')[0])
+                if not target:
+                    logging.warning(f'No target found for spectrum file {spectrum_file_path}; it will be tried again '
+                                    f'when the file changes')
+                    continue
+                result = add_spectrum_to_database(target, spectrum_file_path, plot=self.plot, source_dir=directory)
             else:
-                logging.warning(f'No auto classification found for target {target.name}')
\ No newline at end of file
+                result = add_l1_file_to_database(spectrum_file_path, self.find_target, plot=self.plot,
+                                                 source_dir=directory)
+            if 'Error' in result:
+                logging.error(result)
+            else:
+                logging.info(result)
+            processed.append(spectrum_file_path)
+        return processed
+
+    def find_target(self, name):
+        """The target with this name or alias, or None."""
+        return Target.objects.filter(Q(name=name) | Q(aliases__name=name)).first()
+
+    def worker_pool(self, workers):
+        """
+        A process pool for ``run_in_pool``, or a null context when running serially. The pool starts its workers
+        lazily, at the first task, when this process already holds a database connection, so they are spawned rather
+        than forked and cannot inherit it.
+        """
+        if workers <= 1:
+            return nullcontext()
+        self.max_in_flight = workers * 4
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_ingest_worker)
+
+    def run_in_pool(self, executor, func, tasks):
+        """
+        Yields ``(task, result)`` for each argument tuple in ``tasks``, where ``result`` is ``func(*task)`` or the
+        exception it raised. Without an executor the tasks run in this process; with one, a bounded number are in
+        flight at a time so memory does not grow with the size of the batch, and results arrive as they complete.
+        """
+        if executor is None:
+            for task in tasks:
+                try:
+                    yield task, func(*task)
+                except Exception as e:
+                    yield task, e
+            return
+
+        pending = iter(tasks)
+        in_flight = {}
+        while True:
+            for task in pending:
+                in_flight[executor.submit(func, *task)] = task
+                if len(in_flight) >= self.max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                try:
+                    yield task, future.result()
+                except Exception as e:
+                    yield task, e
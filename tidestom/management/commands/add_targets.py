@@ -1,8 +1,9 @@
 import os
+import time
 import pandas as pd
 from django.core.management.base import BaseCommand
-from tom_targets.models import Target
-from tidestom.tides_utils.target_utils import create_target
+from tom_targets.models import Target, TargetName
+from tidestom.tides_utils.target_utils import create_target, bulk_upsert_targets
 from django.conf import settings
 ### TODO: WRITE CORRECT DIRECTORY IN HER, USING AN ENVIRONMENT VARIABLE
 
@@ -11,6 +12,11 @@ class Command(BaseCommand):
     # Placeholder code that currently looks at a set of simulated spectra from Georgios.
     help = 'Add new targets from a distant directory'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk', action='store_true',
+                            help='Create and update targets in batches and print a summary instead of one line per target')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of targets per batch with --bulk')
+
     def handle(self, *args, **kwargs):
         #directory = os.environ['TARGET_DB']
         target_csv_path = os.path.join(settings.TEST_DIR, "mock_DB.csv")
@@ -19,6 +25,9 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f"Target CSV file not found at {target_csv_path}"))
             return
         dbdf = pd.read_csv(target_csv_path, index_col=0)   
+        if kwargs['bulk']:
+            self.add_targets_in_bulk(dbdf, kwargs['batch_size'])
+            return
         for index, row in dbdf.iterrows(): 
             name=index
             if row['OBS_STATUS_4MOST']:  # Check if the target has been observed by 4MOST
@@ -31,6 +40,13 @@ class Command(BaseCommand):
                     # Add other fields as needed
                 }
 
+                # A target known under another name, or at the same position, gets this name as an alias
+                match = Target.matches.match_target(Target(name=name, **other_fields)).exclude(name=name).first()
+                if match is not None and not Target.objects.filter(name=name).exists():
+                    TargetName.objects.get_or_create(name=name, defaults={'target': match})
+                    self.stdout.write(self.style.SUCCESS(f'Target {name} matches {match.name}, added as an alias'))
+                    continue
+
                 # Check if the target already exists
                 target, created = Target.objects.update_or_create(
                     name=name,
@@ -42,4 +58,25 @@ class Command(BaseCommand):
                 else:
                     self.stdout.write(self.style.SUCCESS(f'Successfully updated target {name}'))
             else:
-                self.stdout.write(self.style.WARNING(f'Target {name} has not been observed by 4MOST and will not be added'))
\ No newline at end of file
+                self.stdout.write(self.style.WARNING(f'Target {name} has not been observed by 4MOST and will not be added'))
+
+    def add_targets_in_bulk(self, dbdf, batch_size):
+        start = time.monotonic()
+        # Only targets that have been observed by 4MOST are added
+        observed = dbdf[dbdf['OBS_STATUS_4MOST'].fillna(False).astype(bool)]
+        target_fields = {
+            str(name): {'ra': ra, 'dec': dec, 'created': created, 'type': 'SIDEREAL'}
+            for name, ra, dec, created in zip(observed.index, observed['ra'], observed['dec'], observed['MJD_DET'])
+        }
+        n_created, n_updated, n_matched = bulk_upsert_targets(target_fields, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f'Added {n_created} and updated {n_updated} targets in {time.monotonic() - start:.1f}s'
+        ))
+        if n_matched:
+            self.stdout.write(self.style.SUCCESS(
+                f'{n_matched} targets matched an existing target by name or position and were added as aliases'
+            ))
+        if len(dbdf) > len(observed):
+            self.stdout.write(self.style.WARNING(
+                f'{len(dbdf) - len(observed)} targets have not been observed by 4MOST and were not added'
+            ))
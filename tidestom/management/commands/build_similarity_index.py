@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from tidestom.tides_utils.redshift import MIN_R_VALUE
+from tidestom.tides_utils.similarity import (FIT_SAMPLE, N_COMPONENTS, fit_index, index_spectra, open_index,
+                                             reliable_estimates)
+
+
+class Command(BaseCommand):
+    help = ('Add the spectra with a reliable redshift estimate to the spectral similarity index, fitting a new index '
+            'first if there is none or with --rebuild')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Fit a new index to the current archive and replace the existing one once it is full')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of spectra read at a time')
+        parser.add_argument('--min-r', type=float, default=MIN_R_VALUE,
+                            help='Lowest Tonry & Davis r of a redshift estimate used to move a spectrum to rest frame')
+        parser.add_argument('--components', type=int, default=N_COMPONENTS, help='Length of the feature vectors')
+        parser.add_argument('--lists', type=int,
+                            help='Number of inverted file lists; by default about the square root of the sample size')
+        parser.add_argument('--sample-size', type=int, default=FIT_SAMPLE,
+                            help='Number of spectra the components and lists are fitted to')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        estimates = reliable_estimates(kwargs['min_r'])
+        index = None if kwargs['rebuild'] else open_index()
+        rebuilt = index is None
+        if rebuilt:
+            try:
+                index = fit_index(estimates, sample_size=kwargs['sample_size'], batch_size=kwargs['batch_size'],
+                                  n_components=kwargs['components'], n_lists=kwargs['lists'])
+            except ValueError as error:
+                raise CommandError(str(error))
+            self.stdout.write(f'Fitted {index.dimensions} components and {len(index.centroids)} lists '
+                              f'in {time.monotonic() - start:.1f}s')
+
+        try:
+            n_added = index_spectra(index, estimates, kwargs['batch_size'],
+                                    progress=lambda n: self.stdout.write(f'Indexed {n} spectra'))
+        except BaseException:
+            if rebuilt:
+                index.discard()
+            raise
+        if rebuilt:
+            index.publish()
+        index.refresh()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Added or updated {n_added} spectra in the similarity index, which holds {len(index)}, '
+            f'in {time.monotonic() - start:.1f}s'
+        ))
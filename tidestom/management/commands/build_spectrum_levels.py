@@ -0,0 +1,41 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from custom_code.models import SpectrumData, SpectrumLevel
+from tidestom.tides_utils.spectrum_store import spectrum_levels
+
+
+class Command(BaseCommand):
+    help = 'Precompute the level-of-detail pyramids of stored spectra that do not have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of spectra processed per transaction')
+        parser.add_argument('--force', action='store_true', help='Rebuild the levels of every spectrum')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        spectra = SpectrumData.objects.order_by('reduced_datum_id')
+        if not kwargs['force']:
+            spectra = spectra.filter(levels__isnull=True)
+        n_spectra = 0
+        n_levels = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, so each batch is an indexed range scan however many spectra have been done
+            batch = list(spectra.filter(reduced_datum_id__gt=last_id)[:kwargs['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].reduced_datum_id
+            levels = [level for spectrum_data in batch
+                      for level in spectrum_levels(spectrum_data.reduced_datum_id, spectrum_data.wavelength,
+                                                   spectrum_data.flux)]
+            with transaction.atomic():
+                SpectrumLevel.objects.filter(spectrum__in=batch).delete()
+                SpectrumLevel.objects.bulk_create(levels)
+            n_spectra += len(batch)
+            n_levels += len(levels)
+            self.stdout.write(f'Processed {n_spectra} spectra')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Built {n_levels} levels of detail for {n_spectra} spectra in {time.monotonic() - start:.1f}s'
+        ))
@@ -0,0 +1,64 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import RedshiftEstimate, SpectralTemplate
+from tidestom.tides_utils.classifier import ClassTemplates, classify
+from tidestom.tides_utils.redshift import MIN_R_VALUE
+from tidestom.tides_utils.spectrum_store import load_spectra
+from tidestom.tides_utils.target_utils import set_auto_classifications
+
+
+class Command(BaseCommand):
+    help = ('Set the automatic classification of targets by fitting the labelled spectral templates to their '
+            'spectrum with the most reliable redshift estimate (see estimate_redshifts)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of targets classified per transaction')
+        parser.add_argument('--min-r', type=float, default=MIN_R_VALUE,
+                            help='Lowest Tonry & Davis r of a redshift estimate used for classification')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        templates = list(SpectralTemplate.objects.filter(tidesclass__isnull=False).order_by('id'))
+        if not templates:
+            raise CommandError('There are no labelled spectral templates; load them with load_spectral_templates')
+        bank = ClassTemplates([template.wavelength_array for template in templates],
+                              [template.flux_array for template in templates],
+                              [template.tidesclass for template in templates],
+                              [template.tidesclass_subclass_id for template in templates])
+
+        # One spectrum per target: the one whose redshift is the most reliable
+        chosen = {}
+        for datum_id, target_id, redshift in RedshiftEstimate.objects.filter(
+                r_value__gte=kwargs['min_r'], reduced_datum__data_type='spectroscopy').order_by(
+                'reduced_datum__target_id', '-r_value').values_list(
+                'reduced_datum_id', 'reduced_datum__target_id', 'redshift').iterator():
+            chosen.setdefault(target_id, (datum_id, redshift))
+        target_ids = list(chosen)
+        redshifts = dict(chosen.values())
+
+        n_classified = 0
+        batch_size = kwargs['batch_size']
+        for i in range(0, len(target_ids), batch_size):
+            batch = target_ids[i:i + batch_size]
+            datums = ReducedDatum.objects.filter(id__in=[chosen[target_id][0] for target_id in batch]).only(
+                'id', 'target_id', 'value')
+            spectra = load_spectra(datums)
+            results = classify(bank, [wavelength for _, wavelength, _ in spectra], [flux for _, _, flux in spectra],
+                               [redshifts[datum.id] for datum, _, _ in spectra])
+            classified = {datum.target_id: {
+                'auto_tidesclass': bank.classes[tidesclass],
+                'auto_tidesclass_subclass': bank.subclasses[subclass] if subclass >= 0 else None,
+                'auto_tidesclass_prob': float(probability),
+            } for (datum, _, _), tidesclass, subclass, probability in zip(
+                spectra, results.tidesclass, results.subclass, results.probability) if tidesclass >= 0}
+            with transaction.atomic():
+                set_auto_classifications(classified)
+            n_classified += len(classified)
+            self.stdout.write(f'Classified {n_classified} of {min(i + batch_size, len(target_ids))} targets')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Classified {n_classified} of {len(target_ids)} targets with a redshift estimate against '
+            f'{len(bank)} templates in {time.monotonic() - start:.1f}s'
+        ))
@@ -0,0 +1,48 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from tidestom.tides_utils.spectrum_store import is_binary_value, pack_spectrum, save_spectrum_arrays
+
+
+class Command(BaseCommand):
+    help = 'Move the arrays of spectroscopic ReducedDatums stored as JSON lists into the float32 SpectrumData store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of datums converted per transaction')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        datums = ReducedDatum.objects.filter(data_type='spectroscopy', spectrum_data__isnull=True).order_by('id')
+        converted = 0
+        json_bytes = 0
+        binary_bytes = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, so each batch is an indexed range scan however many rows have been converted
+            batch = list(datums.filter(id__gt=last_id)[:kwargs['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            to_update = []
+            arrays = []
+            for datum in batch:
+                if not isinstance(datum.value, dict) or 'flux' not in datum.value or is_binary_value(datum.value):
+                    continue
+                json_bytes += len(str(datum.value))
+                datum.value, (wavelength, flux) = pack_spectrum(datum.value)
+                binary_bytes += len(wavelength) + len(flux)
+                to_update.append(datum)
+                arrays.append((wavelength, flux))
+            with transaction.atomic():
+                ReducedDatum.objects.bulk_update(to_update, ['value'])
+                save_spectrum_arrays(to_update, arrays)
+            converted += len(to_update)
+            self.stdout.write(f'Converted {converted} datums')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Converted {converted} spectra from about {json_bytes / 1e6:.1f} MB of JSON to '
+            f'{binary_bytes / 1e6:.1f} MB of float32 in {time.monotonic() - start:.1f}s'
+        ))
+        if converted:
+            self.stdout.write('Run VACUUM (SQLite) or VACUUM FULL (PostgreSQL) to return the freed space to the disk')
@@ -0,0 +1,43 @@
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from tidestom.tides_utils.thumbnails import (render_target_thumbnail, record_thumbnails,
+                                             stale_thumbnail_targets)
+from tidestom.tides_utils.workers import init_ingest_worker
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Render the spectrum thumbnails of all targets whose thumbnails are missing or older than their spectra'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes rendering thumbnails')
+        parser.add_argument('--force', action='store_true', help='Re-render every thumbnail, even if up to date')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        target_ids = stale_thumbnail_targets(force=kwargs['force'])
+        if not target_ids:
+            self.stdout.write(self.style.SUCCESS('All thumbnails are up to date'))
+            return
+
+        if kwargs['workers'] <= 1:
+            versions = dict(zip(target_ids, map(render_target_thumbnail, target_ids)))
+        else:
+            # Spawned workers open their own database connections rather than inheriting this process's
+            with ProcessPoolExecutor(max_workers=kwargs['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_ingest_worker) as executor:
+                versions = dict(zip(target_ids, executor.map(render_target_thumbnail, target_ids, chunksize=16)))
+        # The workers only render; the versions are written here, in the single database writer
+        versions = {target_id: version for target_id, version in versions.items() if version}
+        record_thumbnails(versions)
+        rendered = len(versions)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {rendered} of {len(target_ids)} stale thumbnails in {time.monotonic() - start:.1f}s'
+        ))
@@ -0,0 +1,43 @@
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tidestom.tides_utils.crossmatch import iter_csv, match_catalogue, read_catalogue, target_positions
+
+
+class Command(BaseCommand):
+    help = 'Crossmatch a CSV or Parquet catalogue against the positions of all targets and write the matches as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('catalogue', help='Path of the CSV or Parquet catalogue')
+        parser.add_argument('--radius', type=float, default=settings.TARGET_MATCH_RADIUS, help='Match radius in arcsec')
+        parser.add_argument('--all', action='store_true',
+                            help='Return every target within the radius instead of the nearest one')
+        parser.add_argument('--ra-column', help='RA column, in degrees (found by name if not given)')
+        parser.add_argument('--dec-column', help='Dec column, in degrees (found by name if not given)')
+        parser.add_argument('--id-column', help='Column identifying catalogue rows (the first other column by default)')
+        parser.add_argument('--format', choices=['csv', 'parquet'], help='Catalogue format (from the file name by default)')
+        parser.add_argument('--output', help='File to write the matches to (standard output by default)')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            catalogue = read_catalogue(kwargs['catalogue'], kwargs['ra_column'], kwargs['dec_column'],
+                                       kwargs['id_column'], kwargs['format'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {kwargs['catalogue']}: {e}")
+        targets = target_positions()
+        matches = match_catalogue(catalogue, targets, kwargs['radius'], nearest=not kwargs['all'])
+
+        output = open(kwargs['output'], 'w', newline='') if kwargs['output'] else sys.stdout
+        try:
+            for chunk in iter_csv(matches):
+                output.write(chunk)
+        finally:
+            if kwargs['output']:
+                output.close()
+        # The summary goes to stderr so that standard output holds only the CSV
+        self.stderr.write(self.style.SUCCESS(
+            f'Found {len(matches)} matches between {len(catalogue)} catalogue rows and {len(targets)} targets '
+            f'in {time.monotonic() - start:.1f}s'
+        ))
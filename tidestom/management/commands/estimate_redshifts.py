@@ -0,0 +1,130 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, time as day_time, timedelta, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import RedshiftEstimate, SpectralTemplate
+from tidestom.tides_utils.redshift import TemplateBank, Z_MAX, Z_MIN, estimate_batch, init_redshift_worker
+from tidestom.tides_utils.similarity import index_spectra, open_index, reliable_estimates
+from tidestom.tides_utils.spectrum_store import load_spectra
+
+
+class Command(BaseCommand):
+    help = 'Estimate the redshift of spectra by cross-correlation with the spectral template bank'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--night', type=datetime.fromisoformat, metavar='YYYY-MM-DD',
+                            help='Only the spectra of the night starting on this date (noon to noon UTC)')
+        parser.add_argument('--since', type=datetime.fromisoformat, metavar='YYYY-MM-DD',
+                            help='Only the spectra taken since this date (UTC)')
+        parser.add_argument('--force', action='store_true', help='Estimate again the spectra that have an estimate')
+        parser.add_argument('--batch-size', type=int, default=200, help='Number of spectra per task')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+        parser.add_argument('--z-min', type=float, default=Z_MIN, help='Lowest redshift searched')
+        parser.add_argument('--z-max', type=float, default=Z_MAX, help='Highest redshift searched')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        templates = list(SpectralTemplate.objects.order_by('id'))
+        if not templates:
+            raise CommandError('There are no spectral templates; load them with load_spectral_templates')
+        bank = TemplateBank([template.wavelength_array for template in templates],
+                            [template.flux_array for template in templates])
+        template_ids = [template.id for template in templates]
+
+        datums = ReducedDatum.objects.filter(data_type='spectroscopy').order_by('id')
+        if kwargs['night']:
+            noon = datetime.combine(kwargs['night'].date(), day_time(12), tzinfo=timezone.utc)
+            datums = datums.filter(timestamp__gte=noon, timestamp__lt=noon + timedelta(days=1))
+        if kwargs['since']:
+            datums = datums.filter(timestamp__gte=kwargs['since'].replace(tzinfo=kwargs['since'].tzinfo or timezone.utc))
+        if not kwargs['force']:
+            datums = datums.filter(redshift_estimate__isnull=True)
+
+        n_spectra = n_estimated = 0
+        workers = max(1, kwargs['workers'])
+        with self.worker_pool(workers, bank) as executor:
+            for datum_ids, results in self.run_batches(executor, 2 * workers, datums.only('id', 'value'),
+                                                       kwargs['batch_size'], kwargs['z_min'], kwargs['z_max']):
+                estimates = [
+                    RedshiftEstimate(reduced_datum_id=datum_id, redshift=redshift, redshift_err=redshift_err,
+                                     r_value=r_value, template_id=template_ids[template])
+                    for datum_id, redshift, redshift_err, r_value, template in zip(datum_ids, *results)
+                    if template >= 0
+                ]
+                # The only database writer is this process
+                with transaction.atomic():
+                    RedshiftEstimate.objects.filter(reduced_datum_id__in=datum_ids).exclude(
+                        reduced_datum_id__in=[estimate.reduced_datum_id for estimate in estimates]).delete()
+                    RedshiftEstimate.objects.bulk_create(
+                        estimates, update_conflicts=True, unique_fields=['reduced_datum'],
+                        update_fields=['redshift', 'redshift_err', 'r_value', 'template', 'estimated'])
+                n_spectra += len(datum_ids)
+                n_estimated += len(estimates)
+                self.stdout.write(f'Processed {n_spectra} spectra')
+
+        # Spectra with a reliable redshift can now be found by similarity search
+        index = open_index()
+        n_indexed = index_spectra(index, reliable_estimates()) if index is not None else 0
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Estimated the redshift of {n_estimated} of {n_spectra} spectra against {len(bank)} templates '
+            f'and added {n_indexed} spectra to the similarity index in {time.monotonic() - start:.1f}s'
+        ))
+
+    def worker_pool(self, workers, bank):
+        """A process pool whose workers hold the template bank, or a serial stand-in for a single worker."""
+        if workers <= 1:
+            init_redshift_worker(bank)
+            return SerialExecutor()
+        # The workers need neither Django nor the database, so they are spawned rather than forked: they cannot
+        # inherit the connections this process opens while they run
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_redshift_worker, initargs=(bank,))
+
+    def run_batches(self, executor, max_in_flight, datums, batch_size, z_min, z_max):
+        """
+        Yields ``(datum ids, RedshiftResults)`` per batch of spectra. Batches are read with keyset pagination as
+        workers become free, so no more than ``max_in_flight`` batches are held in memory at a time.
+        """
+        def batches():
+            last_id = 0
+            while True:
+                batch = list(datums.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    return
+                last_id = batch[-1].id
+                spectra = load_spectra(batch)
+                yield ([datum.id for datum, _, _ in spectra], [wavelength for _, wavelength, _ in spectra],
+                       [flux for _, _, flux in spectra])
+
+        pending = batches()
+        in_flight = {}
+        while True:
+            for datum_ids, wavelengths, fluxes in pending:
+                in_flight[executor.submit(estimate_batch, wavelengths, fluxes, z_min, z_max)] = datum_ids
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+
+
+class SerialExecutor:
+    """Runs submitted calls at once in this process, with the interface ``run_batches`` uses from an executor."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
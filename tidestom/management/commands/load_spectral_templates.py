@@ -0,0 +1,59 @@
+import time
+from pathlib import Path
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from custom_code.models import SpectralTemplate, SpectrumData
+from tidestom.tides_utils.spectrum_io import read_spectrum
+from tidestom.tides_utils.taxonomy import get_taxonomy
+
+FITS_SUFFIXES = ('.fits', '.fit', '.fits.gz')
+ASCII_SUFFIXES = ('.dat', '.txt', '.ascii', '.csv', '.flm')
+
+
+class Command(BaseCommand):
+    help = ('Load rest-frame template spectra for redshift estimation from a directory. Files in a sub-directory '
+            'named after a TiDES class or sub-class are labelled with it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory of FITS binary tables (WAVE, FLUX) or two-column ASCII files')
+        parser.add_argument('--replace', action='store_true', help='Delete the templates that are not in the directory')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        directory = Path(kwargs['directory'])
+        if not directory.is_dir():
+            raise CommandError(f'{directory} is not a directory')
+        taxonomy = get_taxonomy()
+        templates = []
+        for path in sorted(directory.rglob('*')):
+            name = path.name.lower()
+            if not path.is_file() or not name.endswith(FITS_SUFFIXES + ASCII_SUFFIXES):
+                continue
+            try:
+                if name.endswith(FITS_SUFFIXES):
+                    spectrum = read_spectrum(path)
+                    wavelength, flux = spectrum.wave[0], spectrum.flux[0]
+                else:
+                    wavelength, flux = np.loadtxt(path, usecols=(0, 1), delimiter=',' if name.endswith('.csv') else None,
+                                                  comments='#', unpack=True)
+            except (OSError, ValueError) as e:
+                self.stderr.write(self.style.WARNING(f'Skipped {path}: {e}'))
+                continue
+            label = path.parent.name if path.parent != directory else None
+            subclass_id = taxonomy.subclass_ids.get(label)
+            tidesclass = taxonomy.subclass_classes[subclass_id] if subclass_id else label
+            templates.append(SpectralTemplate(
+                name=str(path.relative_to(directory).with_suffix('')),
+                tidesclass=tidesclass if tidesclass in taxonomy.classes else None,
+                tidesclass_subclass_id=subclass_id,
+                wavelength=np.asarray(wavelength, dtype=SpectrumData.DTYPE).tobytes(),
+                flux=np.asarray(flux, dtype=SpectrumData.DTYPE).tobytes(),
+            ))
+        SpectralTemplate.objects.bulk_create(templates, update_conflicts=True, unique_fields=['name'],
+                                             update_fields=['tidesclass', 'tidesclass_subclass', 'wavelength', 'flux',
+                                                            'updated'])
+        if kwargs['replace']:
+            SpectralTemplate.objects.exclude(name__in=[template.name for template in templates]).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {len(templates)} spectral templates in {time.monotonic() - start:.1f}s'
+        ))
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_targets.models import Target
+from tidestom.tides_utils.cache_utils import invalidate_latest_targets
+from tidestom.tides_utils.summaries import refresh_target_summaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the TargetSummary read model used by the list pages from the source tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of targets summarised per query')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        target_ids = list(Target.objects.order_by('id').values_list('id', flat=True))
+        batch_size = kwargs['batch_size']
+        for i in range(0, len(target_ids), batch_size):
+            with transaction.atomic():
+                refresh_target_summaries(target_ids[i:i + batch_size])
+        invalidate_latest_targets()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(target_ids)} target summaries in {time.monotonic() - start:.1f}s'
+        ))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_targets.models import Target
+from tidestom.tides_utils.summaries import refresh_target_summaries
+from tidestom.tides_utils.target_utils import update_human_consensus
+
+
+class Command(BaseCommand):
+    help = 'Recompute the materialized human classification consensus of every target from its submissions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of targets recomputed per query')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        target_ids = list(Target.objects.order_by('id').values_list('id', flat=True))
+        batch_size = kwargs['batch_size']
+        for i in range(0, len(target_ids), batch_size):
+            batch = target_ids[i:i + batch_size]
+            with transaction.atomic():
+                update_human_consensus(batch)
+                refresh_target_summaries(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed the human classification consensus of {len(target_ids)} targets in '
+            f'{time.monotonic() - start:.1f}s'
+        ))
@@ -219,7 +219,14 @@ TARGET_MODEL_CLASS = 'custom_code.models.TidesTarget'
 # MATCH_MANAGERS = {
 #    "Target": "custom_code.match_managers.CustomTargetMatchManager"
 # }
-MATCH_MANAGERS = {}
+# TidesTargetMatchManager also treats targets within TARGET_MATCH_RADIUS of each other as the same object.
+MATCH_MANAGERS = {
+    'Target': 'custom_code.match_managers.TidesTargetMatchManager',
+}
+TARGET_MATCH_RADIUS = 1.5  # arcsec
+
+# On-disk spectral similarity index, built with build_similarity_index and extended by estimate_redshifts
+SIMILARITY_INDEX_DIR = os.path.join(BASE_DIR, 'data', 'similarity_index')
 
 FACILITIES = {
     'LCO': {
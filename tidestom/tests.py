@@ -0,0 +1,301 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from tom_dataproducts.models import DataProduct
+from tom_targets.models import Target
+
+from custom_code.models import SpectrumFile, TargetSummary
+from tidestom.tides_utils.consensus import human_consensus
+from tidestom.tides_utils.ingestion import IngestionContext
+from tidestom.tides_utils.redshift import MIN_R_VALUE, TemplateBank, estimate_redshifts
+from tidestom.tides_utils.sky_index import (N_RA_CELLS, N_ZONES, PositionIndex, angular_separation,
+                                            cone_cell_ranges, sky_cell, sky_cells)
+from tidestom.tides_utils.spectrum_store import decimate_minmax
+from tidestom.tides_utils.target_utils import (check_spectrum_manifest, record_spectrum_file, spectrum_file_digest,
+                                               spectrum_file_stat)
+from tidestom.views import LatestView
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class TestSkyCells(TestCase):
+    def in_ranges(self, cell, ranges):
+        return any(first <= cell <= last for first, last in ranges)
+
+    def test_ra_wraps(self):
+        self.assertEqual(sky_cell(360.0, 10.0), sky_cell(0.0, 10.0))
+        self.assertEqual(sky_cell(-0.5, 10.0), sky_cell(359.5, 10.0))
+        self.assertIsNone(sky_cell(10.0, None))
+        self.assertIsNone(sky_cell(10.0, 91.0))
+
+    def test_poles(self):
+        self.assertEqual(sky_cell(0.0, 90.0) // N_RA_CELLS, N_ZONES - 1)
+        self.assertEqual(sky_cell(0.0, -90.0) // N_RA_CELLS, 0)
+        # Every right ascension of the polar zones is in a cone around the pole
+        ranges = cone_cell_ranges(123.0, 89.99, 0.05)
+        for ra in np.arange(0, 360, 7.5):
+            self.assertTrue(self.in_ranges(sky_cell(ra, 89.98), ranges))
+
+    def test_cone_across_ra_zero(self):
+        ranges = cone_cell_ranges(359.9995, 0.0, 0.002)
+        self.assertGreater(len(ranges), 1)
+        for ra in (359.999, 0.0, 0.001):
+            self.assertTrue(self.in_ranges(sky_cell(ra, 0.0005), ranges))
+        self.assertFalse(self.in_ranges(sky_cell(180.0, 0.0), ranges))
+
+    def test_cone_ranges_cover_the_cone(self):
+        rng = np.random.default_rng(3)
+        for ra, dec, radius in ((10.0, 45.0, 0.5), (200.0, -80.0, 2.0), (0.1, 60.0, 1.0)):
+            ranges = cone_cell_ranges(ra, dec, radius)
+            ras = ra + rng.uniform(-radius, radius, 2000) / np.cos(np.radians(dec))
+            decs = np.clip(dec + rng.uniform(-radius, radius, 2000), -90, 90)
+            inside = angular_separation(ra, dec, ras, decs) <= radius
+            for cell in sky_cells(ras[inside], decs[inside]):
+                self.assertTrue(self.in_ranges(cell, ranges))
+
+    def test_position_index(self):
+        index = PositionIndex([(1, 359.9999, 10.0), (2, 0.0002, 10.0), (3, 50.0, 89.9999), (4, 10.0, None)])
+        target_id, separation = index.nearest(0.0001, 10.0, 1 / 3600)
+        self.assertEqual(target_id, 2)
+        self.assertAlmostEqual(separation, 0.0001 * np.cos(np.radians(10.0)), places=9)
+        self.assertEqual(index.nearest(230.0, 89.9999, 1 / 3600)[0], 3)
+        self.assertIsNone(index.nearest(180.0, 10.0, 1 / 3600))
+        index.add(5, 180.0, 10.0)
+        self.assertEqual(index.nearest(180.0, 10.0, 1 / 3600)[0], 5)
+
+    def test_match_cone_search(self):
+        west = Target.objects.create(name='west', type='SIDEREAL', ra=359.9999, dec=-30.0)
+        east = Target.objects.create(name='east', type='SIDEREAL', ra=0.0001, dec=-30.0)
+        pole = Target.objects.create(name='pole', type='SIDEREAL', ra=90.0, dec=89.9999)
+        Target.objects.create(name='far', type='SIDEREAL', ra=180.0, dec=-30.0)
+        self.assertEqual(set(Target.matches.match_cone_search(0.0, -30.0, 1.0)), {west, east})
+        self.assertEqual(set(Target.matches.match_cone_search(-0.0001, -30.0, 0.5)), {west})
+        self.assertEqual(set(Target.matches.match_cone_search(270.0, 89.9999, 1.0)), {pole})
+
+
+class TestDecimateMinMax(TestCase):
+    def test_short_spectra_are_unchanged(self):
+        wavelength = np.arange(10.0)
+        flux = np.arange(10.0)
+        decimated = decimate_minmax(wavelength, flux, 5)
+        np.testing.assert_array_equal(decimated[0], wavelength)
+        np.testing.assert_array_equal(decimated[1], flux)
+
+    def test_keeps_extremes(self):
+        rng = np.random.default_rng(0)
+        wavelength = np.linspace(4000, 9000, 10001)
+        flux = rng.normal(size=wavelength.size)
+        flux[1234] = 50.0  # a narrow line
+        flux[7777] = -50.0
+        flux[42] = np.nan
+        decimated_wavelength, decimated_flux = decimate_minmax(wavelength, flux, 100)
+        self.assertLessEqual(len(decimated_flux), 200)
+        self.assertTrue(np.all(np.diff(decimated_wavelength) > 0))
+        self.assertIn(50.0, decimated_flux)
+        self.assertIn(-50.0, decimated_flux)
+        self.assertFalse(np.isnan(decimated_flux).any())
+        # Every kept pixel is one of the originals
+        np.testing.assert_array_equal(decimated_flux, flux[np.searchsorted(wavelength, decimated_wavelength)])
+
+    def test_each_run_keeps_its_min_and_max(self):
+        flux = np.tile([0.0, 3.0, -2.0, 1.0], 100)
+        _, decimated_flux = decimate_minmax(np.arange(flux.size, dtype=float), flux, 100)
+        np.testing.assert_array_equal(decimated_flux, np.tile([3.0, -2.0], 100))
+
+
+class TestRedshiftEstimates(TestCase):
+    def setUp(self):
+        self.wavelength = np.linspace(2500, 9000, 6000)
+        self.templates = [self.template([3500, 4100, 5200, 6150], [40, 60, 50, 70], [0.4, 0.3, 0.5, 0.4]),
+                          self.template([3900, 4700, 5800, 6600], [50, 40, 80, 60], [0.3, 0.5, 0.3, 0.4])]
+        self.bank = TemplateBank([self.wavelength] * 2, self.templates)
+
+    def template(self, centres, widths, depths):
+        flux = 1 + 0.5 * np.exp(-((self.wavelength - 5000) / 3000) ** 2)
+        for centre, width, depth in zip(centres, widths, depths):
+            flux -= depth * np.exp(-0.5 * ((self.wavelength - centre) / width) ** 2)
+        return flux
+
+    def test_recovers_redshift_and_template(self):
+        rng = np.random.default_rng(1)
+        observed = np.linspace(4000, 8500, 3000)
+        redshifts, templates = [0.05, 0.2, 0.3], [0, 1, 0]
+        fluxes = [np.interp(observed / (1 + z), self.wavelength, self.templates[template])
+                  + rng.normal(0, 0.01, observed.size) for z, template in zip(redshifts, templates)]
+        results = estimate_redshifts(self.bank, [observed] * 3, fluxes)
+        np.testing.assert_allclose(results.redshift, redshifts, atol=0.002)
+        np.testing.assert_array_equal(results.template, templates)
+        self.assertTrue(np.all(results.r_value > MIN_R_VALUE))
+        self.assertTrue(np.all(results.redshift_err > 0))
+
+    def test_spectra_without_data(self):
+        observed = np.linspace(4000, 8500, 3000)
+        results = estimate_redshifts(self.bank, [observed, observed[:1]], [np.full(observed.size, np.nan), [1.0]])
+        np.testing.assert_array_equal(results.template, [-1, -1])
+        self.assertTrue(np.isnan(results.redshift).all())
+        self.assertEqual(len(estimate_redshifts(self.bank, [], []).redshift), 0)
+
+
+class TestHumanConsensus(TestCase):
+    def row(self, target_id, tidesclass, n, first, subclass=None, other=None):
+        return {'target_id': target_id, 'tidesclass': tidesclass, 'tidesclass_subclass': subclass,
+                'tidesclass_other': other, 'n': n, 'first': first}
+
+    def test_majority_and_agreement(self):
+        consensus, no_votes = human_consensus([1, 2], [
+            self.row(1, 'SNIa', 2, 3, subclass=7),
+            self.row(1, 'SNIa', 1, 5, subclass=8),
+            self.row(1, 'SNII', 1, 1),
+        ])
+        self.assertEqual(consensus['human_tidesclass'], 'SNIa')
+        self.assertEqual(consensus['human_tidesclass_subclass'], 7)
+        self.assertEqual(consensus['human_tidesclass_votes'], {'SNIa': 3, 'SNII': 1})
+        self.assertEqual(consensus['human_tidesclass_count'], 4)
+        self.assertEqual(consensus['human_tidesclass_agreement'], 0.75)
+        self.assertIsNone(no_votes['human_tidesclass'])
+        self.assertEqual(no_votes['human_tidesclass_count'], 0)
+        self.assertIsNone(no_votes['human_tidesclass_agreement'])
+
+    def test_ties_go_to_the_first_submission(self):
+        consensus, = human_consensus([1], [
+            self.row(1, 'SNII', 1, 4),
+            self.row(1, 'Other', 1, 2, other='nova'),
+            self.row(1, 'Other', 1, 6, other='flare'),
+            self.row(1, 'SNII', 1, 8),
+        ])
+        self.assertEqual(consensus['human_tidesclass'], 'Other')
+        self.assertEqual(consensus['human_tidesclass_other'], 'nova')
+        self.assertEqual(consensus['human_tidesclass_agreement'], 0.5)
+
+
+class TestSpectrumManifest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.targets = [Target.objects.create(name=f'manifest{i}', type='SIDEREAL', ra=10.0 + i, dec=-20.0)
+                        for i in range(2)]
+        # A multi-target L1 file with a product for each target
+        self.path = self.write('l1.fits', b'two targets')
+        self.products = [DataProduct.objects.create(target=target, product_id=f'l1_{target.name}',
+                                                    data_product_type='spectroscopy', data=f'spectra/{target.name}')
+                         for target in self.targets]
+        record_spectrum_file(self.path, *spectrum_file_stat(self.path), spectrum_file_digest(self.path),
+                             [product.id for product in self.products])
+
+    def write(self, filename, content):
+        path = os.path.join(self.directory, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_unchanged_file_is_not_hashed(self):
+        with mock.patch('tidestom.tides_utils.target_utils.spectrum_file_digest') as digest:
+            action, entries, *_ = check_spectrum_manifest(self.path)
+        self.assertEqual(action, 'unchanged')
+        self.assertEqual({entry.data_product_id for entry in entries}, {product.id for product in self.products})
+        digest.assert_not_called()
+
+    def test_touched_file_with_the_same_content(self):
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        action, *_ = check_spectrum_manifest(self.path)
+        self.assertEqual(action, 'unchanged')
+        self.assertEqual(set(SpectrumFile.objects.filter(path=self.path).values_list('mtime', flat=True)),
+                         {stat.st_mtime + 10})
+
+    def test_copy_is_a_duplicate_of_every_product(self):
+        copy = self.write('copy.fits', b'two targets')
+        action, *_ = check_spectrum_manifest(copy)
+        self.assertEqual(action, 'duplicate')
+        self.assertEqual(set(SpectrumFile.objects.filter(path=copy).values_list('data_product_id', flat=True)),
+                         {product.id for product in self.products})
+
+    def test_changed_and_new_files_are_ingested(self):
+        self.write('l1.fits', b'new content')
+        action, entries, *_ = check_spectrum_manifest(self.path)
+        self.assertEqual(action, 'ingest')
+        self.assertEqual(len(entries), 2)
+        action, entries, *_ = check_spectrum_manifest(self.write('new.fits', b'other content'))
+        self.assertEqual((action, entries), ('ingest', []))
+
+    def test_record_replaces_the_products_of_a_file(self):
+        record_spectrum_file(self.path, *spectrum_file_stat(self.path), 'digest', [self.products[1].id])
+        self.assertEqual(list(SpectrumFile.objects.filter(path=self.path).values_list('data_product_id', 'sha256')),
+                         [(self.products[1].id, 'digest')])
+        record_spectrum_file(self.path, *spectrum_file_stat(self.path), 'digest', [])
+        self.assertEqual(list(SpectrumFile.objects.filter(path=self.path).values_list('data_product_id', flat=True)),
+                         [None])
+
+    def test_ingestion_context(self):
+        context = IngestionContext()
+        size, mtime = spectrum_file_stat(self.path)
+        sha256 = spectrum_file_digest(self.path)
+        product_ids = [product.id for product in self.products]
+        self.assertTrue(context.spectrum_unchanged(self.path, size, mtime))
+        self.assertFalse(context.spectrum_unchanged(self.path, size, mtime + 1))
+        self.assertEqual(context.classify_spectrum(self.path, sha256), ('unchanged', product_ids))
+        self.assertEqual(context.classify_spectrum(os.path.join(self.directory, 'copy.fits'), sha256),
+                         ('duplicate', product_ids))
+        self.assertEqual(context.classify_spectrum(self.path, 'changed'), ('changed', product_ids))
+        self.assertEqual(context.classify_spectrum(os.path.join(self.directory, 'new.fits'), 'new'), ('new', []))
+
+        copy = os.path.join(self.directory, 'copy.fits')
+        context.record_spectrum_file(copy, size, mtime, sha256, product_ids)
+        self.assertEqual(context.manifest[copy], (size, mtime, sha256, product_ids))
+        self.assertEqual(context.products_by_digest[sha256], product_ids)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestLatestView(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser(username='latest', password='latest')
+        self.client.force_login(self.user)
+        now = timezone.now()
+        targets = [Target.objects.create(name=f'latest{i}', type='SIDEREAL', ra=i, dec=0.0) for i in range(8)]
+        # Pairs of targets created at the same time, so pages also split ties on the target id
+        for i, target in enumerate(targets):
+            TargetSummary.objects.filter(target=target).update(created=now - timedelta(hours=i // 2),
+                                                               latest_spectrum=now)
+        Target.objects.create(name='nospectra', type='SIDEREAL', ra=20.0, dec=0.0)
+        self.expected = list(TargetSummary.objects.filter(latest_spectrum__isnull=False).order_by(
+            '-created', '-target_id').values_list('target_id', flat=True))
+
+    def pages(self, query=None):
+        query = dict(query or {})
+        pages = []
+        # A cursor that does not move on would page forever
+        for _ in range(len(self.expected) + 1):
+            response = self.client.get(reverse('latest'), query)
+            self.assertEqual(response.status_code, 200)
+            pages.append([summary.target_id for summary in response.context['targets']])
+            self.assertEqual(response.context['is_first_page'], len(pages) == 1)
+            if not response.context['next_cursor']:
+                return pages
+            query['before'] = response.context['next_cursor']
+        self.fail('The Latest pages did not end')
+
+    def test_keyset_pages(self):
+        with mock.patch.object(LatestView, 'page_size', 3):
+            pages = self.pages()
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([target_id for page in pages for target_id in page], self.expected)
+
+    def test_page_boundary_on_a_tie(self):
+        with mock.patch.object(LatestView, 'page_size', 1):
+            pages = self.pages()
+        self.assertEqual([target_id for page in pages for target_id in page], self.expected)
+
+    def test_filters_are_kept_across_pages(self):
+        with mock.patch.object(LatestView, 'page_size', 1):
+            pages = self.pages({'name': 'latest1'})
+        self.assertEqual(pages, [[Target.objects.get(name='latest1').id]])
@@ -0,0 +1,62 @@
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+LATEST_TARGETS_VERSION_KEY = 'latest_targets_version'
+
+
+def latest_targets_version():
+    '''
+    Version counter for the cached pages of the Latest view. Page cache keys include it, so bumping it invalidates
+    every cached page at once. It starts from the current time, so a counter lost from the cache never comes back
+    with the number of an old version.
+    '''
+    return cache.get_or_set(LATEST_TARGETS_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def _bump_latest_targets_version():
+    try:
+        cache.incr(LATEST_TARGETS_VERSION_KEY)
+    except ValueError:
+        cache.set(LATEST_TARGETS_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate_latest_targets():
+    '''
+    Call when spectra, targets or auto classifications change. Inside a transaction the version is bumped once it
+    commits: bumped earlier, a concurrent request could cache the data from before the commit under the new version.
+    '''
+    transaction.on_commit(_bump_latest_targets_version)
+
+
+def _target_version_key(target_id):
+    return f'target_version:{target_id}'
+
+
+def target_version(target_id):
+    '''
+    Version counter for the cached fragments of a target's detail page, which include it in their keys. Like
+    ``latest_targets_version`` it starts from the current time, so dropping the counter is enough to invalidate.
+    '''
+    return cache.get_or_set(_target_version_key(target_id), time.time_ns(), timeout=None)
+
+
+def invalidate_targets(target_ids):
+    '''
+    Call when anything shown on the detail pages of these targets changes; one cache call for any number, made once
+    the current transaction commits, as with ``invalidate_latest_targets``.
+    '''
+    keys = [_target_version_key(target_id) for target_id in target_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+TAXONOMY_VERSION_KEY = 'taxonomy_version'
+
+
+def taxonomy_version():
+    '''Version of the TidesClass and TidesClassSubClass tables, checked by every process before using its snapshot.'''
+    return cache.get_or_set(TAXONOMY_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate_taxonomy_version():
+    cache.delete(TAXONOMY_VERSION_KEY)
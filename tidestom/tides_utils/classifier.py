@@ -0,0 +1,90 @@
+"""
+Template-fitting classification of spectra at their redshift. Spectra are moved to the rest frame, resampled onto the
+log-wavelength grid of ``tidestom.tides_utils.redshift`` and flattened in the same way, and stacked into one matrix.
+A few matrix products then give the correlation of every spectrum with every template over the wavelengths both
+cover. A class scores its best template, and the scores of the classes become probabilities with a softmax, so they
+rank the classes of one spectrum rather than being calibrated. Only NumPy and SciPy are needed.
+"""
+from typing import NamedTuple
+import numpy as np
+from tidestom.tides_utils.redshift import MIN_OVERLAP, flatten, log_rebin
+
+# Correlation difference that makes one class e times more likely than another
+SCORE_SCALE = 0.05
+
+
+class ClassifierResults(NamedTuple):
+    """Per-spectrum arrays; ``tidesclass`` and ``subclass`` are indices into the bank's labels, -1 for none."""
+    tidesclass: np.ndarray
+    subclass: np.ndarray
+    probability: np.ndarray
+    score: np.ndarray
+
+
+class ClassTemplates:
+    """
+    Rest-frame templates stacked as matrices, with the index of their class and sub-class in ``classes`` and
+    ``subclasses`` (-1 for a template with no sub-class).
+    """
+
+    def __init__(self, wavelengths, fluxes, tidesclasses, subclasses):
+        rebinned = np.array([log_rebin(wavelength, flux) for wavelength, flux in zip(wavelengths, fluxes)])
+        self.flat = flatten(rebinned).astype(np.float32)
+        self.covered = np.isfinite(rebinned).astype(np.float32)
+        self.classes = sorted(set(tidesclasses))
+        self.subclasses = sorted({subclass for subclass in subclasses if subclass is not None})
+        self.class_index = np.array([self.classes.index(tidesclass) for tidesclass in tidesclasses])
+        self.subclass_index = np.array([self.subclasses.index(subclass) if subclass is not None else -1
+                                        for subclass in subclasses])
+
+    def __len__(self):
+        return len(self.flat)
+
+
+def template_correlations(templates, wavelengths, fluxes, redshifts):
+    '''
+    Correlation coefficient of each spectrum, moved to the rest frame, with each template over the wavelengths that
+    both cover, as an (n spectra, n templates) matrix. Pairs that overlap by less than ``MIN_OVERLAP`` of either
+    spectrum's or template's power are -1.
+    '''
+    rebinned = np.array([log_rebin(np.asarray(wavelength, dtype=float) / (1 + redshift), flux)
+                         for wavelength, flux, redshift in zip(wavelengths, fluxes, redshifts)])
+    flat = flatten(rebinned).astype(np.float32)
+    covered = np.isfinite(rebinned).astype(np.float32)
+    products = flat @ templates.flat.T
+    # Power of each template where the spectrum has data, and of each spectrum where the template has data
+    template_power = covered @ (templates.flat ** 2).T
+    spectrum_power = (flat ** 2) @ templates.covered.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = products / np.sqrt(template_power * spectrum_power)
+    return np.where((template_power >= MIN_OVERLAP) & (spectrum_power >= MIN_OVERLAP), correlation, -1)
+
+
+def classify(templates, wavelengths, fluxes, redshifts):
+    '''
+    Classifies a batch of spectra at their redshifts. The class is the one of the best-matching template, with the
+    softmax of the class scores as its probability; the sub-class is the best sub-class of that class, if any of its
+    templates has one.
+    '''
+    n_spectra = len(fluxes)
+    if not n_spectra or not len(templates):
+        return ClassifierResults(np.full(n_spectra, -1), np.full(n_spectra, -1), np.full(n_spectra, np.nan),
+                                 np.full(n_spectra, np.nan))
+    correlation = template_correlations(templates, wavelengths, fluxes, redshifts)
+    class_scores = np.full((n_spectra, len(templates.classes)), -1.0)
+    for index in range(len(templates.classes)):
+        class_scores[:, index] = correlation[:, templates.class_index == index].max(axis=1)
+    tidesclass = class_scores.argmax(axis=1)
+    score = class_scores[np.arange(n_spectra), tidesclass]
+    weights = np.exp((class_scores - score[:, None]) / SCORE_SCALE)
+    probability = 1 / weights.sum(axis=1)
+
+    # Best sub-class among the templates of the chosen class
+    in_class = templates.class_index[None, :] == tidesclass[:, None]
+    with_subclass = in_class & (templates.subclass_index[None, :] >= 0)
+    best = np.where(with_subclass, correlation, -np.inf).argmax(axis=1)
+    subclass = np.where(with_subclass.any(axis=1), templates.subclass_index[best], -1)
+
+    matched = score > -1
+    return ClassifierResults(np.where(matched, tidesclass, -1), np.where(matched, subclass, -1),
+                             np.where(matched, probability, np.nan), np.where(matched, score, np.nan))
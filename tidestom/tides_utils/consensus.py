@@ -0,0 +1,49 @@
+"""
+The human classification consensus of targets, materialized on ``TidesTarget`` in ``HUMAN_CONSENSUS_FIELDS`` from
+their ``HumanTidesClassSubmission`` rows. ``human_consensus`` works on plain rows and needs no database.
+"""
+from django.db.models import Count, Min
+
+HUMAN_CONSENSUS_FIELDS = ['human_tidesclass', 'human_tidesclass_other', 'human_tidesclass_subclass',
+                          'human_tidesclass_votes', 'human_tidesclass_count', 'human_tidesclass_agreement']
+
+def _majority(votes):
+    # votes maps a choice to (count, id of its first submission); ties go to the choice submitted first
+    return min(votes, key=lambda choice: (-votes[choice][0], votes[choice][1])) if votes else None
+
+def human_vote_rows(submissions):
+    '''The submissions grouped by target and choice, as ``human_consensus`` takes them.'''
+    return (submissions.values('target_id', 'tidesclass', 'tidesclass_other', 'tidesclass_subclass')
+            .annotate(n=Count('id'), first=Min('id')))
+
+def human_consensus(target_ids, vote_rows):
+    '''
+    The human classification consensus of each target, in ``HUMAN_CONSENSUS_FIELDS``, from its ``human_vote_rows``:
+    the majority class (ties go to the class submitted first, as with ``Counter.most_common``), the majority sub-class
+    and "Other" text among the votes for that class, the votes per class, the number of submissions and the fraction
+    that agree with the majority.
+    '''
+    class_votes, subclass_votes, other_votes = {}, {}, {}
+    for row in vote_rows:
+        key = (row['target_id'], row['tidesclass'])
+        n, first = class_votes.setdefault(row['target_id'], {}).get(row['tidesclass'], (0, row['first']))
+        class_votes[row['target_id']][row['tidesclass']] = (n + row['n'], min(first, row['first']))
+        for votes, choice in ((subclass_votes, row['tidesclass_subclass']), (other_votes, row['tidesclass_other'])):
+            if choice:
+                n, first = votes.setdefault(key, {}).get(choice, (0, row['first']))
+                votes[key][choice] = (n + row['n'], min(first, row['first']))
+
+    consensus = []
+    for target_id in target_ids:
+        votes = class_votes.get(target_id, {})
+        majority = _majority(votes)
+        total = sum(n for n, _ in votes.values())
+        consensus.append({
+            'human_tidesclass': majority,
+            'human_tidesclass_other': _majority(other_votes.get((target_id, majority), {})),
+            'human_tidesclass_subclass': _majority(subclass_votes.get((target_id, majority), {})),
+            'human_tidesclass_votes': {choice: n for choice, (n, _) in votes.items()},
+            'human_tidesclass_count': total,
+            'human_tidesclass_agreement': votes[majority][0] / total if total else None,
+        })
+    return consensus
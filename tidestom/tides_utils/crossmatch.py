@@ -0,0 +1,142 @@
+"""
+Positional crossmatch of an external catalogue (host galaxies, TNS objects, another survey's alerts) against all
+targets in one vectorized step. Positions become unit vectors, the targets go into a k-d tree, and a match radius
+becomes the straight-line (chord) distance between the vectors, so every catalogue row is matched with a single tree
+query and no loop over targets. Used by the ``crossmatch`` command and the crossmatch upload endpoint.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from guardian.shortcuts import get_objects_for_user
+from scipy.spatial import cKDTree
+from tom_targets.models import Target
+
+# Recognised coordinate column names, compared case-insensitively
+RA_COLUMNS = ('ra', 'raj2000', 'ra_j2000', 'ra_deg', 'radeg', 'ra_icrs')
+DEC_COLUMNS = ('dec', 'decj2000', 'dej2000', 'dec_j2000', 'dec_deg', 'decdeg', 'de_icrs', 'dec_icrs')
+CSV_CHUNK_ROWS = 50000
+
+
+def unit_vectors(ra, dec):
+    '''Cartesian unit vectors of positions in degrees, as an (n, 3) array.'''
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def chord_length(radius):
+    '''Distance between the unit vectors of two positions ``radius`` arcseconds apart.'''
+    return 2 * np.sin(np.radians(radius / 3600) / 2)
+
+
+def chord_separation(chord):
+    '''Inverse of ``chord_length``, in arcseconds.'''
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0, 1))) * 3600
+
+
+def crossmatch(ra, dec, target_ra, target_dec, radius, nearest=True):
+    '''
+    Matches positions to target positions within ``radius`` arcseconds. With ``nearest`` each position gets its
+    closest target, otherwise every pair within the radius is returned. Rows without a valid position never match.
+
+    :returns: position indices, target indices and separations in arcseconds, ordered by position index
+    '''
+    ra, dec, target_ra, target_dec = (np.asarray(values, dtype=float) for values in (ra, dec, target_ra, target_dec))
+    valid = np.flatnonzero(np.isfinite(ra) & (np.abs(dec) <= 90))
+    target_valid = np.flatnonzero(np.isfinite(target_ra) & (np.abs(target_dec) <= 90))
+    if not len(valid) or not len(target_valid):
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+    tree = cKDTree(unit_vectors(target_ra[target_valid], target_dec[target_valid]))
+    points = unit_vectors(ra[valid], dec[valid])
+    max_chord = chord_length(radius)
+    if nearest:
+        chord, index = tree.query(points, distance_upper_bound=max_chord, workers=-1)
+        matched = np.flatnonzero(np.isfinite(chord))
+        return valid[matched], target_valid[index[matched]], chord_separation(chord[matched])
+    pairs = cKDTree(points).sparse_distance_matrix(tree, max_chord, output_type='ndarray')
+    order = np.lexsort((pairs['v'], pairs['i']))
+    pairs = pairs[order]
+    return valid[pairs['i']], target_valid[pairs['j']], chord_separation(pairs['v'])
+
+
+def find_column(columns, candidates, name=None):
+    '''The column called ``name``, or else the first of ``candidates`` in ``columns``, ignoring case.'''
+    lowered = {column.lower(): column for column in columns}
+    for candidate in ([name] if name else candidates):
+        if candidate.lower() in lowered:
+            return lowered[candidate.lower()]
+    raise ValueError(f"No {name or candidates[0]} column among {', '.join(map(str, columns))}")
+
+
+def read_catalogue(source, ra_column=None, dec_column=None, id_column=None, file_format=None):
+    '''
+    Reads the identifier, RA and Dec (degrees) columns of a CSV or Parquet catalogue, from a path or a file object.
+    Only those three columns are loaded. Without ``id_column`` the first other column identifies rows, or the row
+    number if there is none. The format follows the file name unless ``file_format`` is given.
+
+    :returns: DataFrame with the identifier column followed by ``ra`` and ``dec``
+    '''
+    if file_format is None:
+        file_format = 'parquet' if Path(getattr(source, 'name', str(source))).suffix.lower() in ('.parquet', '.pq') \
+            else 'csv'
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        columns = pq.ParquetFile(source).schema_arrow.names
+    else:
+        columns = list(pd.read_csv(source, nrows=0).columns)
+    ra_column = find_column(columns, RA_COLUMNS, ra_column)
+    dec_column = find_column(columns, DEC_COLUMNS, dec_column)
+    if id_column is None:
+        id_column = next((column for column in columns if column not in (ra_column, dec_column)), None)
+    elif id_column not in columns:
+        raise ValueError(f'No {id_column} column in the catalogue')
+    usecols = [column for column in (id_column, ra_column, dec_column) if column is not None]
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    if file_format == 'parquet':
+        catalogue = pd.read_parquet(source, columns=usecols)
+    else:
+        catalogue = pd.read_csv(source, usecols=usecols, dtype={id_column: str} if id_column else None)
+    catalogue = catalogue.rename(columns={ra_column: 'ra', dec_column: 'dec'})
+    if id_column is None:
+        catalogue.insert(0, 'row', np.arange(len(catalogue)))
+    else:
+        catalogue = catalogue[[id_column, 'ra', 'dec']]
+    catalogue['ra'] = pd.to_numeric(catalogue['ra'], errors='coerce')
+    catalogue['dec'] = pd.to_numeric(catalogue['dec'], errors='coerce')
+    return catalogue
+
+
+def target_positions(user=None):
+    '''
+    Ids, names and positions of the targets with a position, those ``user`` may view if given, as one DataFrame read
+    with a single query.
+    '''
+    targets = Target.objects.filter(ra__isnull=False, dec__isnull=False)
+    if user is not None and not user.is_superuser:
+        targets = get_objects_for_user(user, f'{Target._meta.app_label}.view_target', klass=targets)
+    return pd.DataFrame.from_records(targets.values_list('id', 'name', 'ra', 'dec').iterator(),
+                                     columns=['target_id', 'target_name', 'target_ra', 'target_dec'])
+
+
+def match_catalogue(catalogue, targets, radius, nearest=True):
+    '''
+    Crossmatches a catalogue from ``read_catalogue`` with the targets from ``target_positions``.
+
+    :returns: DataFrame with the catalogue identifier and position of each match, then the target id, name and
+        position and the separation in arcseconds
+    '''
+    rows, target_rows, separation = crossmatch(catalogue['ra'], catalogue['dec'], targets['target_ra'],
+                                               targets['target_dec'], radius, nearest=nearest)
+    matches = pd.concat([catalogue.iloc[rows].reset_index(drop=True),
+                         targets.iloc[target_rows].reset_index(drop=True)], axis=1)
+    matches['separation'] = separation
+    return matches
+
+
+def iter_csv(matches, chunk_rows=CSV_CHUNK_ROWS):
+    '''The matches as CSV text, in chunks of ``chunk_rows`` rows, for streaming responses and output files.'''
+    yield matches.iloc[:0].to_csv(index=False)
+    for start in range(0, len(matches), chunk_rows):
+        yield matches.iloc[start:start + chunk_rows].to_csv(index=False, header=False, float_format='%.10g')
@@ -0,0 +1,147 @@
+import logging
+import pandas as pd
+from pathlib import Path
+from tom_targets.models import Target, TargetName
+from tom_dataproducts.models import DataProduct
+from custom_code.models import SpectrumFile
+from tidestom.tides_utils.target_utils import links_to, tom_spectrum_path, record_spectrum_file
+from tidestom.tides_utils.summaries import refresh_target_summaries
+from tidestom.tides_utils.taxonomy import get_taxonomy
+
+logger = logging.getLogger(__name__)
+
+ARROW_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'ipc', '.feather': 'ipc', '.ipc': 'ipc'}
+
+
+def iter_pipeline_results(pipeline_results_path, chunk_size=1000, start_row=0):
+    """
+    Streams a pipeline results file in chunks without loading it whole. CSV is read with pandas, and Parquet or
+    Arrow IPC/Feather files with pyarrow, chosen by file extension.
+
+    :returns: iterator of ``(first_row, DataFrame)`` tuples, starting at row ``start_row``
+    """
+    arrow_format = ARROW_FORMATS.get(Path(pipeline_results_path).suffix.lower())
+    if arrow_format is None:
+        row = start_row
+        for chunk in pd.read_csv(pipeline_results_path, chunksize=chunk_size, skiprows=range(1, start_row + 1)):
+            yield row, chunk
+            row += len(chunk)
+        return
+
+    import pyarrow.dataset as ds
+    row = 0
+    for batch in ds.dataset(pipeline_results_path, format=arrow_format).to_batches(batch_size=chunk_size):
+        if row + batch.num_rows <= start_row:
+            row += batch.num_rows
+            continue
+        if row < start_row:
+            batch = batch.slice(start_row - row)
+            row = start_row
+        yield row, batch.to_pandas()
+        row += batch.num_rows
+
+
+class IngestionContext:
+    """
+    Lookup maps for a spectrum ingestion run, each loaded with a single query, so that rows can be resolved in memory
+    instead of with several queries per row. Auto classifications are queued and written with one ``bulk_update``
+    per ``batch_size`` targets; call ``flush`` at the end of each chunk.
+
+    The ingestion manifest (``SpectrumFile``) is loaded too, so that unchanged files are skipped after a stat and
+    only files whose content is new or changed are decoded. It maps each path to its size, mtime, content hash and
+    the ids of the DataProducts made from it.
+    """
+
+    AUTO_CLASS_FIELDS = ['auto_tidesclass', 'auto_tidesclass_subclass', 'auto_tidesclass_prob']
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.target_ids = {name: target_id for name, target_id in Target.objects.values_list('name', 'id')}
+        # Aliases never shadow a primary name
+        for name, target_id in TargetName.objects.values_list('name', 'target_id'):
+            self.target_ids.setdefault(name, target_id)
+        self.spectrum_paths = dict(
+            DataProduct.objects.filter(data_product_type='spectroscopy').values_list('data', 'id')
+        )
+        self.manifest = {}
+        self.products_by_digest = {}
+        for path, size, mtime, sha256, data_product_id in SpectrumFile.objects.values_list(
+                'path', 'size', 'mtime', 'sha256', 'data_product_id'):
+            entry = self.manifest.setdefault(path, (size, mtime, sha256, []))
+            if data_product_id:
+                entry[3].append(data_product_id)
+                products = self.products_by_digest.setdefault(sha256, [])
+                if data_product_id not in products:
+                    products.append(data_product_id)
+        self.subclass_ids = get_taxonomy().subclass_ids  # lowest id wins, as with .first()
+        self.pending_auto_classes = {}
+
+    def resolve_target(self, name):
+        return self.target_ids.get(str(name))
+
+    def spectrum_unchanged(self, spectrum_file_path, size, mtime):
+        entry = self.manifest.get(spectrum_file_path)
+        return entry is not None and entry[0] == size and entry[1] == mtime
+
+    def classify_spectrum(self, spectrum_file_path, sha256):
+        """
+        Decides what to do with a file whose size or mtime differs from the manifest, given its content hash.
+
+        :returns: ``(action, data_product_ids)`` where action is ``'unchanged'``, ``'duplicate'`` (content already
+            ingested, possibly under another path, into all of ``data_product_ids``), ``'changed'`` (reprocess into
+            the product of ``data_product_ids`` that belongs to the file's target) or ``'new'``
+        """
+        entry = self.manifest.get(spectrum_file_path)
+        if entry and entry[2] == sha256:
+            return 'unchanged', entry[3]
+        if sha256 in self.products_by_digest:
+            return 'duplicate', self.products_by_digest[sha256]
+        if entry is None:
+            # Spectra ingested before the manifest existed are recorded without being decoded again
+            tom_file_path = tom_spectrum_path(spectrum_file_path)
+            legacy = self.spectrum_paths.get(spectrum_file_path)
+            if not legacy and links_to(tom_file_path, spectrum_file_path):
+                legacy = self.spectrum_paths.get(tom_file_path)
+            if legacy:
+                return 'duplicate', [legacy]
+            return 'new', []
+        return ('changed', entry[3]) if entry[3] else ('new', [])
+
+    def record_spectrum_file(self, spectrum_file_path, size, mtime, sha256, data_product_ids):
+        data_product_ids = [data_product_id for data_product_id in dict.fromkeys(data_product_ids) if data_product_id]
+        record_spectrum_file(spectrum_file_path, size, mtime, sha256, data_product_ids)
+        self.manifest[spectrum_file_path] = (size, mtime, sha256, data_product_ids)
+        if data_product_ids:
+            self.products_by_digest[sha256] = data_product_ids
+
+    def add_spectrum(self, data_product):
+        self.spectrum_paths[data_product.data.name] = data_product.id
+
+    def set_auto_classification(self, target_id, target_name, auto_class, auto_class_subclass, auto_class_prob):
+        if not auto_class or pd.isna(auto_class):
+            logger.warning(f'No auto classification found for target {target_name}')
+            return
+        subclass_id = self.subclass_ids.get(auto_class_subclass)
+        if subclass_id is None:
+            logger.warning(f"Subclass '{auto_class_subclass}' not found in TidesClassSubClass for target {target_name}")
+        self.pending_auto_classes[target_id] = (auto_class, subclass_id, auto_class_prob)
+        if len(self.pending_auto_classes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the queued auto classifications with a single bulk_update."""
+        if not self.pending_auto_classes:
+            return
+        with_subclass, without_subclass = [], []
+        for target_id, (auto_class, subclass_id, auto_class_prob) in self.pending_auto_classes.items():
+            target = Target(pk=target_id, auto_tidesclass=auto_class, auto_tidesclass_prob=auto_class_prob)
+            target.auto_tidesclass_subclass_id = subclass_id
+            (with_subclass if subclass_id is not None else without_subclass).append(target)
+        Target.objects.bulk_update(with_subclass, self.AUTO_CLASS_FIELDS)
+        # A subclass that is not in the taxonomy leaves the target's current one in place
+        Target.objects.bulk_update(without_subclass, [field for field in self.AUTO_CLASS_FIELDS
+                                                      if field != 'auto_tidesclass_subclass'])
+        targets = with_subclass + without_subclass
+        refresh_target_summaries(self.pending_auto_classes)
+        logger.info(f'Updated auto classification for {len(targets)} targets')
+        self.pending_auto_classes = {}
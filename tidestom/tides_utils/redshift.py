@@ -0,0 +1,191 @@
+"""
+Batched cross-correlation redshifts. Spectra and templates are resampled onto one logarithmic wavelength grid, where a
+redshift is a shift by a fixed number of bins, flattened by their continuum and tapered at the ends. Each spectrum is
+then correlated with every template at every shift through FFT products, over a whole batch of spectra at once, and
+each correlation is normalised by the part of the template that overlaps the spectrum at that shift. The highest
+peak gives the redshift and template, and the Tonry & Davis (1979) r value and peak width give its uncertainty. Only
+NumPy and SciPy are needed, so the engine runs in worker processes without Django.
+"""
+from typing import NamedTuple
+import numpy as np
+from scipy import fft
+from scipy.ndimage import uniform_filter1d
+
+WAVELENGTH_MIN = 1000.0  # Angstrom, covers the rest frame of templates and the observed frame of spectra
+WAVELENGTH_MAX = 12000.0
+N_BINS = 4096
+LOG_STEP = np.log(WAVELENGTH_MAX / WAVELENGTH_MIN) / N_BINS  # about 180 km/s per bin
+LOG_GRID = np.log(WAVELENGTH_MIN) + (np.arange(N_BINS) + 0.5) * LOG_STEP
+# Zero padded to twice the grid, so the correlation is not circular at any shift
+N_FFT = 2 * N_BINS
+# Width of the running mean that is divided out as the continuum, in bins: broad supernova features survive
+CONTINUUM_BINS = 201
+TAPER_FRACTION = 0.05
+Z_MIN = 0.0
+Z_MAX = 2.0
+# Correlations are only trusted where the overlapping part of the template holds this fraction of its power
+MIN_OVERLAP = 0.2
+# Estimates with a lower Tonry & Davis r are kept but not trusted; noise alone rarely reaches it
+MIN_R_VALUE = 7.0
+# Elements of the (spectra, templates, lags) correlation array computed at once
+CORRELATION_BUDGET = 2 ** 24
+
+
+class RedshiftResults(NamedTuple):
+    """Per-spectrum arrays; ``template`` is an index into the bank, or -1 where no estimate could be made."""
+    redshift: np.ndarray
+    redshift_err: np.ndarray
+    r_value: np.ndarray
+    template: np.ndarray
+
+
+def log_rebin(wavelength, flux):
+    '''
+    A spectrum resampled onto ``LOG_GRID`` by linear interpolation between its finite pixels, NaN outside the range
+    they cover.
+    '''
+    wavelength = np.asarray(wavelength, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(wavelength) & np.isfinite(flux) & (wavelength > 0)
+    rebinned = np.full(N_BINS, np.nan)
+    if good.sum() < 2:
+        return rebinned
+    log_wavelength = np.log(wavelength[good])
+    order = np.argsort(log_wavelength)
+    log_wavelength = log_wavelength[order]
+    inside = (LOG_GRID >= log_wavelength[0]) & (LOG_GRID <= log_wavelength[-1])
+    rebinned[inside] = np.interp(LOG_GRID[inside], log_wavelength, flux[good][order])
+    return rebinned
+
+
+def flatten(rebinned):
+    '''
+    Prepares rows of rebinned spectra for correlation: divides out a running-mean continuum, tapers both ends of the
+    covered range with a cosine and scales each row to unit norm. Bins without data are zero, so they add nothing to
+    any correlation.
+    '''
+    rebinned = np.atleast_2d(rebinned)
+    covered = np.isfinite(rebinned)
+    flux = np.where(covered, rebinned, 0.0)
+    weight = uniform_filter1d(covered.astype(float), CONTINUUM_BINS, axis=1, mode='constant')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        continuum = uniform_filter1d(flux, CONTINUUM_BINS, axis=1, mode='constant') / weight
+        flat = np.where(covered & (continuum > 0), flux / continuum - 1, 0.0)
+
+    first = covered.argmax(axis=1)
+    last = N_BINS - 1 - covered[:, ::-1].argmax(axis=1)
+    edge = np.maximum(1.0, TAPER_FRACTION * (last - first))[:, None]
+    position = np.arange(N_BINS)
+    ramp = np.clip(np.minimum(position - first[:, None], last[:, None] - position) / edge, 0, 1)
+    flat *= 0.5 * (1 - np.cos(np.pi * ramp))
+
+    norm = np.sqrt((flat ** 2).sum(axis=1, keepdims=True))
+    return np.divide(flat, norm, out=np.zeros_like(flat), where=norm > 0)
+
+
+class TemplateBank:
+    """
+    Templates resampled, flattened and Fourier transformed once, to be correlated with any number of spectra.
+    Picklable, so a process pool can hand it to its workers at start-up.
+    """
+
+    def __init__(self, wavelengths, fluxes):
+        flat = flatten(np.array([log_rebin(wavelength, flux) for wavelength, flux in zip(wavelengths, fluxes)]))
+        self.usable = np.flatnonzero(flat.any(axis=1))
+        flat = flat[self.usable].astype(np.float32)
+        self.transforms = np.conj(fft.rfft(flat, n=N_FFT, axis=1))
+        self.power_transforms = np.conj(fft.rfft(flat ** 2, n=N_FFT, axis=1))
+
+    def __len__(self):
+        return len(self.usable)
+
+
+def lag_range(z_min=Z_MIN, z_max=Z_MAX):
+    '''Shifts in bins of the redshifts from ``z_min`` to ``z_max``; a negative shift is a blueshift.'''
+    return np.arange(int(np.floor(np.log1p(z_min) / LOG_STEP)), int(np.ceil(np.log1p(z_max) / LOG_STEP)) + 1)
+
+
+def estimate_redshifts(bank, wavelengths, fluxes, z_min=Z_MIN, z_max=Z_MAX):
+    '''
+    Cross-correlation redshifts of a batch of spectra, given as sequences of wavelength (Angstrom) and flux arrays,
+    against a ``TemplateBank``. The correlations of as many spectra as fit in ``CORRELATION_BUDGET`` are computed
+    with one FFT product and one inverse FFT.
+    '''
+    n_spectra = len(fluxes)
+    results = RedshiftResults(np.full(n_spectra, np.nan), np.full(n_spectra, np.nan), np.full(n_spectra, np.nan),
+                              np.full(n_spectra, -1))
+    if not n_spectra or not len(bank):
+        return results
+    rebinned = np.array([log_rebin(wavelength, flux) for wavelength, flux in zip(wavelengths, fluxes)])
+    flat = flatten(rebinned).astype(np.float32)
+    covered = np.isfinite(rebinned).astype(np.float32)
+    lags = lag_range(z_min, z_max)
+    chunk = max(1, CORRELATION_BUDGET // (len(bank) * N_FFT))
+    for start in range(0, n_spectra, chunk):
+        rows = np.arange(start, min(start + chunk, n_spectra))
+        rows = rows[flat[rows].any(axis=1)]
+        if not len(rows):
+            continue
+        # correlation[s, t, k] = sum_i spectrum_s[i + k] * template_t[i], and overlap[s, t, k] the same sum of
+        # template_t[i] ** 2 over the bins the spectrum covers
+        correlation = fft.irfft(fft.rfft(flat[rows], n=N_FFT, axis=1)[:, None, :] * bank.transforms[None],
+                                n=N_FFT, axis=2)
+        overlap = fft.irfft(fft.rfft(covered[rows], n=N_FFT, axis=1)[:, None, :] * bank.power_transforms[None],
+                            n=N_FFT, axis=2)
+        in_range = _normalised(correlation[:, :, lags % N_FFT], overlap[:, :, lags % N_FFT])
+        best = in_range.reshape(len(rows), -1).argmax(axis=1)
+        template, lag_index = np.unravel_index(best, in_range.shape[1:])
+        index = np.arange(len(rows))
+        _fit_peaks(_normalised(correlation[index, template], overlap[index, template]), lags[lag_index], rows,
+                   results)
+        results.template[rows] = bank.usable[template]
+    return results
+
+
+def _normalised(correlation, overlap):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(overlap >= MIN_OVERLAP, correlation / np.sqrt(overlap), 0)
+
+
+def _fit_peaks(correlation, lag, rows, results):
+    # Parabola through the peak and its neighbours for the sub-bin shift and the peak width
+    index = np.arange(len(rows))
+    peak = correlation[index, lag % N_FFT]
+    before = correlation[index, (lag - 1) % N_FFT]
+    after = correlation[index, (lag + 1) % N_FFT]
+    curvature = before - 2 * peak + after
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0.0)
+        # Width of a Gaussian peak with this height and curvature, in bins
+        fwhm = 2 * np.sqrt(2 * np.log(2)) * np.sqrt(np.where(curvature < 0, peak / -curvature, 1.0))
+
+    # Tonry & Davis: r is the peak height over sqrt(2) times the rms of the antisymmetric part of the correlation
+    shifts = np.arange(1, N_FFT // 2)
+    antisymmetric = 0.5 * (np.take_along_axis(correlation, (lag[:, None] + shifts) % N_FFT, axis=1)
+                           - np.take_along_axis(correlation, (lag[:, None] - shifts) % N_FFT, axis=1))
+    # Shifts where either side has no usable overlap say nothing about the noise
+    measured = (np.take_along_axis(correlation, (lag[:, None] + shifts) % N_FFT, axis=1) != 0) \
+        & (np.take_along_axis(correlation, (lag[:, None] - shifts) % N_FFT, axis=1) != 0)
+    sigma_a = np.sqrt(np.divide((np.where(measured, antisymmetric, 0) ** 2).sum(axis=1), measured.sum(axis=1),
+                                out=np.zeros_like(peak), where=measured.any(axis=1)))
+    r_value = np.divide(peak, np.sqrt(2) * sigma_a, out=np.zeros_like(peak), where=sigma_a > 0)
+
+    redshift = np.expm1((lag + np.clip(offset, -1, 1)) * LOG_STEP)
+    results.redshift[rows] = redshift
+    results.redshift_err[rows] = (1 + redshift) * LOG_STEP * 3 * fwhm / (8 * (1 + r_value))
+    results.r_value[rows] = r_value
+
+
+# Template bank of a worker process, set once by the pool initializer
+_worker_bank = None
+
+
+def init_redshift_worker(bank):
+    '''Process pool initializer: keeps the bank in the worker, so tasks only carry spectra.'''
+    global _worker_bank
+    _worker_bank = bank
+
+
+def estimate_batch(wavelengths, fluxes, z_min=Z_MIN, z_max=Z_MAX):
+    '''``estimate_redshifts`` against the bank given to ``init_redshift_worker``.'''
+    return estimate_redshifts(_worker_bank, wavelengths, fluxes, z_min, z_max)
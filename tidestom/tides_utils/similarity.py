@@ -0,0 +1,366 @@
+"""
+Spectral similarity search ("more like this"). A spectrum with a reliable redshift becomes a short feature vector: it
+is moved to the rest frame, resampled and flattened as by the redshift and classifier engines, cut to the rest-frame
+range that most spectra cover and averaged into coarser bins, then projected onto principal components fitted to the
+archive. Bins a spectrum does not cover take the archive mean, so they do not count. Vectors have unit length, so the
+cosine similarity of two spectra is the dot product of their vectors.
+
+The index lives on disk, in a generation directory under ``settings.SIMILARITY_INDEX_DIR`` named by the ``current``
+file: the model (mean, components and the centroids of an inverted file) in an ``.npz`` file, and append-only arrays
+of vectors, datum ids, the redshifts they were computed with and nearest centroids. New spectra are appended without
+refitting, and a search only compares the query with the vectors of its ``N_PROBE`` nearest centroids, read through
+memory maps. A spectrum whose redshift changed, or that no longer has a reliable one, is appended again, and only the
+latest row of each datum is searched; superseded rows take up disk space until the next rebuild. A rebuild fills a
+new generation and then switches ``current`` to it, so readers never see a half-built index.
+"""
+import fcntl
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import RedshiftEstimate
+from tidestom.tides_utils.redshift import LOG_GRID, MIN_R_VALUE, flatten, log_rebin
+from tidestom.tides_utils.spectrum_store import load_spectra
+
+REST_WAVELENGTH_MIN = 3000.0  # Angstrom
+REST_WAVELENGTH_MAX = 7500.0
+# Neighbouring bins of the redshift grid averaged into one feature
+BIN_FACTOR = 4
+FEATURE_BINS = np.flatnonzero((LOG_GRID >= np.log(REST_WAVELENGTH_MIN)) & (LOG_GRID < np.log(REST_WAVELENGTH_MAX)))
+FEATURE_BINS = FEATURE_BINS[:len(FEATURE_BINS) // BIN_FACTOR * BIN_FACTOR]
+N_FEATURES = len(FEATURE_BINS) // BIN_FACTOR
+N_COMPONENTS = 32
+# Inverted file lists: about the square root of the number of spectra fitted, at most MAX_LISTS
+MAX_LISTS = 1024
+N_PROBE = 8
+KMEANS_ITERATIONS = 20
+# Spectra sampled to fit the components and centroids
+FIT_SAMPLE = 20000
+
+CURRENT_FILE = 'current'
+MODEL_FILE = 'model.npz'
+LOCK_FILE = 'lock'
+# Row arrays: file name, dtype. The datum ids are written last, so their length is the number of complete rows
+ARRAY_FILES = {
+    'vectors': ('vectors.f4', np.float32),
+    'lists': ('lists.i4', np.int32),
+    'redshifts': ('redshifts.f8', np.float64),
+    'datums': ('datums.i8', np.int64),
+}
+# List of the rows that are never searched: spectra that cover none of the features, and removed ones
+NO_LIST = -1
+
+
+def feature_matrix(wavelengths, fluxes, redshifts):
+    '''
+    Rest-frame features of a batch of spectra, as an (n spectra, ``N_FEATURES``) array, with a mask of the features
+    that each spectrum covers for at least half of their bins.
+    '''
+    rebinned = np.array([log_rebin(np.asarray(wavelength, dtype=float) / (1 + redshift), flux)
+                         for wavelength, flux, redshift in zip(wavelengths, fluxes, redshifts)])
+    rebinned = rebinned.reshape(-1, len(LOG_GRID))
+    flat = flatten(rebinned)[:, FEATURE_BINS].reshape(len(rebinned), N_FEATURES, BIN_FACTOR)
+    counts = np.isfinite(rebinned[:, FEATURE_BINS]).reshape(len(rebinned), N_FEATURES, BIN_FACTOR).sum(axis=2)
+    # Uncovered bins are zero after flattening, so the sum is over the covered ones
+    features = np.divide(flat.sum(axis=2), counts, out=np.zeros(counts.shape), where=counts > 0)
+    return features.astype(np.float32), counts >= BIN_FACTOR / 2
+
+
+def _unit_rows(matrix):
+    norm = np.sqrt((matrix ** 2).sum(axis=1, keepdims=True))
+    return np.divide(matrix, norm, out=np.zeros_like(matrix), where=norm > 0)
+
+
+def project(mean, components, features, covered):
+    '''Unit feature vectors of spectra; rows that cover none of the features are zero.'''
+    return _unit_rows(np.where(covered, features - mean, 0) @ components.T).astype(np.float32)
+
+
+def fit_model(features, covered, n_components=N_COMPONENTS, n_lists=None, seed=0):
+    '''
+    Fits the principal components of a sample of features, and the centroids of the inverted file lists with
+    spherical k-means on the sample's vectors.
+
+    :returns: mean features, components and centroids
+    '''
+    counts = covered.sum(axis=0)
+    mean = np.divide(np.where(covered, features, 0).sum(axis=0), counts, out=np.zeros(features.shape[1]),
+                     where=counts > 0)
+    _, _, components = np.linalg.svd(np.where(covered, features - mean, 0), full_matrices=False)
+    components = components[:n_components]
+    vectors = project(mean, components, features, covered)
+    vectors = vectors[vectors.any(axis=1)]
+    if not len(vectors):
+        raise ValueError('None of the spectra cover the rest-frame feature range')
+    if n_lists is None:
+        n_lists = int(np.sqrt(len(vectors)))
+    n_lists = int(np.clip(n_lists, 1, min(MAX_LISTS, len(vectors))))
+
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = (vectors @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        # An emptied list keeps its centroid
+        centroids = np.where(sums.any(axis=1, keepdims=True), _unit_rows(sums), centroids)
+    return mean.astype(np.float32), components.astype(np.float32), centroids.astype(np.float32)
+
+
+class SimilarityIndex:
+    """
+    One generation of the on-disk index. ``add`` appends rows under a file lock; readers map the rows whose datum id
+    has been written, and ``refresh`` maps any rows appended since, by this or another process. The latest row of
+    each datum supersedes any earlier ones.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with np.load(self.path / MODEL_FILE) as model:
+            self.mean = model['mean']
+            self.components = model['components']
+            self.centroids = model['centroids']
+        self.refresh()
+
+    @classmethod
+    def create(cls, directory, mean, components, centroids):
+        '''A new, empty and unpublished generation under ``directory``.'''
+        path = Path(directory) / f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}'
+        path.mkdir(parents=True)
+        np.savez(path / MODEL_FILE, mean=mean, components=components, centroids=centroids)
+        for file_name, _ in ARRAY_FILES.values():
+            (path / file_name).touch()
+        return cls(path)
+
+    def publish(self):
+        '''Makes this generation the current one and removes the others.'''
+        directory = self.path.parent
+        pointer = directory / f'{CURRENT_FILE}.{os.getpid()}'
+        pointer.write_text(self.path.name)
+        os.replace(pointer, directory / CURRENT_FILE)
+        for path in directory.iterdir():
+            if path.is_dir() and path != self.path:
+                # Readers that still map the old files keep them until they refresh
+                shutil.rmtree(path, ignore_errors=True)
+
+    def discard(self):
+        '''Removes an unpublished generation, such as one whose build failed.'''
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __len__(self):
+        '''Number of searchable spectra.'''
+        return sum(len(rows) for rows in self.list_rows)
+
+    @property
+    def dimensions(self):
+        return len(self.components)
+
+    def _row_count(self):
+        return min((self.path / file_name).stat().st_size // (np.dtype(dtype).itemsize * self._width(name))
+                   for name, (file_name, dtype) in ARRAY_FILES.items())
+
+    def _width(self, name):
+        return self.dimensions if name == 'vectors' else 1
+
+    def _map(self, name, n_rows):
+        file_name, dtype = ARRAY_FILES[name]
+        shape = (n_rows, self.dimensions) if name == 'vectors' else (n_rows,)
+        if not n_rows:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path / file_name, dtype=dtype, mode='r', shape=shape)
+
+    def refresh(self):
+        '''
+        Maps the complete rows on disk, finds the latest row of each datum, sorted by datum id for lookups, and groups
+        the searchable ones by inverted file list.
+        '''
+        self.n_rows = self._row_count()
+        self.vectors = self._map('vectors', self.n_rows)
+        self.datum_ids = self._map('datums', self.n_rows)
+        self.redshifts = self._map('redshifts', self.n_rows)
+        self.lists = np.asarray(self._map('lists', self.n_rows))
+        order = np.argsort(self.datum_ids, kind='stable')
+        sorted_ids = np.asarray(self.datum_ids[order])
+        latest = np.r_[sorted_ids[1:] != sorted_ids[:-1], True] if len(sorted_ids) else np.zeros(0, dtype=bool)
+        self.latest_ids = sorted_ids[latest]
+        self.latest_rows = order[latest]
+        rows = np.sort(self.latest_rows[self.lists[self.latest_rows] != NO_LIST])
+        order = rows[np.argsort(self.lists[rows], kind='stable')]
+        self.list_rows = np.split(order, np.searchsorted(self.lists[order], np.arange(1, len(self.centroids))))
+
+    def latest_redshifts(self):
+        '''The indexed datum ids, sorted, and the redshift of the latest row of each; NaN for removed spectra.'''
+        return self.latest_ids, np.asarray(self.redshifts[self.latest_rows])
+
+    def add(self, datum_ids, vectors, redshifts):
+        '''
+        Appends vectors, with the ids of their datums and the redshifts they were computed with, to their nearest
+        inverted file lists, superseding any earlier rows of those datums. Zero vectors are kept out of the lists.
+        '''
+        if not len(datum_ids):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rows = {
+            'vectors': vectors,
+            'lists': np.where(vectors.any(axis=1), (vectors @ self.centroids.T).argmax(axis=1), NO_LIST),
+            'redshifts': np.asarray(redshifts),
+            'datums': np.asarray(datum_ids),
+        }
+        with open(self.path / LOCK_FILE, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Rows left incomplete by an interrupted append are dropped first
+            n_rows = self._row_count()
+            for name, (file_name, dtype) in ARRAY_FILES.items():
+                with open(self.path / file_name, 'r+b') as file:
+                    file.truncate(n_rows * np.dtype(dtype).itemsize * self._width(name))
+                    file.seek(0, os.SEEK_END)
+                    file.write(np.ascontiguousarray(rows[name], dtype=dtype).tobytes())
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def vector_of(self, datum_id):
+        '''The vector of a datum from its latest row, or None if it is not indexed or not searchable.'''
+        position = np.searchsorted(self.latest_ids, datum_id)
+        if position == len(self.latest_ids) or self.latest_ids[position] != datum_id:
+            return None
+        row = self.latest_rows[position]
+        return np.array(self.vectors[row]) if self.lists[row] != NO_LIST else None
+
+    def search(self, vector, k, n_probe=N_PROBE):
+        '''
+        The ``k`` indexed vectors most similar to ``vector`` among those of its ``n_probe`` nearest inverted file
+        lists.
+
+        :returns: datum ids and cosine similarities, most similar first
+        '''
+        probed = np.argsort(self.centroids @ vector)[::-1][:n_probe]
+        rows = np.sort(np.concatenate([self.list_rows[index] for index in probed]))
+        similarity = self.vectors[rows] @ vector
+        if len(rows) > k:
+            top = np.argpartition(-similarity, k)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-similarity[top], kind='stable')]
+        return np.asarray(self.datum_ids[rows[top]]), similarity[top]
+
+
+def index_directory():
+    return Path(settings.SIMILARITY_INDEX_DIR)
+
+
+def open_index(directory=None):
+    '''
+    The current generation of the index, or None if none has been built, or if it was written by a version of this
+    module with other row arrays and needs rebuilding.
+    '''
+    directory = Path(directory or index_directory())
+    try:
+        generation = (directory / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+    if not all((directory / generation / file_name).exists() for file_name, _ in ARRAY_FILES.values()):
+        return None
+    return SimilarityIndex(directory / generation)
+
+
+# Index of this process, reused across requests while it is the current generation
+_cached_index = None
+
+
+def current_index():
+    '''
+    ``open_index`` for request handlers: the index is mapped once per process and refreshed when rows are appended
+    or another generation is published.
+    '''
+    global _cached_index
+    try:
+        generation = (index_directory() / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+    if _cached_index is None or _cached_index.path.name != generation:
+        _cached_index = open_index()
+    elif _cached_index._row_count() != _cached_index.n_rows:
+        _cached_index.refresh()
+    return _cached_index
+
+
+def reliable_estimates(min_r=MIN_R_VALUE):
+    '''Redshift estimates of spectra that are trusted enough to move them to the rest frame.'''
+    return RedshiftEstimate.objects.filter(r_value__gte=min_r, reduced_datum__data_type='spectroscopy')
+
+
+def spectrum_features(redshifts):
+    '''
+    Features of the spectra whose datum ids key ``redshifts``.
+
+    :returns: datum ids, features and coverage masks, in the order the spectra were loaded
+    '''
+    datums = ReducedDatum.objects.filter(id__in=list(redshifts)).only('id', 'value')
+    spectra = load_spectra(datums)
+    features, covered = feature_matrix([wavelength for _, wavelength, _ in spectra],
+                                       [flux for _, _, flux in spectra],
+                                       [redshifts[datum.id] for datum, _, _ in spectra])
+    return np.array([datum.id for datum, _, _ in spectra], dtype=np.int64), features, covered
+
+
+def fit_index(estimates, directory=None, sample_size=FIT_SAMPLE, batch_size=2000, n_components=N_COMPONENTS,
+              n_lists=None, seed=0):
+    '''A new, empty generation with its model fitted to a random sample of the spectra of ``estimates``.'''
+    redshifts = dict(estimates.values_list('reduced_datum_id', 'redshift').iterator())
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(np.fromiter(redshifts, dtype=np.int64), min(sample_size, len(redshifts)), replace=False)
+    features, covered = [], []
+    for start in range(0, len(sample), batch_size):
+        _, batch_features, batch_covered = spectrum_features(
+            {int(datum_id): redshifts[datum_id] for datum_id in sample[start:start + batch_size]})
+        features.append(batch_features)
+        covered.append(batch_covered)
+    if not features:
+        raise ValueError('There are no spectra with a reliable redshift to fit the index to')
+    model = fit_model(np.concatenate(features), np.concatenate(covered), n_components, n_lists, seed)
+    return SimilarityIndex.create(directory or index_directory(), *model)
+
+
+def index_spectra(index, estimates, batch_size=2000, progress=None):
+    '''
+    Brings the index up to date with ``estimates``, in batches read with keyset pagination: adds the spectra that are
+    not indexed yet, adds again those whose redshift changed, e.g. after ``estimate_redshifts --force``, and appends a
+    removal row for indexed spectra that no longer have an estimate, e.g. as they were reprocessed into new datums.
+    ``progress`` is called with the running count after each batch.
+
+    :returns: number of spectra added or updated
+    '''
+    indexed_ids, indexed_redshifts = index.latest_redshifts()
+    seen = []
+    n_added = 0
+    last_id = 0
+    while True:
+        batch = list(estimates.filter(reduced_datum_id__gt=last_id).order_by('reduced_datum_id').values_list(
+            'reduced_datum_id', 'redshift')[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        datum_ids = np.array([datum_id for datum_id, _ in batch], dtype=np.int64)
+        redshifts = np.array([redshift for _, redshift in batch], dtype=np.float64)
+        seen.append(datum_ids)
+        position = np.minimum(np.searchsorted(indexed_ids, datum_ids), max(len(indexed_ids) - 1, 0))
+        current = (indexed_ids[position] == datum_ids) & (indexed_redshifts[position] == redshifts) \
+            if len(indexed_ids) else np.zeros(len(datum_ids), dtype=bool)
+        if current.all():
+            continue
+        todo = dict(zip(datum_ids[~current].tolist(), redshifts[~current].tolist()))
+        datum_ids, features, covered = spectrum_features(todo)
+        vectors = project(index.mean, index.components, features, covered)
+        # Spectra that cover none of the features are recorded too, so they are not read again until they change
+        index.add(datum_ids, vectors, [todo[datum_id] for datum_id in datum_ids.tolist()])
+        n_added += int(vectors.any(axis=1).sum())
+        if progress is not None:
+            progress(n_added)
+
+    seen = np.concatenate(seen) if seen else np.zeros(0, dtype=np.int64)
+    removed = indexed_ids[~np.isnan(indexed_redshifts) & ~np.isin(indexed_ids, seen)]
+    index.add(removed, np.zeros((len(removed), index.dimensions), dtype=np.float32), np.full(len(removed), np.nan))
+    return n_added
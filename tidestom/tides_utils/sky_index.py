@@ -0,0 +1,111 @@
+"""
+Integer sky cells for indexed positional queries on targets. The sky is cut into declination zones of
+``ZONE_HEIGHT`` degrees, each split into ``N_RA_CELLS`` equal cells of right ascension, and ``TidesTarget.sky_cell``
+holds the number of the cell a target falls in. A cone maps to one contiguous range of cells per zone it touches, so
+a cone search is a few indexed range scans followed by an exact separation test on the candidates. Only NumPy is
+needed, so this module can be imported from models and worker processes alike.
+"""
+import numpy as np
+
+ZONE_HEIGHT = 0.1  # degrees
+N_ZONES = int(round(180 / ZONE_HEIGHT))
+N_RA_CELLS = 3600
+RA_CELL_WIDTH = 360 / N_RA_CELLS
+
+
+def _zone(dec):
+    return np.clip(np.floor((np.asarray(dec, dtype=float) + 90) / ZONE_HEIGHT), 0, N_ZONES - 1).astype(np.int64)
+
+
+def sky_cells(ra, dec):
+    '''Sky cells of the positions given in degrees, as an int64 array (or scalar for scalar input).'''
+    ra_cell = np.clip(np.floor(np.mod(np.asarray(ra, dtype=float), 360) / RA_CELL_WIDTH), 0, N_RA_CELLS - 1)
+    cells = _zone(dec) * N_RA_CELLS + ra_cell.astype(np.int64)
+    return cells if np.ndim(cells) else int(cells)
+
+
+def sky_cell(ra, dec):
+    '''The sky cell of a target, or None if it has no position (non-sidereal targets).'''
+    if ra is None or dec is None or not -90 <= dec <= 90:
+        return None
+    return sky_cells(ra, dec)
+
+
+def cone_cell_ranges(ra, dec, radius):
+    '''
+    Inclusive ranges of sky cells that together cover the cone of ``radius`` degrees around ``(ra, dec)``. Every zone
+    gets the widest right ascension extent of the circle, so the ranges always hold every target in the cone.
+    '''
+    ra = ra % 360
+    if abs(dec) + radius >= 90:
+        half_width = 180.0
+    else:
+        # Largest right ascension offset on a small circle (Gray et al. 2006, the "zones" algorithm)
+        half_width = np.degrees(np.arctan(np.sin(np.radians(radius)) / np.sqrt(abs(
+            np.cos(np.radians(dec - radius)) * np.cos(np.radians(dec + radius))))))
+    if half_width >= 180 - RA_CELL_WIDTH:
+        ra_ranges = [(0, N_RA_CELLS - 1)]
+    else:
+        first = int(np.floor((ra - half_width) / RA_CELL_WIDTH))
+        last = int(np.floor((ra + half_width) / RA_CELL_WIDTH))
+        if first < 0:
+            ra_ranges = [(first + N_RA_CELLS, N_RA_CELLS - 1), (0, last)]
+        elif last >= N_RA_CELLS:
+            ra_ranges = [(first, N_RA_CELLS - 1), (0, last - N_RA_CELLS)]
+        else:
+            ra_ranges = [(first, last)]
+    return [(zone * N_RA_CELLS + first, zone * N_RA_CELLS + last)
+            for zone in range(int(_zone(dec - radius)), int(_zone(dec + radius)) + 1)
+            for first, last in ra_ranges]
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    '''Great-circle distance in degrees, with the haversine formula, which stays accurate at arcsecond scales.'''
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(value, dtype=float)) for value in (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+class PositionIndex:
+    """
+    In-memory positional lookup for ingestion: the targets, loaded once, grouped by sky cell. A duplicate check is a
+    dict lookup for the few cells around a position and a separation test on their targets, whatever the size of
+    the catalogue. Positions added during the run are found as well.
+    """
+
+    def __init__(self, positions=()):
+        self.cells = {}
+        positions = [(key, ra, dec) for key, ra, dec in positions
+                     if ra is not None and dec is not None and -90 <= dec <= 90]
+        if not positions:
+            return
+        keys, ras, decs = zip(*positions)
+        for cell, key, ra, dec in zip(sky_cells(ras, decs).tolist(), keys, ras, decs):
+            self.cells.setdefault(cell, []).append((key, ra, dec))
+
+    def add(self, target_id, ra, dec):
+        cell = sky_cell(ra, dec)
+        if cell is not None:
+            self.cells.setdefault(cell, []).append((target_id, ra, dec))
+
+    def nearest(self, ra, dec, radius):
+        '''
+        The closest target within ``radius`` degrees of the position.
+
+        :returns: ``(target_id, separation)``, or None
+        '''
+        if sky_cell(ra, dec) is None:
+            return None
+        candidates = [entry for first, last in cone_cell_ranges(ra, dec, radius)
+                      for cell in self._cells_between(first, last) for entry in self.cells[cell]]
+        if not candidates:
+            return None
+        target_ids, ras, decs = zip(*candidates)
+        separations = angular_separation(ra, dec, ras, decs)
+        best = int(np.argmin(separations))
+        return (target_ids[best], float(separations[best])) if separations[best] <= radius else None
+
+    def _cells_between(self, first, last):
+        if last - first > len(self.cells):
+            return [cell for cell in self.cells if first <= cell <= last]
+        return [cell for cell in range(first, last + 1) if cell in self.cells]
@@ -0,0 +1,53 @@
+from collections import namedtuple
+import numpy as np
+from astropy.io import fits
+
+# Binary table columns read by default; ERR and the mask are read only when asked for
+SPECTRUM_COLUMNS = ('WAVE', 'FLUX')
+# Small per-row columns of multi-fibre/multi-epoch L1 files, always read when present
+ROW_COLUMNS = ('MJD_OBS', 'MJD', 'OBJECT', 'OBJ_NAME', 'NAME', 'TARGNAME')
+ARRAY_COLUMNS = ('WAVE', 'FLUX', 'ERR_FLUX', 'ERR', 'QUAL', 'MASK')
+
+SpectrumArrays = namedtuple('SpectrumArrays', ['wave', 'flux', 'err', 'mask', 'header', 'primary_header', 'rows',
+                                               'units'])
+SpectrumArrays.__doc__ = '''
+Columns of a spectrum file as 2D (row, pixel) arrays. ``err`` and ``mask`` are None unless they were requested and
+present in the file. ``rows`` holds the per-row columns in ``ROW_COLUMNS`` that the file has, and ``units`` the
+TUNIT of each column read.
+'''
+
+
+def read_spectrum(spectrum_file_path, columns=SPECTRUM_COLUMNS, rows=None, ext=1):
+    '''
+    Reads the spectrum columns of a FITS binary table with a single memory-mapped open. Only the requested columns
+    (and ``rows``, a slice or index array, if given) are copied out of the map, so the rest of a large L1 file is
+    never paged in. The result can be handed to both the plotter and the data processor.
+    '''
+    with fits.open(spectrum_file_path, memmap=True) as hdul:
+        hdu = hdul[ext]
+        names = [name.upper() for name in hdu.columns.names]
+        arrays = {}
+        row_columns = {}
+        units = {}
+        for column in tuple(columns) + ROW_COLUMNS:
+            if column.upper() not in names or column.upper() in arrays or column.upper() in row_columns:
+                continue
+            field = hdu.data.field(column)
+            values = np.array(field if rows is None else field[rows])
+            if column.upper() in ARRAY_COLUMNS:
+                arrays[column.upper()] = np.atleast_2d(values)
+            else:
+                row_columns[column.upper()] = np.atleast_1d(values)
+            units[column.upper()] = hdu.columns[names.index(column.upper())].unit
+        header = hdu.header.copy()
+        primary_header = hdul[0].header.copy()
+    return SpectrumArrays(
+        wave=arrays['WAVE'],
+        flux=arrays['FLUX'],
+        err=arrays.get('ERR_FLUX', arrays.get('ERR')),
+        mask=arrays.get('QUAL', arrays.get('MASK')),
+        header=header,
+        primary_header=primary_header,
+        rows=row_columns,
+        units=units,
+    )
@@ -0,0 +1,171 @@
+import hashlib
+import numpy as np
+from custom_code.models import SpectrumData, SpectrumLevel
+
+STORE_DTYPE = SpectrumData.DTYPE
+# Bins of the precomputed levels of detail; a level is only kept when it is at most a quarter of the full spectrum
+LOD_BINS = (512, 2048, 8192)
+# Bins of the min/max decimated copy of the arrays kept in the JSON value, for TOM code that reads it
+VALUE_BINS = 512
+
+
+def is_binary_value(value):
+    '''True for a ReducedDatum value whose arrays live in ``SpectrumData`` rather than in the JSON.'''
+    return isinstance(value, dict) and value.get('storage') == 'float32'
+
+
+def serialize_spectrum(wavelength, flux, wavelength_units, flux_units):
+    '''
+    Fast replacement for ``SpectrumSerializer().serialize``: builds the spectrum value straight from the NumPy arrays
+    and the declared unit strings, without constructing Quantities or a Spectrum1D. The arrays are kept as they are
+    until ``pack_spectrum`` writes them out; use ``json_spectrum_value`` where a JSON value is needed.
+    '''
+    return {'wavelength': wavelength, 'wavelength_units': wavelength_units, 'flux': flux, 'flux_units': flux_units}
+
+
+def json_spectrum_value(value):
+    '''The JSON form of a value from ``serialize_spectrum``, as ``SpectrumSerializer`` would have stored it.'''
+    return dict(value, wavelength=np.asarray(value['wavelength']).tolist(), flux=np.asarray(value['flux']).tolist())
+
+
+def pack_spectrum(value):
+    '''
+    Splits a serialized spectrum (``wavelength`` and ``flux`` as lists or arrays, plus units) into the JSON value kept
+    on the ReducedDatum and the float32 bytes for ``SpectrumData``. The JSON value keeps the arrays min/max decimated
+    to ``VALUE_BINS`` in TOM's ``SpectrumSerializer`` layout, so TOM's data sharing, REST API and spectroscopy tags
+    still read a spectrum from it, and the digest of the full arrays, so datums can be compared by value to skip
+    duplicates.
+
+    :returns: ``(value, (wavelength bytes, flux bytes))``
+    '''
+    wavelength = np.ascontiguousarray(value['wavelength'], dtype=STORE_DTYPE)
+    flux = np.ascontiguousarray(value['flux'], dtype=STORE_DTYPE)
+    value_wavelength, value_flux = decimate_minmax(wavelength, flux, VALUE_BINS)
+    wavelength, flux = wavelength.tobytes(), flux.tobytes()
+    stored = {
+        'storage': 'float32',
+        'n_pixels': len(flux) // STORE_DTYPE.itemsize,
+        'digest': hashlib.sha256(wavelength + flux).hexdigest(),
+        'wavelength': value_wavelength.tolist(),
+        'wavelength_units': value.get('wavelength_units'),
+        'flux': value_flux.tolist(),
+        'flux_units': value.get('flux_units'),
+    }
+    return stored, (wavelength, flux)
+
+
+def decimate_minmax(wavelength, flux, n_bins):
+    '''
+    Min/max decimation: splits the spectrum into ``n_bins`` runs of equal numbers of pixels and keeps, in order, the
+    pixels with the lowest and highest finite flux of each run. Unlike averaging or striding this never loses a narrow
+    line, and plotted ``n_bins`` pixels wide it is indistinguishable from the full spectrum.
+
+    :returns: ``(wavelength, flux)`` with at most ``2 * n_bins`` pixels
+    '''
+    wavelength = np.asarray(wavelength)
+    flux = np.asarray(flux)
+    n_pixels = len(flux)
+    if n_pixels <= 2 * n_bins:
+        return wavelength, flux
+    run = -(-n_pixels // n_bins)
+    n_bins = -(-n_pixels // run)
+    # The last run is padded with values that are never picked, as are NaNs unless a run has nothing else
+    finite = np.isfinite(flux)
+    low = np.full(n_bins * run, np.inf)
+    low[:n_pixels] = np.where(finite, flux, np.inf)
+    high = np.full(n_bins * run, -np.inf)
+    high[:n_pixels] = np.where(finite, flux, -np.inf)
+    offsets = np.arange(n_bins) * run
+    index = np.sort(np.stack([low.reshape(n_bins, run).argmin(axis=1) + offsets,
+                              high.reshape(n_bins, run).argmax(axis=1) + offsets], axis=1), axis=1).ravel()
+    index = index[np.r_[True, index[1:] != index[:-1]]]
+    return wavelength[index], flux[index]
+
+
+def spectrum_levels(reduced_datum_id, wavelength, flux):
+    '''The ``SpectrumLevel`` rows of the level-of-detail pyramid of a spectrum, from its packed float32 bytes.'''
+    wavelength = np.frombuffer(wavelength, dtype=STORE_DTYPE)
+    flux = np.frombuffer(flux, dtype=STORE_DTYPE)
+    levels = []
+    for n_bins in LOD_BINS:
+        if 4 * n_bins > len(flux):
+            break
+        level_wavelength, level_flux = decimate_minmax(wavelength, flux, n_bins)
+        levels.append(SpectrumLevel(spectrum_id=reduced_datum_id, n_bins=n_bins,
+                                    wavelength=level_wavelength.tobytes(), flux=level_flux.tobytes()))
+    return levels
+
+
+def save_spectrum_arrays(reduced_datums, arrays):
+    '''Stores the packed arrays of newly created ReducedDatums, and their levels of detail, with two bulk inserts.'''
+    SpectrumData.objects.bulk_create([
+        SpectrumData(reduced_datum_id=datum.id, wavelength=wavelength, flux=flux)
+        for datum, (wavelength, flux) in zip(reduced_datums, arrays)
+    ])
+    SpectrumLevel.objects.bulk_create([
+        level for datum, (wavelength, flux) in zip(reduced_datums, arrays)
+        for level in spectrum_levels(datum.id, wavelength, flux)
+    ])
+
+
+def load_spectra(datums):
+    '''
+    Loads the wavelength and flux arrays of spectroscopic ReducedDatums. Binary datums are read with one query for the
+    whole list, as read-only float32 views of the stored bytes; datums still holding JSON lists, or binary datums
+    whose arrays are not stored yet, are converted from the lists in their value.
+
+    :returns: list of ``(datum, wavelength, flux)`` tuples
+    '''
+    datums = list(datums)
+    stored = SpectrumData.objects.in_bulk([datum.id for datum in datums if is_binary_value(datum.value)])
+    spectra = []
+    for datum in datums:
+        if datum.id in stored:
+            spectrum_data = stored[datum.id]
+            spectra.append((datum, spectrum_data.wavelength_array, spectrum_data.flux_array))
+        elif 'flux' in datum.value:
+            spectra.append((datum, np.asarray(datum.value['wavelength'], dtype=float),
+                            np.asarray(datum.value['flux'], dtype=float)))
+    return spectra
+
+
+def _window(wavelength, wavelength_min, wavelength_max):
+    # Index range of the pixels in the window, plus one on each side so lines run to the edges of the plot
+    start = 0 if wavelength_min is None else max(int(np.searchsorted(wavelength, wavelength_min)) - 1, 0)
+    stop = len(wavelength) if wavelength_max is None else int(np.searchsorted(wavelength, wavelength_max, 'right')) + 1
+    return start, stop
+
+
+def load_spectrum_window(datum, wavelength_min=None, wavelength_max=None, width=None):
+    '''
+    The part of a spectrum between ``wavelength_min`` and ``wavelength_max`` (either may be None) at the resolution a
+    plot ``width`` pixels wide needs: the coarsest precomputed level with at least ``width`` bins in the window, or
+    else the full spectrum, still min/max decimated to ``width`` bins when it has many more pixels than that. Without
+    a ``width`` the full spectrum is returned. Coarse views never read the full arrays from the database.
+
+    :returns: ``(level, wavelength, flux)``, where ``level`` is the number of bins of the level used, or None for the
+        full spectrum
+    '''
+    if width:
+        for level in SpectrumLevel.objects.filter(spectrum_id=datum.id).order_by('n_bins'):
+            wavelength = level.wavelength_array
+            start, stop = _window(wavelength, wavelength_min, wavelength_max)
+            if stop - start >= 2 * width:
+                return level.n_bins, wavelength[start:stop], level.flux_array[start:stop]
+    _, wavelength, flux = load_spectra([datum])[0]
+    start, stop = _window(wavelength, wavelength_min, wavelength_max)
+    wavelength, flux = wavelength[start:stop], flux[start:stop]
+    if width and len(flux) > 4 * width:
+        wavelength, flux = decimate_minmax(wavelength, flux, width)
+    return None, wavelength, flux
+
+
+def to_spectrum1d(wavelength, flux, value):
+    '''
+    Builds a ``Spectrum1D`` from arrays given by ``load_spectra`` and the units in the datum ``value``, for analysis code
+    that needs one. Plotting and ingestion work on the plain arrays and never pay for this.
+    '''
+    from astropy import units as u
+    from specutils import Spectrum1D
+    return Spectrum1D(flux=np.asarray(flux) * u.Unit(value['flux_units']),
+                      spectral_axis=np.asarray(wavelength) * u.Unit(value['wavelength_units']))
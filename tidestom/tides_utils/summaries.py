@@ -0,0 +1,62 @@
+from django.db.models import Count, Max
+from guardian.shortcuts import get_objects_for_user
+from tom_dataproducts.models import ReducedDatum
+from tom_targets.models import Target
+from custom_code.models import TargetSummary
+from tidestom.tides_utils.cache_utils import invalidate_latest_targets, invalidate_targets
+
+SUMMARY_FIELDS = ['name', 'created', 'n_spectra', 'latest_spectrum', 'thumbnail_version', 'auto_tidesclass',
+                  'auto_tidesclass_subclass', 'auto_tidesclass_prob', 'human_tidesclass', 'n_human_submissions']
+
+
+def refresh_target_summaries(target_ids):
+    '''
+    Recomputes the ``TargetSummary`` rows of the given targets from the source tables: one query each for the
+    targets, with their materialized human consensus, and their spectra, then one upsert. Called with the targets
+    touched by an ingestion batch, a thumbnail render or a classification submission, and in batches by the rebuild
+    command. As every change to what a target shows passes through here, it also invalidates the cached fragments of
+    their detail pages, and the cached Latest pages if any summary changed.
+    '''
+    target_ids = list(target_ids)
+    if not target_ids:
+        return
+    invalidate_targets(target_ids)
+    spectra = {
+        row['target_id']: row for row in
+        ReducedDatum.objects.filter(target_id__in=target_ids, data_type='spectroscopy')
+        .values('target_id').annotate(n_spectra=Count('id'), latest_spectrum=Max('timestamp'))
+    }
+    previous = {row[0]: row[1:] for row in TargetSummary.objects.filter(target_id__in=target_ids).values_list(
+        'target_id', *SUMMARY_FIELDS)}
+    summaries = []
+    for target in Target.objects.filter(id__in=target_ids).values(
+            'id', 'name', 'created', 'auto_tidesclass', 'auto_tidesclass_subclass__sub_class', 'auto_tidesclass_prob',
+            'spectrum_thumbnail__version', 'human_tidesclass', 'human_tidesclass_count'):
+        target_spectra = spectra.get(target['id'], {})
+        summaries.append(TargetSummary(
+            target_id=target['id'],
+            name=target['name'],
+            created=target['created'],
+            n_spectra=target_spectra.get('n_spectra', 0),
+            latest_spectrum=target_spectra.get('latest_spectrum'),
+            thumbnail_version=target['spectrum_thumbnail__version'] or '',
+            auto_tidesclass=target['auto_tidesclass'],
+            auto_tidesclass_subclass=target['auto_tidesclass_subclass__sub_class'],
+            auto_tidesclass_prob=target['auto_tidesclass_prob'],
+            human_tidesclass=target['human_tidesclass'],
+            n_human_submissions=target['human_tidesclass_count'],
+        ))
+    TargetSummary.objects.bulk_create(summaries, update_conflicts=True, unique_fields=['target'],
+                                      update_fields=SUMMARY_FIELDS + ['updated'])
+    if any(previous.get(summary.target_id) != tuple(getattr(summary, field) for field in SUMMARY_FIELDS)
+           for summary in summaries):
+        invalidate_latest_targets()
+
+
+def visible_summaries(user):
+    '''The summaries of the targets ``user`` may view, as a lazy queryset to order and slice.'''
+    summaries = TargetSummary.objects.all()
+    if not user.is_superuser:
+        permitted = get_objects_for_user(user, f'{Target._meta.app_label}.view_target')
+        summaries = summaries.filter(target__in=permitted.values('pk'))
+    return summaries
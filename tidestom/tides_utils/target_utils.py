@@ -1,14 +1,30 @@
 import os
+import json
+import uuid
+import hashlib
+import logging
 import matplotlib.pyplot as plt
-from astropy.io import fits
 from django.conf import settings
-from tom_targets.models import Target
-from django.core.management.base import BaseCommand
-from tom_dataproducts.models import DataProduct
-from tom_dataproducts.data_processor import run_data_processor
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from tom_targets.base_models import BaseTarget
+from tom_targets.models import Target, TargetExtra, TargetName
+from tom_targets.sharing import continuous_share_data
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from custom_code.models import SpectrumFile, HumanTidesClassSubmission
+from tidestom.tides_utils.spectrum_io import read_spectrum
+from tidestom.tides_utils.spectrum_store import is_binary_value, pack_spectrum, save_spectrum_arrays
+from tidestom.tides_utils.cache_utils import invalidate_latest_targets, invalidate_targets
+from tidestom.tides_utils.consensus import human_consensus, human_vote_rows
+from tidestom.tides_utils.sky_index import PositionIndex, sky_cell
+from tidestom.tides_utils.summaries import refresh_target_summaries
+from tidestom.tides_utils.thumbnails import render_spectrum_thumbnail, record_thumbnails
 from datetime import datetime
 from pathlib import Path  # Import pathlib
 
+logger = logging.getLogger(__name__)
+
 def generate_light_curve_plot(target):
     # Generate the light curve plot for the target
     plt.figure()
@@ -25,26 +41,24 @@ def generate_light_curve_plot(target):
     plt.savefig(plot_path)
     plt.close()
 
-def generate_spectrum_plot(target, spec_fn):
+def generate_spectrum_plot(target, spec_fn, spectrum=None):
     # Generate the spectrum plot for the target
-    f, ax = plt.subplots()
+    version = plot_spectrum(target.id, spec_fn, spectrum=spectrum)
+    if version:
+        record_thumbnails({target.id: version})
+
+def plot_spectrum(target_id, spec_fn, spectrum=None):
+    # Only needs the target id, so it can run in a worker process. Pass the arrays from read_spectrum
+    # as ``spectrum`` to avoid reading the file again. Returns the thumbnail version for record_thumbnails.
     try:
-        spec = fits.getdata(spec_fn)
-        # Example plot code
-        ax.step(spec['WAVE'][0], spec['FLUX'][0], where='mid')
-        ax.set_xlim(4000, 9300)
-    except OSError:
-        pass
-    
-    # Ensure the directory exists
-    plot_dir = Path(settings.STATICFILES_DIRS[0]) / 'plots'
-    plot_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Save the plot
-    plot_path = plot_dir / f'spectrum_{target.id}.png'
-    plt.savefig(plot_path)
-    print("Saved spectrum plot to", plot_path)
-    plt.close()
+        if spectrum is None:
+            spectrum = read_spectrum(spec_fn, rows=slice(0, 1))
+    except OSError as e:
+        logger.warning(f'Could not read {spec_fn} to plot it: {e}')
+        return None
+    version = render_spectrum_thumbnail(target_id, spectrum.wave[0], spectrum.flux[0])
+    print("Saved spectrum plot", version, "for target", target_id)
+    return version
 
 def create_target(name, other_fields, update_existing=False, generate_plots=False, spec_fn=None):
     if update_existing:
@@ -63,26 +77,404 @@ def create_target(name, other_fields, update_existing=False, generate_plots=Fals
     
     return target
 
-def add_spectrum_to_database(target, spectrum_file_path):
+def _insert_target_child_rows(target_ids, target_fields=None):
+    '''
+    Adds the custom target model's table rows for freshly bulk-created BaseTargets. Django's bulk_create refuses
+    multi-table inherited models, so the child rows are inserted directly with the fields' defaults, or the values in
+    ``target_fields`` (a list of field dicts, one per id).
+    '''
+    fields = Target._meta.local_concrete_fields
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    sql = f'INSERT INTO {connection.ops.quote_name(Target._meta.db_table)} ({columns}) VALUES ({placeholders})'
+    defaults = {field.name: field.get_db_prep_save(field.get_default(), connection)
+                for field in fields if not field.primary_key}
+    rows = []
+    for target_id, values in zip(target_ids, target_fields or [{}] * len(target_ids)):
+        rows.append([target_id if field.primary_key
+                     else field.get_db_prep_save(values[field.name], connection) if field.name in values
+                     else defaults[field.name] for field in fields])
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+def _update_target_rows(target_ids, target_fields):
+    '''
+    Writes ``target_fields`` (a list of field dicts, one per id) with one executemany per table. Much faster than
+    bulk_update, which builds a CASE expression per field and row in Python.
+    '''
+    by_table = {}
+    for field_name in sorted({field_name for fields in target_fields for field_name in fields}):
+        field = Target._meta.get_field(field_name)
+        by_table.setdefault(field.model, []).append(field)
+    with connection.cursor() as cursor:
+        for model, fields in by_table.items():
+            assignments = ', '.join(f'{connection.ops.quote_name(field.column)} = %s' for field in fields)
+            pk_column = connection.ops.quote_name(model._meta.pk.column)
+            sql = f'UPDATE {connection.ops.quote_name(model._meta.db_table)} SET {assignments} WHERE {pk_column} = %s'
+            rows = [[field.get_db_prep_save(field.to_python(values[field.name]), connection) for field in fields]
+                    + [target_id] for target_id, values in zip(target_ids, target_fields)]
+            cursor.executemany(sql, rows)
+
+def load_position_index():
+    '''A ``PositionIndex`` of the names and positions of all targets, for duplicate checks during ingestion.'''
+    return PositionIndex(Target.objects.filter(sky_cell__isnull=False).values_list('name', 'ra', 'dec').iterator())
+
+def bulk_upsert_targets(target_fields, batch_size=2000, match_radius=None):
+    '''
+    Creates or updates targets in batches, the bulk equivalent of calling ``update_or_create`` per target.
+    ``target_fields`` maps target name to a dict of BaseTarget field values. Each batch runs in its own
+    transaction with a fixed number of queries. Unlike ``Target.save`` no ``target_post_save`` hook is run.
+
+    A new name that is already an alias, or whose position is within ``match_radius`` arcseconds (by default
+    ``TARGET_MATCH_RADIUS``) of a target, is the same object seen by another alert stream: it is added as an alias of
+    that target, which is otherwise left as it is. The positions of all targets are loaded once, so each check is a
+    lookup in memory.
+
+    :returns: number of targets created, number updated and number matched to an existing target
+    '''
+    if match_radius is None:
+        match_radius = getattr(settings, 'TARGET_MATCH_RADIUS', 0)
+    positions = load_position_index() if match_radius else None
+    names = list(target_fields)
+    n_created = n_updated = n_matched = 0
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        new_ids = {}
+        with transaction.atomic():
+            existing = dict(Target.objects.filter(name__in=batch).values_list('name', 'id'))
+            aliases = dict(TargetName.objects.filter(name__in=batch).values_list('name', 'target_id'))
+
+            # Existing targets: one parameterised UPDATE per table, executed for the whole batch
+            if existing:
+                now = timezone.now()
+                _update_target_rows(list(existing.values()),
+                                    [{**target_fields[name], 'modified': now,
+                                      'sky_cell': sky_cell(target_fields[name].get('ra'), target_fields[name].get('dec'))}
+                                     for name in existing])
+
+            # Names of other targets, given or found by position, become aliases of those targets
+            matches = {}
+            new_names = []
+            for name in batch:
+                if name in existing or name in aliases:
+                    continue
+                fields = target_fields[name]
+                match = positions.nearest(fields.get('ra'), fields.get('dec'), match_radius / 3600) if positions else None
+                if match is None:
+                    new_names.append(name)
+                    if positions:
+                        positions.add(name, fields.get('ra'), fields.get('dec'))
+                else:
+                    matches[name] = match[0]
+            if matches:
+                new_ids.update(Target.objects.filter(name__in=set(matches.values())).values_list('name', 'id'))
+
+            # New targets: BaseTarget rows first, then the matching custom target rows
+            if new_names:
+                cells = [{'sky_cell': sky_cell(target_fields[name].get('ra'), target_fields[name].get('dec'))}
+                         for name in new_names]
+                if Target._meta.parents:
+                    BaseTarget.objects.bulk_create([BaseTarget(name=name, **target_fields[name]) for name in new_names])
+                    new_ids.update(BaseTarget.objects.filter(name__in=new_names).values_list('name', 'id'))
+                    _insert_target_child_rows([new_ids[name] for name in new_names], cells)
+                else:
+                    Target.objects.bulk_create([Target(name=name, **target_fields[name], **cell)
+                                                for name, cell in zip(new_names, cells)])
+                    new_ids.update(Target.objects.filter(name__in=new_names).values_list('name', 'id'))
+                TargetExtra.objects.bulk_create([
+                    TargetExtra(target_id=new_ids[name], key=extra_field['name'], value=extra_field['default'])
+                    for name in new_names
+                    for extra_field in settings.EXTRA_FIELDS if extra_field.get('default') is not None
+                ])
+            # Matches to targets created earlier in this batch are only resolved now
+            TargetName.objects.bulk_create([TargetName(target_id=new_ids[match], name=name)
+                                            for name, match in matches.items()])
+            refresh_target_summaries(list(existing.values()) + [new_ids[name] for name in new_names])
+            if matches:
+                invalidate_targets({new_ids[match] for match in matches.values()})
+        n_created += len(new_names)
+        n_updated += len(existing)
+        n_matched += len(matches) + sum(name not in existing for name in aliases)
+    invalidate_latest_targets()
+    return n_created, n_updated, n_matched
+
+def update_human_consensus(target_ids):
+    '''
+    Recomputes the materialized human classification consensus of the given targets from their submissions with one
+    grouped query (see ``human_consensus``). Targets without submissions are reset.
+    '''
+    target_ids = list(target_ids)
+    _update_target_rows(target_ids, human_consensus(target_ids, human_vote_rows(
+        HumanTidesClassSubmission.objects.filter(target_id__in=target_ids))))
+
+def set_auto_classifications(classifications):
+    '''
+    Writes automatic classifications, a dict of target id to ``auto_tidesclass``, ``auto_tidesclass_subclass`` (an
+    id) and ``auto_tidesclass_prob``, with one executemany, and refreshes the summaries of those targets.
+    '''
+    target_ids = list(classifications)
+    _update_target_rows(target_ids, [classifications[target_id] for target_id in target_ids])
+    refresh_target_summaries(target_ids)
+
+def make_product_id(target_name):
+    '''
+    DataProduct.product_id for a new spectrum. The random suffix keeps ids unique when several
+    spectra for the same target are written within the same second.
+    '''
+    return f'{target_name}' + datetime.now().strftime('%Y%m%d%H%M%S') + f'_{uuid.uuid4().hex[:8]}'
+
+def tom_spectrum_path(spectrum_file_path, source_dir=None):
+    '''
+    Path of the link to a spectrum file under ``data/spectra``. Files delivered into a directory tree (``source_dir``)
+    keep their directory relative to it, so files with the same name in different directories get different links.
+    '''
+    filename = os.path.basename(spectrum_file_path)
+    if source_dir is not None:
+        filename = os.path.normpath(os.path.join(os.path.relpath(os.path.dirname(os.path.abspath(spectrum_file_path)),
+                                                                 os.path.abspath(source_dir)), filename))
+    if os.path.basename(spectrum_file_path).startswith('l1_obs_joined_'):
+        return os.path.join(settings.BASE_DIR,'data/spectra/test/',filename)
+    return os.path.join(settings.BASE_DIR,'data/spectra/',filename)
+
+def links_to(tom_file_path, spectrum_file_path):
+    '''Whether the link ``tom_file_path`` resolves to ``spectrum_file_path``, not another file of the same name.'''
+    return os.path.realpath(tom_file_path) == os.path.realpath(spectrum_file_path)
+
+def link_spectrum(spectrum_file_path, source_dir=None):
+    tom_file_path = tom_spectrum_path(spectrum_file_path, source_dir)
+    os.makedirs(os.path.dirname(tom_file_path), exist_ok=True)
+    if not os.path.isfile(tom_file_path):
+        try:
+            os.symlink(spectrum_file_path,tom_file_path)
+        except FileExistsError:
+            pass  # another worker linked it first
+    return tom_file_path
+
+def get_spectroscopy_processor():
+    processor_class = settings.DATA_PROCESSORS.get('spectroscopy', 'tom_dataproducts.data_processor.DataProcessor')
+    return import_string(processor_class)()
+
+def prepare_spectrum(target_id, spectrum_file_path, plot=True, source_dir=None):
+    '''
+    CPU-bound half of a spectrum ingest: plot, link and serialize the spectrum without any database access.
+    Safe to run in a worker process; the result is passed to ``save_prepared_spectrum`` in the writer.
+    The file is read once and the same arrays are used for the plot and the serialized spectrum. ``source_dir`` is
+    the delivery directory the file was found in, if any (see ``tom_spectrum_path``).
+    '''
+    tom_file_path = link_spectrum(spectrum_file_path, source_dir)
+    try:
+        spectrum = read_spectrum(tom_file_path)
+    except (OSError, KeyError):
+        spectrum = None  # left to the processor, which knows the file's layout
+    return {
+        'target_id': target_id,
+        'spectrum_file_path': spectrum_file_path,
+        'tom_file_path': tom_file_path,
+        'data': get_spectroscopy_processor().process_file(tom_file_path, spectrum=spectrum),
+        'thumbnail': plot_spectrum(target_id, spectrum_file_path, spectrum=spectrum) if plot else None,
+    }
+
+def stored_value(value):
+    '''The value a spectroscopy datum has in the binary store, so legacy JSON datums compare equal to packed ones.'''
+    if not is_binary_value(value) and isinstance(value, dict) and 'flux' in value and 'wavelength' in value:
+        return pack_spectrum(value)[0]
+    return value
+
+def save_prepared_spectrum(target, prepared, data_product=None):
+    '''
+    Database half of a spectrum ingest. Creates the DataProduct and its ReducedDatums from the output of
+    ``prepare_spectrum``, skipping datums the target already has as ``run_data_processor`` does. The spectrum arrays
+    are kept as float32 in ``SpectrumData`` rather than as JSON lists (see ``spectrum_store``). If an existing
+    ``data_product`` is given, e.g. for a file that was reprocessed in place, its ReducedDatums are replaced instead.
+    '''
+    if data_product is None:
+        data_product = DataProduct.objects.create(
+            target=target,
+            data_product_type='spectroscopy',
+            product_id=make_product_id(target.name),
+            data=prepared['tom_file_path']
+        )
+    else:
+        ReducedDatum.objects.filter(data_product=data_product).delete()
+        data_product.save()  # bumps modified
+    existing_values = {json.dumps(stored_value(rd.value), sort_keys=True, skipkeys=True)
+                       for rd in ReducedDatum.objects.filter(target=target)}
+    new_reduced_datums = []
+    arrays = []
+    for timestamp, value, source in prepared['data']:
+        value, spectrum_arrays = pack_spectrum(value)
+        key = json.dumps(value, sort_keys=True, skipkeys=True)
+        if key in existing_values:
+            continue
+        existing_values.add(key)
+        new_reduced_datums.append(ReducedDatum(target=target, data_product=data_product, data_type='spectroscopy',
+                                               timestamp=timestamp, value=value, source_name=source))
+        arrays.append(spectrum_arrays)
+    reduced_datums = ReducedDatum.objects.bulk_create(new_reduced_datums)
+    save_spectrum_arrays(reduced_datums, arrays)
+    if prepared.get('thumbnail'):
+        record_thumbnails({target.id: prepared['thumbnail']})  # refreshes the target summary too
+    else:
+        refresh_target_summaries([target.id])
+    try:
+        continuous_share_data(target, reduced_datums)
+    except Exception as e:
+        logger.warning(f"Failed to share new dataproduct {data_product.product_id}: {repr(e)}")
+    return data_product
+
+def complete_spectrum_store(data_products):
+    '''
+    Stores the float32 arrays of the spectra that TOM's ``run_data_processor`` saved for ``data_products``, e.g. on
+    upload: it only creates the ReducedDatums, with the packed values ``process_data`` returns. Each file is read
+    again and its arrays stored under the datums with the same digest, then the summaries of the targets refreshed.
+    '''
+    pending = {}
+    for datum in (ReducedDatum.objects.filter(data_product__in=data_products, data_type='spectroscopy',
+                                              spectrum_data__isnull=True, value__storage='float32')
+                  .select_related('data_product')):
+        pending.setdefault(datum.data_product, []).append(datum)
+    processor = get_spectroscopy_processor()
+    for data_product, datums in pending.items():
+        arrays = {}
+        for _, value, _ in processor.process_file(data_product.data.path):
+            packed, spectrum_arrays = pack_spectrum(value)
+            arrays[packed['digest']] = spectrum_arrays
+        datums = [datum for datum in datums if datum.value['digest'] in arrays]
+        save_spectrum_arrays(datums, [arrays[datum.value['digest']] for datum in datums])
+    refresh_target_summaries({data_product.target_id for data_product in pending})
+
+def spectrum_file_stat(spectrum_file_path):
+    stat = os.stat(spectrum_file_path)
+    return stat.st_size, stat.st_mtime
+
+def spectrum_file_digest(spectrum_file_path):
+    sha256 = hashlib.sha256()
+    with open(spectrum_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def record_spectrum_file(spectrum_file_path, size, mtime, sha256, data_product_ids):
+    '''
+    Records a spectrum file in the ingestion manifest with one entry per DataProduct made from it, or a single entry
+    without one, replacing the file's entries for products it no longer has.
+    '''
+    data_product_ids = list(dict.fromkeys(data_product_ids)) or [None]
+    product_ids = [data_product_id for data_product_id in data_product_ids if data_product_id]
+    entries = SpectrumFile.objects.filter(path=spectrum_file_path)
+    with transaction.atomic():
+        if product_ids:
+            entries.exclude(data_product_id__in=product_ids).delete()
+        else:
+            entries.filter(data_product__isnull=False).delete()
+        entries.update(size=size, mtime=mtime, sha256=sha256, last_seen=timezone.now())
+        recorded = set(entries.values_list('data_product_id', flat=True))
+        SpectrumFile.objects.bulk_create([
+            SpectrumFile(path=spectrum_file_path, size=size, mtime=mtime, sha256=sha256,
+                         data_product_id=data_product_id)
+            for data_product_id in data_product_ids if data_product_id not in recorded
+        ])
+
+def check_spectrum_manifest(spectrum_file_path):
+    '''
+    Looks a spectrum file up in the ingestion manifest. Unchanged files cost a single stat and an indexed lookup;
+    files are only hashed when their size or mtime changed. Files whose content has already been ingested are
+    recorded in the manifest here, with every DataProduct made from that content.
+
+    :returns: ``(action, entries, size, mtime, sha256)`` where action is ``'unchanged'``, ``'duplicate'`` or
+        ``'ingest'`` and ``entries`` are the file's manifest entries, one per DataProduct
+    '''
+    size, mtime = spectrum_file_stat(spectrum_file_path)
+    entries = list(SpectrumFile.objects.filter(path=spectrum_file_path).select_related('data_product'))
+    if entries and entries[0].size == size and entries[0].mtime == mtime:
+        return 'unchanged', entries, size, mtime, entries[0].sha256
+
+    sha256 = spectrum_file_digest(spectrum_file_path)
+    if entries and entries[0].sha256 == sha256:
+        record_spectrum_file(spectrum_file_path, size, mtime, sha256, [entry.data_product_id for entry in entries])
+        return 'unchanged', entries, size, mtime, sha256
+    duplicates = list(SpectrumFile.objects.filter(sha256=sha256, data_product__isnull=False).exclude(
+        path=spectrum_file_path).values_list('data_product_id', flat=True))
+    if duplicates:
+        record_spectrum_file(spectrum_file_path, size, mtime, sha256, duplicates)
+        return 'duplicate', entries, size, mtime, sha256
+    if not entries:
+        # Spectra ingested before the manifest existed are recorded without being decoded again
+        tom_file_path = tom_spectrum_path(spectrum_file_path)
+        legacy = list(DataProduct.objects.filter(data=tom_file_path).values_list('id', flat=True))
+        if legacy and links_to(tom_file_path, spectrum_file_path):
+            record_spectrum_file(spectrum_file_path, size, mtime, sha256, legacy)
+            return 'duplicate', entries, size, mtime, sha256
+    return 'ingest', entries, size, mtime, sha256
+
+def add_spectrum_to_database(target, spectrum_file_path, plot=False, source_dir=None):
+    '''
+    Adds a spectrum file to the database unless the ingestion manifest shows it has been seen before (see
+    ``check_spectrum_manifest``), so only new content is decoded. A file that changed in place is reprocessed
+    into its existing DataProduct. With ``plot``, the spectrum plot is made from the same read of the file.
+    '''
     try:
         if os.path.exists(spectrum_file_path):
-        
-            if os.path.basename(spectrum_file_path).startswith('l1_obs_joined_'):
-                tom_file_path = os.path.join(settings.BASE_DIR,'data/spectra/test/',os.path.basename(spectrum_file_path))
-            else:
-                tom_file_path = os.path.join(settings.BASE_DIR,'data/spectra/',os.path.basename(spectrum_file_path))
-            if not os.path.isfile(tom_file_path):
-                os.symlink(spectrum_file_path,tom_file_path)
-            print('Adding', target, f'{target.name}', tom_file_path)
-            data_product = DataProduct.objects.create(
-                target=target,
-                data_product_type='spectroscopy',
-                product_id=f'{target.name}'+datetime.now().strftime('%Y%m%d%H%M%S'),
-                data=tom_file_path
-            )
-            run_data_processor(data_product)
+            action, entries, size, mtime, sha256 = check_spectrum_manifest(spectrum_file_path)
+            if action == 'unchanged':
+                return f'Spectrum file for {target.name} is unchanged'
+            if action == 'duplicate':
+                return f'Spectrum for {target.name} already exists in the database'
+
+            existing = next((entry.data_product for entry in entries
+                             if entry.data_product and entry.data_product.target_id == target.id), None)
+            prepared = prepare_spectrum(target.id, spectrum_file_path, plot=plot, source_dir=source_dir)
+            print('Adding', target, f'{target.name}', prepared['tom_file_path'])
+            with transaction.atomic():
+                data_product = save_prepared_spectrum(target, prepared, data_product=existing)
+                record_spectrum_file(spectrum_file_path, size, mtime, sha256, [data_product.id])
+            if existing:
+                return f'Updated spectrum for {target.name} in the database'
             return f'Added spectrum for {target.name} to the database'
         else:
             return f'Spectrum file for {target.name} does not exist'
     except Exception as e:
-        return f'Error adding spectrum for {target.name}: {e}'
\ No newline at end of file
+        return f'Error adding spectrum for {target.name}: {e}'
+
+def add_l1_file_to_database(spectrum_file_path, resolve_target, plot=False, source_dir=None):
+    '''
+    Adds every spectrum in a multi-row L1 file, which may hold many targets, with a single read of the file.
+    Rows are grouped by target name and ``resolve_target`` maps each name to a Target, or None to skip it. Each
+    target gets its own DataProduct pointing at the file, and its own manifest entry. The ingestion manifest is
+    checked as in ``add_spectrum_to_database``; if the file changed in place, the DataProducts made from it are
+    replaced, except those that other files with the old content still point at.
+    '''
+    filename = os.path.basename(spectrum_file_path)
+    try:
+        action, entries, size, mtime, sha256 = check_spectrum_manifest(spectrum_file_path)
+        if action == 'unchanged':
+            return f'Spectrum file {filename} is unchanged'
+        if action == 'duplicate':
+            return f'Spectra in {filename} already exist in the database'
+
+        tom_file_path = link_spectrum(spectrum_file_path, source_dir)
+        spectrum = read_spectrum(tom_file_path)
+        by_target = get_spectroscopy_processor().process_file_by_target(tom_file_path, spectrum=spectrum)
+        data_products = []
+        with transaction.atomic():
+            replaced = {entry.data_product_id for entry in entries if entry.data_product_id}
+            replaced -= set(SpectrumFile.objects.filter(data_product_id__in=replaced).exclude(
+                path=spectrum_file_path).values_list('data_product_id', flat=True))
+            DataProduct.objects.filter(id__in=replaced).delete()
+            for name, (rows, data) in by_target.items():
+                target = resolve_target(name) if name else None
+                if not target:
+                    logger.warning(f'No target found for {len(rows)} spectra named {name} in {filename}')
+                    continue
+                thumbnail = None
+                if plot:
+                    wave = spectrum.wave[rows] if len(spectrum.wave) > 1 else spectrum.wave
+                    thumbnail = plot_spectrum(target.id, spectrum_file_path,
+                                              spectrum=spectrum._replace(wave=wave, flux=spectrum.flux[rows]))
+                data_products.append(save_prepared_spectrum(target, {'tom_file_path': tom_file_path, 'data': data,
+                                                                     'thumbnail': thumbnail}))
+            record_spectrum_file(spectrum_file_path, size, mtime, sha256,
+                                 [data_product.id for data_product in data_products])
+        return f'Added {len(data_products)} spectra from {filename} to the database'
+    except Exception as e:
+        return f'Error adding spectra from {filename}: {e}'
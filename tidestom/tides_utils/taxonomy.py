@@ -0,0 +1,75 @@
+import hashlib
+import json
+import threading
+from types import MappingProxyType
+from typing import NamedTuple
+from custom_code.models import TidesClass, TidesClassSubClass
+from tidestom.tides_utils.cache_utils import invalidate_taxonomy_version, taxonomy_version
+
+
+class Taxonomy(NamedTuple):
+    """
+    Immutable snapshot of the ``TidesClass``/``TidesClassSubClass`` tree, built with two queries and shared by every
+    request of a process until the tables change.
+    """
+    version: int
+    classes: tuple  # class names, in id order
+    subclasses: MappingProxyType  # class name -> tuple of (subclass id, subclass name)
+    subclass_ids: MappingProxyType  # subclass name -> id, the lowest id when a name is repeated
+    subclass_classes: MappingProxyType  # subclass id -> class name
+    document: bytes  # the tree as JSON, for the taxonomy endpoint
+    etag: str  # digest of the document, so it only changes with the content
+
+    def subclasses_of(self, class_name):
+        return self.subclasses.get(class_name, ())
+
+
+_taxonomy = None
+_lock = threading.Lock()
+
+
+def invalidate_taxonomy():
+    '''
+    Call when TidesClass or TidesClassSubClass rows change, after the transaction commits so no process reloads the
+    old rows. Every process reloads its snapshot on its next use.
+    '''
+    global _taxonomy
+    _taxonomy = None
+    invalidate_taxonomy_version()
+
+
+def load_taxonomy(version):
+    '''Builds a ``Taxonomy`` from the tables with two queries.'''
+    classes = tuple(TidesClass.objects.order_by('id').values_list('name', flat=True))
+    subclasses = {name: [] for name in classes}
+    subclass_ids = {}
+    subclass_classes = {}
+    for subclass_id, sub_class, class_name in TidesClassSubClass.objects.order_by('id').values_list(
+            'id', 'sub_class', 'main_class__name'):
+        subclasses[class_name].append((subclass_id, sub_class))
+        subclass_ids.setdefault(sub_class, subclass_id)
+        subclass_classes[subclass_id] = class_name
+    subclasses = {name: tuple(entries) for name, entries in subclasses.items()}
+    document = json.dumps({
+        'classes': [{'name': name, 'subclasses': [{'id': subclass_id, 'sub_class': sub_class}
+                                                  for subclass_id, sub_class in subclasses[name]]}
+                    for name in classes],
+    }, separators=(',', ':')).encode()
+    return Taxonomy(version, classes, MappingProxyType(subclasses), MappingProxyType(subclass_ids),
+                    MappingProxyType(subclass_classes), document, hashlib.md5(document).hexdigest())
+
+
+def get_taxonomy():
+    '''
+    The current taxonomy snapshot. Costs one cache read to check the version; the tables are only queried again
+    after ``invalidate_taxonomy``, in this or any other process.
+    '''
+    global _taxonomy
+    version = taxonomy_version()
+    taxonomy = _taxonomy
+    if taxonomy is None or taxonomy.version != version:
+        with _lock:
+            if _taxonomy is None or _taxonomy.version != version:
+                _taxonomy = load_taxonomy(version)
+            taxonomy = _taxonomy
+    return taxonomy
@@ -0,0 +1,112 @@
+import hashlib
+import logging
+from pathlib import Path
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+from tom_dataproducts.models import ReducedDatum
+from tom_targets.models import Target
+from custom_code.models import SpectrumThumbnail
+from tidestom.tides_utils.spectrum_store import decimate_minmax, load_spectra
+from tidestom.tides_utils.summaries import refresh_target_summaries
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTHS = SpectrumThumbnail.WIDTHS
+THUMBNAIL_ASPECT = SpectrumThumbnail.ASPECT
+WEBP_QUALITY = 80
+
+
+def thumbnail_dir():
+    return Path(settings.STATICFILES_DIRS[0]) / 'plots'
+
+
+def render_spectrum_thumbnail(target_id, wavelength, flux):
+    '''
+    Renders the spectrum plot of a target once, at the largest thumbnail width, with an object-oriented Agg figure,
+    and writes a WebP file for every width in ``THUMBNAIL_WIDTHS``. The spectrum is min/max decimated to the width of
+    the image first, as more pixels than that cannot show. Nothing touches the pyplot state machine, so this is safe
+    to call from worker processes and threads. Files of earlier versions are left for ``record_thumbnails`` to remove.
+
+    :returns: the version, a hash of the rendered image that is part of the file names
+    '''
+    width = max(THUMBNAIL_WIDTHS)
+    fig = Figure(figsize=(6.4, 6.4 * THUMBNAIL_ASPECT), dpi=width / 6.4)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.step(*decimate_minmax(wavelength, flux, width), where='mid')
+    ax.set_xlim(4000, 9300)
+    canvas.draw()
+    image = Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba()).convert('RGB')
+    version = hashlib.sha256(image.tobytes()).hexdigest()[:12]
+
+    plot_dir = thumbnail_dir()
+    plot_dir.mkdir(parents=True, exist_ok=True)
+    thumbnail = SpectrumThumbnail(target_id=target_id, version=version)
+    for size in THUMBNAIL_WIDTHS:
+        resized = image if size == image.width else image.resize((size, round(size * THUMBNAIL_ASPECT)),
+                                                                 Image.LANCZOS)
+        resized.save(plot_dir / thumbnail.filename(size), 'WEBP', quality=WEBP_QUALITY, method=4)
+    return version
+
+
+def record_thumbnails(versions):
+    '''
+    Stores the versions returned by ``render_spectrum_thumbnail``, given as a dict of target id to version, and
+    refreshes the summaries of those targets. The files of the versions they replace are deleted once the new versions
+    are committed, so no page is pointed at a deleted file if the transaction rolls back.
+    '''
+    superseded = [thumbnail for thumbnail in SpectrumThumbnail.objects.filter(target_id__in=list(versions))
+                  if thumbnail.version != versions[thumbnail.target_id]]
+    now = timezone.now()
+    SpectrumThumbnail.objects.bulk_create(
+        [SpectrumThumbnail(target_id=target_id, version=version, rendered=now)
+         for target_id, version in versions.items()],
+        update_conflicts=True, unique_fields=['target'], update_fields=['version', 'rendered'],
+    )
+    refresh_target_summaries(versions)
+    if superseded:
+        transaction.on_commit(lambda: remove_thumbnail_files(superseded))
+
+
+def remove_thumbnail_files(thumbnails):
+    '''Deletes the WebP files of ``SpectrumThumbnail`` versions, at every width.'''
+    plot_dir = thumbnail_dir()
+    for thumbnail in thumbnails:
+        for size in THUMBNAIL_WIDTHS:
+            (plot_dir / thumbnail.filename(size)).unlink(missing_ok=True)
+
+
+def render_target_thumbnail(target_id):
+    '''
+    Renders the thumbnails of a target from its most recent spectrum in the database. Only reads from the database,
+    so it can run in a worker process; pass the result to ``record_thumbnails`` in the writer.
+
+    :returns: the thumbnail version, or None if the target has no spectrum
+    '''
+    latest = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy').order_by('-timestamp')[:1]
+    try:
+        spectra = load_spectra(latest)
+        if not spectra:
+            return None
+        _, wavelength, flux = spectra[0]
+        return render_spectrum_thumbnail(target_id, wavelength, flux)
+    except Exception as e:
+        logger.error(f'Failed to render the thumbnail of target {target_id}: {e}')
+        return None
+
+
+def stale_thumbnail_targets(force=False):
+    '''
+    Ids of the targets with no thumbnail, or one rendered before their most recently modified spectroscopy
+    DataProduct, found with a single query.
+    '''
+    spectrum_times = (Target.objects.filter(dataproduct__data_product_type='spectroscopy')
+                      .annotate(spectrum_modified=Max('dataproduct__modified'))
+                      .values_list('id', 'spectrum_modified', 'spectrum_thumbnail__rendered'))
+    return [target_id for target_id, spectrum_modified, rendered in spectrum_times
+            if force or rendered is None or rendered < spectrum_modified]
@@ -1,29 +1,114 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import logging
+import numpy as np
 from astropy.time import Time
 from tom_dataproducts.data_processor import DataProcessor
-from tom_dataproducts.processors.data_serializers import SpectrumSerializer
-from astropy.io import fits
-from specutils import Spectrum1D
+from tidestom.tides_utils.spectrum_io import read_spectrum
+from tidestom.tides_utils.spectrum_store import pack_spectrum, serialize_spectrum
 from astropy import units as u
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_WAVE_UNIT = u.Angstrom
+DEFAULT_FLUX_UNIT = u.Unit('erg cm-2 s-1 AA-1')
+
 class QMOSTSpectroscopyProcessor(DataProcessor):
 
     def process_data(self, data_product,test=False):
-        if os.path.basename(data_product.data.path).startswith('l1_obs_joined_'):
-
-            spectrum, obs_date, source_id = self._process_test_spectrum(data_product)
-
-        serialized_spectrum = SpectrumSerializer().serialize(spectrum)
-
-        return [(obs_date, serialized_spectrum, source_id)]
-    
-    def _process_test_spectrum(self, data_product):
-        spec=fits.getdata(data_product.data.path)
-        wave = spec['WAVE'][0]*u.Angstrom
-        flux = spec['FLUX'][0]*u.Unit('erg cm-2 s-1 AA-1')
-        spectrum = Spectrum1D(flux=flux, spectral_axis=wave)
-        return spectrum, Time(datetime.now()).to_datetime(), '4MOST' #TODO change obs date!
-    
-    def _process_L1_spectrum(self, data_product):
-        '''Some code to process real 4MOST L1 spectra'''
\ No newline at end of file
+        '''
+        Called by ``run_data_processor``, which saves the datums returned. Their values are already packed for the
+        binary store (see ``pack_spectrum``); ``complete_spectrum_store`` stores the arrays once the datums exist.
+        '''
+        return [(timestamp, pack_spectrum(value)[0], source)
+                for timestamp, value, source in self.process_file(data_product.data.path)]
+
+    def process_file(self, spectrum_file_path, spectrum=None):
+        '''
+        Serialize the spectra in a file without touching the database, so it can run in a worker process.
+        ``spectrum`` takes the arrays from ``read_spectrum`` when the caller has already read the file. Values hold
+        the wavelength and flux as NumPy arrays, ready for ``pack_spectrum``.
+        '''
+        if os.path.basename(spectrum_file_path).startswith('l1_obs_joined_'):
+            return [self._process_test_spectrum(spectrum_file_path, spectrum)]
+        return self._process_L1_spectrum(spectrum_file_path, spectrum)
+
+    def process_file_by_target(self, spectrum_file_path, spectrum=None):
+        '''
+        Serialize a multi-target L1 file and group the spectra by the target name of each row.
+
+        :returns: dict of target name to ``(row indices, list of (timestamp, value, source) tuples)``
+        '''
+        if spectrum is None:
+            spectrum = read_spectrum(spectrum_file_path)
+        data = self.process_file(spectrum_file_path, spectrum=spectrum)
+        names = self.row_target_names(spectrum)
+        grouped = {}
+        for name in dict.fromkeys(names):
+            rows = np.flatnonzero(names == name)
+            grouped[name] = (rows, [data[row] for row in rows])
+        return grouped
+
+    def row_target_names(self, spectrum):
+        '''The target name of every row: from a per-row name column if there is one, else the OBJECT keyword.'''
+        for column in ('OBJECT', 'OBJ_NAME', 'NAME', 'TARGNAME'):
+            if column in spectrum.rows:
+                return np.char.strip(spectrum.rows[column].astype(str))
+        name = spectrum.header.get('OBJECT', spectrum.primary_header.get('OBJECT'))
+        return np.full(len(spectrum.flux), str(name).strip() if name else None, dtype=object)
+
+    def _process_test_spectrum(self, spectrum_file_path, spectrum=None):
+        if spectrum is None:
+            spectrum = read_spectrum(spectrum_file_path, rows=slice(0, 1))
+        value = serialize_spectrum(spectrum.wave[0], spectrum.flux[0], DEFAULT_WAVE_UNIT.to_string(),
+                                   DEFAULT_FLUX_UNIT.to_string())
+        return self._observation_dates(spectrum, spectrum_file_path)[0], value, '4MOST'
+
+    def _process_L1_spectrum(self, spectrum_file_path, spectrum=None):
+        '''
+        Process every row (fibre or epoch) of a 4MOST L1 file in one vectorized pass. Observation dates come from a
+        per-row MJD column if the file has one, otherwise from the MJD-OBS or DATE-OBS header keywords. Non-finite
+        pixels are dropped.
+
+        :returns: list of ``(timestamp, value, source)`` tuples, one per row
+        '''
+        if spectrum is None:
+            spectrum = read_spectrum(spectrum_file_path)
+        wave_unit = self._column_unit(spectrum, 'WAVE', DEFAULT_WAVE_UNIT).to_string()
+        flux_unit = self._column_unit(spectrum, 'FLUX', DEFAULT_FLUX_UNIT).to_string()
+        obs_dates = self._observation_dates(spectrum, spectrum_file_path)
+        source_id = spectrum.primary_header.get('ORIGIN', '4MOST')
+
+        wave = np.broadcast_to(spectrum.wave, spectrum.flux.shape)
+        good = np.isfinite(wave) & np.isfinite(spectrum.flux)
+        if good.all():
+            waves, fluxes = wave, spectrum.flux
+        else:
+            waves = [row[mask] for row, mask in zip(wave, good)]
+            fluxes = [row[mask] for row, mask in zip(spectrum.flux, good)]
+
+        return [
+            (obs_date, serialize_spectrum(wavelength, flux, wave_unit, flux_unit), source_id)
+            for obs_date, wavelength, flux in zip(obs_dates, waves, fluxes)
+        ]
+
+    def _column_unit(self, spectrum, column, default):
+        try:
+            return u.Unit(spectrum.units.get(column)) if spectrum.units.get(column) else default
+        except ValueError:
+            logger.warning(f'Unrecognised unit {spectrum.units[column]} for {column}, assuming {default}')
+            return default
+
+    def _observation_dates(self, spectrum, spectrum_file_path):
+        n_rows = len(spectrum.flux)
+        for column in ('MJD_OBS', 'MJD'):
+            if column in spectrum.rows:
+                mjd = spectrum.rows[column].astype(float)
+                return Time(mjd, format='mjd').to_datetime(timezone=timezone.utc)
+        for header in (spectrum.header, spectrum.primary_header):
+            if header.get('MJD-OBS') is not None:
+                return [Time(header['MJD-OBS'], format='mjd').to_datetime(timezone=timezone.utc)] * n_rows
+            if header.get('DATE-OBS'):
+                return [Time(header['DATE-OBS'], scale='utc').to_datetime(timezone=timezone.utc)] * n_rows
+        logger.warning(f'No observation date in {spectrum_file_path}, using the current time')
+        return [datetime.now(timezone.utc)] * n_rows
@@ -0,0 +1,15 @@
+"""
+Set-up of spawned worker processes. A spawned worker imports its initializer before Django is set up, so this module
+must not import any models; the tasks themselves are imported afterwards.
+"""
+import django
+
+
+def init_ingest_worker():
+    '''
+    Initializer of the ingestion and thumbnail pools, whose workers are spawned: each starts a fresh interpreter, so
+    Django is set up here, and plots are drawn without a GUI backend.
+    '''
+    django.setup()
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
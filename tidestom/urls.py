@@ -16,7 +16,9 @@ Including another URLconf
 
 from django.urls import path, include
 from django.views.generic import TemplateView
-from .views import LatestView, SubmitClassificationView, get_subclasses, MyTargetDetailView
+from .views import LatestView, SubmitClassificationView, SpectrumUploadView, get_subclasses, MyTargetDetailView, serve_thumbnail, \
+    serve_plotly_js, target_spectra, target_spectrum, taxonomy, cone_search, \
+    crossmatch_catalogue, similar_spectra
 urlpatterns = [
    
     path('about/', TemplateView.as_view(template_name='about.html'),name='about'),
@@ -24,5 +26,15 @@ urlpatterns = [
     path('targets/<int:pk>/', MyTargetDetailView.as_view(template_name='target_detail.html'), name='target_detail'),
     path('targets/<int:target_id>/submit_classification/', SubmitClassificationView.as_view(), name='submit_classification'),
     path('api/get_subclasses/', get_subclasses, name='get_subclasses'),
+    path('api/taxonomy/', taxonomy, name='taxonomy'),
+    path('api/targets/cone/', cone_search, name='cone_search'),
+    path('api/crossmatch/', crossmatch_catalogue, name='crossmatch'),
+    path('api/targets/<int:target_id>/spectra/', target_spectra, name='target_spectra'),
+    path('api/targets/<int:target_id>/similar/', similar_spectra, name='similar_spectra'),
+    path('api/targets/<int:target_id>/spectra/<int:datum_id>/', target_spectrum, name='target_spectrum'),
+    path('thumbnails/<path:path>', serve_thumbnail, name='thumbnail'),
+    path('assets/plotly-<str:version>.min.js', serve_plotly_js, name='plotly_js'),
+    # Replaces TOM's upload view at the same URL, which dataproducts:upload still reverses to
+    path('dataproducts/data/upload/', SpectrumUploadView.as_view(), name='spectrum_upload'),
     path('', include('tom_common.urls')),
 ]
\ No newline at end of file
@@ -1,49 +1,108 @@
 #from django.views.generic import TemplateView
 from django.views.generic.detail import DetailView
-from django_filters.views import FilterView
+from django.views.generic.list import ListView
 from django.utils import timezone
 from django.views.generic.edit import FormView
-from django.db import models
-from django.contrib.auth.models import User
-from django.shortcuts import get_object_or_404, redirect, render
-from django.urls import reverse_lazy
-from guardian.mixins import PermissionListMixin
+from django.db import models, transaction
+from django.db.models import Q
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.urls import reverse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_GET, require_POST
+from django.views.static import serve
+from guardian.shortcuts import get_objects_for_user
 from tom_targets.models import Target
 from tom_targets.filters import TargetFilter
-from tom_dataproducts.models import DataProduct
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from tom_dataproducts.views import DataProductUploadView
+from calendar import timegm
 from datetime import timedelta
-from collections import Counter
-from custom_code.models import TidesTarget, HumanTidesClassSubmission  
+from pathlib import Path
+import hashlib
+import numpy as np
+import plotly
+from plotly.offline import get_plotlyjs_version
+from custom_code.models import TidesTarget, HumanTidesClassSubmission, RedshiftEstimate
 from custom_code.forms import TidesTargetForm
+from tidestom.tides_utils.cache_utils import latest_targets_version, target_version
+from tidestom.tides_utils.crossmatch import iter_csv, match_catalogue, read_catalogue, target_positions
+from tidestom.tides_utils.redshift import MIN_R_VALUE
+from tidestom.tides_utils.similarity import current_index
+from tidestom.tides_utils.spectrum_store import STORE_DTYPE, load_spectrum_window
+from tidestom.tides_utils.summaries import visible_summaries
+from tidestom.tides_utils.target_utils import complete_spectrum_store
+from tidestom.tides_utils.taxonomy import get_taxonomy
+from tidestom.tides_utils.thumbnails import thumbnail_dir
 
 #from tom_common.mixins import Raise403PermissionRequiredMixin
-from datetime import timedelta
-
 from django.utils.timezone import now
 
-class LatestView(PermissionListMixin, FilterView):
+class LatestView(ListView):
+    """
+    Card grid of recent targets with spectra, newest first, read only from the ``TargetSummary`` table of the targets
+    the user may view, narrowed by the ``TargetFilter`` parameters in the query string. Pages are fetched with keyset
+    pagination on ``(created, target)`` rather than ListView's page numbers: the ``before`` parameter holds the cursor
+    of the last card of the previous page, so every page is one indexed range scan however deep it is. Pages are
+    cached per user and query string until the next ingestion.
+    """
     template_name = 'latest.html'
-    paginate_by = 200
-    strict = False
-    model = Target
-    filterset_class = TargetFilter
-    # Set app_name for Django-Guardian Permissions in case of Custom Target Model
-    permission_required = f'{Target._meta.app_label}.view_target'
-    ordering = ['-created']
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    page_size = 200
+    cache_timeout = 600
+    ordering = ['-created', '-target_id']
+
+    def get_queryset(self):
         recent = timezone.now() - timedelta(days=356)
-        # Filter targets that have associated spectra
-        context['targets'] = Target.objects.filter(
-            created__gte=recent,
-            dataproduct__data_product_type='spectroscopy'
-        ).distinct()
+        summaries = visible_summaries(self.request.user).filter(latest_spectrum__isnull=False, created__gte=recent)
+        self.filterset = TargetFilter(self.request.GET or None, queryset=Target.objects.all(), request=self.request)
+        # Invalid filters are ignored, as FilterView does with strict = False
+        if self.filterset.is_bound and self.filterset.is_valid() and any(
+                value not in (None, '', []) for value in self.filterset.form.cleaned_data.values()):
+            summaries = summaries.filter(target__in=self.filterset.qs.values('pk'))
+        return summaries.order_by(*self.ordering)
+
+    def keyset_page(self, queryset):
+        '''The cards after the ``before`` cursor, and whether there are more, from the cache if possible.'''
+        key = 'latest_targets:{}:{}:{}'.format(
+            latest_targets_version(), self.request.user.pk,
+            hashlib.md5(self.request.GET.urlencode().encode()).hexdigest())
+        page = cache.get(key)
+        if page is None:
+            created, _, target_id = self.request.GET.get('before', '').rpartition('_')
+            try:
+                created = parse_datetime(created)
+            except ValueError:
+                created = None
+            if created and target_id.isdigit():
+                queryset = queryset.filter(Q(created__lt=created) | Q(created=created, target_id__lt=int(target_id)))
+            targets = list(queryset[:self.page_size + 1])
+            page = (targets[:self.page_size], len(targets) > self.page_size)
+            cache.set(key, page, self.cache_timeout)
+        return page
+
+    def get_context_data(self, **kwargs):
+        targets, has_next = self.keyset_page(self.object_list)
+        context = super().get_context_data(object_list=targets, **kwargs)
+        filters = self.request.GET.copy()
+        filters.pop('before', None)
+        context['filter'] = self.filterset
+        context['filter_query'] = filters.urlencode()
+        context['targets'] = targets
+        context['next_cursor'] = f'{targets[-1].created.isoformat()}_{targets[-1].target_id}' if has_next else None
+        context['is_first_page'] = not self.request.GET.get('before')
         return context
 
 class MyTargetDetailView(DetailView):
     model = TidesTarget
     template_name = 'target_detail.html'
     context_object_name = 'target'
+    fragment_timeout = 24 * 3600
     print('MyTargetDetailView called')
     def __init__(self, *args, **kwargs):
         print("MyTargetDetailView initialized")  # Debug statement
@@ -62,53 +121,60 @@ class MyTargetDetailView(DetailView):
         print("MyTargetDetailView get context data called")  # Debug statement
         context = super().get_context_data(**kwargs)
         context['view'] = self  # Explicitly set the view in the context
-        target = self.get_object()
-        submissions = HumanTidesClassSubmission.objects.filter(target=target)
-        print(f"Submissions retrieved: {submissions}")  # Debug statement
-        # Debug each submission
-        for submission in submissions:
-            print(f"Submission ID: {submission.id}")
-            print(f"Target: {submission.target}")
-            print(f"Tidesclass Class: {submission.tidesclass}")
-            print(f"Tidesclass Subclass: {submission.tidesclass_subclass}")
+        target = self.object
         context['form'] = TidesTargetForm()
 
-        # Get all human classification submissions for this target
-        submissions = HumanTidesClassSubmission.objects.filter(target=target)
-        # Aggregate the most common classification
-        if submissions.exists():
-            print(f"Submissions exist, now trying to count ")  # Debug statement
-            tidesclass_counts = Counter(sub.tidesclass for sub in submissions if sub.tidesclass is not None)
-            print("counted ",tidesclass_counts)
-            most_common_class, count = tidesclass_counts.most_common(1)[0]
-            print("counted, here is most common",most_common_class, count )
-            context['aggregated_human_class'] = {
-                'most_common_class': most_common_class,
-                'count': count,
-                'total_submissions': submissions.count(),
-            }
-        else:
-            context['aggregated_human_class'] = None
+        # The consensus is materialized on the target when classifications are submitted
+        context['aggregated_human_class'] = target.aggregate_human_tidesclass()
 
         # Add all individual submissions to the context
-        context['human_classifications'] = submissions.order_by('-timestamp')
+        context['human_classifications'] = target.human_classifications.select_related(
+            'user', 'tidesclass_subclass').order_by('-timestamp')
+
+        # Keys of the cached page sections. The version is bumped by signals, the bulk ingestion paths and summary
+        # refreshes, which SpectrumUploadView runs after an upload; the newest datum id also covers datums that
+        # run_data_processor bulk creates elsewhere, e.g. for the API, as that sends no signal.
+        newest_datum = ReducedDatum.objects.filter(target_id=target.id).aggregate(newest=models.Max('id'))['newest']
+        context['fragment_version'] = f'{target_version(target.id)}.{newest_datum}'
+        context['fragment_timeout'] = self.fragment_timeout
+        # Datums are filtered by user unless permissions are only checked on targets
+        context['fragment_scope'] = '' if settings.TARGET_PERMISSIONS_ONLY else self.request.user.pk
+
+        # The redshift slider opens at the most reliable cross-correlation estimate among the target's spectra
+        context['redshift_estimate'] = RedshiftEstimate.objects.filter(
+            reduced_datum__in=spectroscopy_datums(self.request.user, target.id), r_value__gte=MIN_R_VALUE
+        ).select_related('template').order_by('-r_value').first()
         return context
 
+class SpectrumUploadView(DataProductUploadView):
+    """
+    TOM's upload view, followed by ``complete_spectrum_store`` for the spectra that ``run_data_processor`` saved, so
+    their arrays reach the binary store and the target's summary counts them.
+    """
+
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        target = form.cleaned_data['target'] or form.cleaned_data['observation_record'].target
+        complete_spectrum_store(DataProduct.objects.filter(target=target))
+        return response
+
 class SubmitClassificationView(FormView):
     
     form_class = TidesTargetForm
 
     def form_valid(self, form):
-        target = get_object_or_404(TidesTarget, id=self.kwargs['target_id'])
-        # Save the classification as a new submission
-        submission = HumanTidesClassSubmission.objects.create(
-            target=target,
-            user=self.request.user,
-            tidesclass=form.cleaned_data['tidesclass'],
-            tidesclass_other=form.cleaned_data['tidesclass_other'],
-            tidesclass_subclass=form.cleaned_data['tidesclass_subclass'],
-            timestamp=now()
-        )
+        with transaction.atomic():
+            # Lock the target so concurrent submissions update its consensus one after the other
+            target = get_object_or_404(TidesTarget.objects.select_for_update(), id=self.kwargs['target_id'])
+            # Save the classification as a new submission; its post_save signal recomputes the consensus
+            submission = HumanTidesClassSubmission.objects.create(
+                target=target,
+                user=self.request.user,
+                tidesclass=form.cleaned_data['tidesclass'],
+                tidesclass_other=form.cleaned_data['tidesclass_other'],
+                tidesclass_subclass=form.cleaned_data['tidesclass_subclass'],
+                timestamp=now()
+            )
         print(f"Submission saved: {submission}")  # Debug statement
         return redirect('target_detail', pk=self.kwargs['target_id'])
 
@@ -118,15 +184,273 @@ class SubmitClassificationView(FormView):
         context['form'] = self.get_form()
         return context
     
-from django.http import JsonResponse
-from custom_code.models  import TidesClass, TidesClassSubClass
 
 def get_subclasses(request):
-    main_class_name = request.GET.get('main_class')
+    subclasses = get_taxonomy().subclasses_of(request.GET.get('main_class'))
+    return JsonResponse([{'id': subclass_id, 'sub_class': sub_class} for subclass_id, sub_class in subclasses],
+                        safe=False)
+
+
+# Thumbnail file names contain a hash of the image, so a file never changes once written
+@cache_control(public=True, max_age=365 * 24 * 3600, immutable=True)
+def serve_thumbnail(request, path):
+    return serve(request, path, document_root=thumbnail_dir())
+
+
+# The URL holds the plotly.js version, which changes whenever the plotly package is upgraded
+@gzip_page
+@cache_control(public=True, max_age=365 * 24 * 3600, immutable=True)
+def serve_plotly_js(request, version):
+    if version != get_plotlyjs_version():
+        raise Http404('Unknown plotly.js version')
+    return serve(request, 'plotly.min.js', document_root=Path(plotly.__file__).parent / 'package_data')
+
+
+SPECTRUM_INDEX_FIELDS = ('id', 'timestamp', 'value__digest', 'value__n_pixels', 'value__wavelength_units',
+                         'value__flux_units', 'data_product__modified')
+MAX_PLOT_WIDTH = 8192
+
+
+def spectroscopy_datums(user, target_id):
+    '''
+    The spectroscopic ReducedDatums of a target that ``user`` may view, as the ``target_spectroscopy`` tag selects them.
+    Raises Http404 if the user may not view the target itself, as the target detail page does.
+    '''
+    if not user.is_superuser and not get_objects_for_user(
+            user, f'{Target._meta.app_label}.view_target', klass=Target.objects.filter(id=target_id)).exists():
+        raise Http404('No such target')
     try:
-        main_class = TidesClass.objects.get(name=main_class_name)
-        subclasses = TidesClassSubClass.objects.filter(main_class=main_class).values('id', 'sub_class')
-        return JsonResponse(list(subclasses), safe=False)
-    except TidesClass.DoesNotExist:
-        return JsonResponse([], safe=False)
+        spectroscopy_data_type = settings.DATA_PRODUCT_TYPES['spectroscopy'][0]
+    except (AttributeError, KeyError):
+        spectroscopy_data_type = 'spectroscopy'
+    datums = ReducedDatum.objects.filter(target_id=target_id, data_product__data_product_type=spectroscopy_data_type)
+    if not settings.TARGET_PERMISSIONS_ONLY:
+        datums = get_objects_for_user(user, 'tom_dataproducts.view_reduceddatum', klass=datums)
+    return datums
+
+
+def _epoch_etag(row):
+    # Binary spectra carry a digest of their arrays; legacy JSON ones change only with their data product
+    return row['value__digest'] or f"{row['id']}-{row['data_product__modified'].timestamp()}"
+
+
+def _float_param(request, name):
+    try:
+        return float(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def conditional_response(request, etag, last_modified, build_response):
+    '''
+    Answers a GET with 304 Not Modified when the client already holds the representation identified by ``etag`` and
+    ``last_modified``, otherwise with ``build_response()``. Either way the validators are sent, with ``no-cache`` so
+    the browser keeps the response but revalidates it on every view.
+    '''
+    etag = quote_etag(etag)
+    last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = build_response()
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@gzip_page
+@require_GET
+def target_spectra(request, target_id):
+    '''
+    Index of the spectroscopic epochs of a target: for each one its timestamp, size, units and the URL of its arrays.
+    The arrays themselves are fetched per epoch from ``target_spectrum``, so the page loads only the epochs on show.
+    '''
+    datums = spectroscopy_datums(request.user, target_id).order_by('timestamp', 'id')
+    if request.GET.get('data_product', '').isdigit():
+        datums = datums.filter(data_product_id=int(request.GET['data_product']))
+    rows = list(datums.values(*SPECTRUM_INDEX_FIELDS))
+    etag = hashlib.md5('|'.join(_epoch_etag(row) for row in rows).encode()).hexdigest()
+    last_modified = max((row['data_product__modified'] for row in rows), default=None)
+
+    def build_response():
+        return JsonResponse({
+            'target': target_id,
+            'epochs': [{
+                'id': row['id'],
+                'timestamp': row['timestamp'].isoformat(),
+                'name': row['timestamp'].strftime('%Y%m%d-%H:%M:%S'),
+                'n_pixels': row['value__n_pixels'],
+                'wavelength_units': row['value__wavelength_units'],
+                'flux_units': row['value__flux_units'],
+                'url': reverse('target_spectrum', kwargs={'target_id': target_id, 'datum_id': row['id']}),
+            } for row in rows],
+        })
+    return conditional_response(request, etag, last_modified, build_response)
+
+
+@gzip_page
+@require_GET
+def target_spectrum(request, target_id, datum_id):
+    '''
+    Wavelength and flux arrays of one spectroscopic epoch. ``?format=f32`` returns them as raw little-endian float32,
+    the wavelengths followed by the fluxes, with the number of pixels in ``X-Spectrum-Pixels``; the default is JSON,
+    with non-finite fluxes as null. ``wmin`` and ``wmax`` restrict the response to a wavelength window, and ``width``,
+    the width of the plot in screen pixels, selects the level of detail (see ``load_spectrum_window``), reported in
+    ``X-Spectrum-Level``. The ETag is the digest of the stored arrays and the query, so it only changes with the data.
+    '''
+    binary = request.GET.get('format') == 'f32'
+    wavelength_min = _float_param(request, 'wmin')
+    wavelength_max = _float_param(request, 'wmax')
+    width = request.GET.get('width', '')
+    width = min(int(width), MAX_PLOT_WIDTH) if width.isdigit() and int(width) else None
+    row = spectroscopy_datums(request.user, target_id).filter(id=datum_id).values(*SPECTRUM_INDEX_FIELDS).first()
+    if row is None:
+        raise Http404('No such spectrum')
+
+    def build_response():
+        level, wavelength, flux = load_spectrum_window(ReducedDatum.objects.only('id', 'value').get(id=datum_id),
+                                                       wavelength_min, wavelength_max, width)
+        level = level or 'full'
+        if binary:
+            response = HttpResponse(np.asarray(wavelength, dtype=STORE_DTYPE).tobytes()
+                                    + np.asarray(flux, dtype=STORE_DTYPE).tobytes(),
+                                    content_type='application/octet-stream')
+            response.headers['X-Spectrum-Pixels'] = len(flux)
+            response.headers['X-Spectrum-Level'] = level
+            return response
+        return JsonResponse({
+            'wavelength': np.asarray(wavelength, dtype=float).tolist(),
+            'flux': np.where(np.isfinite(flux), flux, None).tolist(),
+            'wavelength_units': row['value__wavelength_units'],
+            'flux_units': row['value__flux_units'],
+            'level': level,
+        })
+    etag = f"{_epoch_etag(row)}-{'f32' if binary else 'json'}-{width}-{wavelength_min}-{wavelength_max}"
+    return conditional_response(request, etag, row['data_product__modified'], build_response)
+
+
+@require_GET
+def taxonomy(request):
+    '''
+    The whole classification tree as one JSON document, so forms switch sub-class options without a request per
+    change. Served from the in-memory taxonomy, with an ETag that changes only when the tables do.
+    '''
+    current = get_taxonomy()
+    return conditional_response(request, current.etag, None,
+                                lambda: HttpResponse(current.document, content_type='application/json'))
+
+
+MAX_CONE_RADIUS = 3600  # arcsec
+MAX_CONE_RESULTS = 1000
+
+
+@require_GET
+def cone_search(request):
+    '''
+    Targets within ``radius`` arcseconds (at most ``MAX_CONE_RADIUS``) of ``ra``, ``dec`` in degrees, nearest first,
+    with their separation in arcseconds. Candidates come from the indexed sky cells of the cone (see
+    ``TidesTargetMatchManager.match_cone_search``), so the cost depends on the density of targets, not their number.
+    '''
+    ra, dec, radius = (_float_param(request, name) for name in ('ra', 'dec', 'radius'))
+    if ra is None or dec is None or not -90 <= dec <= 90:
+        return JsonResponse({'error': 'ra and dec are required, in degrees'}, status=400)
+    if radius is None or radius <= 0:
+        radius = settings.TARGET_MATCH_RADIUS
+    radius = min(radius, MAX_CONE_RADIUS)
+    targets = Target.matches.match_cone_search(ra, dec, radius)
+    if not request.user.is_superuser:
+        targets = get_objects_for_user(request.user, f'{Target._meta.app_label}.view_target', klass=targets)
+    rows = targets.order_by('separation').values('id', 'name', 'ra', 'dec', 'separation')[:MAX_CONE_RESULTS]
+    return JsonResponse({
+        'ra': ra % 360,
+        'dec': dec,
+        'radius': radius,
+        'targets': [{**row, 'separation': row['separation'] * 3600,
+                     'url': reverse('target_detail', kwargs={'pk': row['id']})} for row in rows],
+    })
+
+
+@require_POST
+def crossmatch_catalogue(request):
+    '''
+    Crossmatches an uploaded CSV or Parquet catalogue (the ``catalogue`` file) against the targets the user may
+    view, and streams the matches back as CSV with separations in arcseconds. Takes the same options as the
+    ``crossmatch`` command: ``radius`` (arcsec, at most ``MAX_CONE_RADIUS``), ``all``, ``ra_column``, ``dec_column``
+    and ``id_column``.
+    '''
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Log in to crossmatch a catalogue'}, status=403)
+    upload = request.FILES.get('catalogue')
+    if upload is None:
+        return JsonResponse({'error': 'Upload the catalogue as the catalogue file'}, status=400)
+    radius = request.POST.get('radius')
+    try:
+        radius = min(float(radius), MAX_CONE_RADIUS) if radius else settings.TARGET_MATCH_RADIUS
+        catalogue = read_catalogue(upload, request.POST.get('ra_column') or None, request.POST.get('dec_column') or None,
+                                   request.POST.get('id_column') or None)
+    except (OSError, ValueError) as e:
+        return JsonResponse({'error': f'Could not read the catalogue: {e}'}, status=400)
+    matches = match_catalogue(catalogue, target_positions(request.user), radius,
+                              nearest=request.POST.get('all') not in ('1', 'true', 'on'))
+    response = StreamingHttpResponse(iter_csv(matches), content_type='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename="{Path(upload.name).stem}_crossmatch.csv"'
+    response.headers['X-Crossmatch-Rows'] = len(catalogue)
+    response.headers['X-Crossmatch-Matches'] = len(matches)
+    return response
+
+
+MAX_SIMILAR = 50
+# Candidates searched per result, since the target's own spectra and those the user may not view are dropped
+SIMILAR_SEARCH_DEPTH = 5
+
+
+@require_GET
+def similar_spectra(request, target_id):
+    '''
+    The ``k`` targets (at most ``MAX_SIMILAR``) with the spectra most like this target's, by the cosine similarity of
+    their rest-frame feature vectors in the similarity index (see ``tidestom.tides_utils.similarity``). The query is
+    the spectrum ``datum`` if given, else the target's spectrum with the most reliable redshift. Each target is listed
+    once, with its most similar spectrum.
+    '''
+    index = current_index()
+    if index is None:
+        return JsonResponse({'error': 'The similarity index has not been built'}, status=503)
+    try:
+        k = min(max(int(request.GET.get('k', 10)), 1), MAX_SIMILAR)
+    except ValueError:
+        return JsonResponse({'error': 'k must be an integer'}, status=400)
+    datums = spectroscopy_datums(request.user, target_id)
+    n_own = datums.count()
+    if request.GET.get('datum', '').isdigit():
+        datums = datums.filter(id=int(request.GET['datum']))
+    estimates = RedshiftEstimate.objects.filter(reduced_datum__in=datums, r_value__gte=MIN_R_VALUE).order_by(
+        '-r_value').values_list('reduced_datum_id', 'redshift')
+    query, redshift = next(((datum_id, redshift) for datum_id, redshift in estimates
+                            if index.vector_of(datum_id) is not None), (None, None))
+    if query is None:
+        return JsonResponse({'target': target_id, 'datum': None, 'redshift': None, 'similar': []})
+
+    found, similarity = index.search(index.vector_of(query), SIMILAR_SEARCH_DEPTH * k + n_own)
+    matches = ReducedDatum.objects.filter(id__in=found.tolist()).exclude(target_id=target_id)
+    if not settings.TARGET_PERMISSIONS_ONLY:
+        matches = get_objects_for_user(request.user, 'tom_dataproducts.view_reduceddatum', klass=matches)
+    target_of = dict(matches.values_list('id', 'target_id'))
+    targets = Target.objects.filter(id__in=set(target_of.values()))
+    if not request.user.is_superuser:
+        targets = get_objects_for_user(request.user, f'{Target._meta.app_label}.view_target', klass=targets)
+    rows = {row['id']: row for row in TidesTarget.objects.filter(id__in=targets.values('id')).values(
+        'id', 'name', 'auto_tidesclass', 'human_tidesclass')}
+    redshifts = dict(RedshiftEstimate.objects.filter(reduced_datum_id__in=list(target_of)).values_list(
+        'reduced_datum_id', 'redshift'))
 
+    similar = []
+    for datum_id, score in zip(found.tolist(), similarity.tolist()):
+        row = rows.pop(target_of.get(datum_id), None)
+        if row is None:
+            continue
+        similar.append({**row, 'datum': datum_id, 'similarity': score, 'redshift': redshifts.get(datum_id),
+                        'url': reverse('target_detail', kwargs={'pk': row['id']})})
+        if len(similar) == k:
+            break
+    return JsonResponse({'target': target_id, 'datum': query, 'redshift': redshift, 'similar': similar})